@@ -0,0 +1,288 @@
+import argparse
+import datetime
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import openpyxl as op
+
+import jiesheng
+from scripts.rate_limiter import STATE_FILE_ENV
+from scripts.utils import print_with_color
+
+
+class FleetTask:
+    """
+    批量执行中的一个任务，对应 task_result.xlsx 中的一行。
+    """
+
+    def __init__(self, num, app, task, using_method):
+        """
+        初始化 FleetTask 实例。
+
+        :param num: 任务在 excel 表格中的行号
+        :param app: 应用名称
+        :param task: 任务描述
+        :param using_method: 是否使用基于相似度的任务终止方法（"TRUE" / "FALSE"）
+        """
+        self.num = num
+        self.app = app
+        self.task = task
+        self.using_method = using_method
+        self.attempts = 0
+        self.device = None
+        self.status = "pending"
+        self.duration = 0.0
+        self.result = None
+
+
+def list_healthy_devices():
+    """
+    列出所有状态为 device（已连接且已授权）的设备，offline / unauthorized 的设备会被跳过。
+
+    :return: 设备标识符列表
+    """
+    try:
+        output = subprocess.run(["adb", "devices"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True).stdout
+    except OSError as e:
+        print_with_color(f"ERROR: failed to list devices\n{e}", "red")
+        return []
+    devices = []
+    for line in output.strip().split("\n")[1:]:
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == "device":
+            devices.append(fields[0])
+    return devices
+
+
+def device_healthy(device):
+    """
+    检查设备是否仍然在线。
+
+    :param device: 设备标识符
+    :return: 设备在线时返回 True
+    """
+    try:
+        result = subprocess.run(["adb", "-s", device, "get-state"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0 and result.stdout.strip() == "device"
+
+
+def load_tasks(excel_path, rows=None):
+    """
+    从 excel 表格中读取要执行的任务。
+
+    :param excel_path: excel 表格的路径
+    :param rows: 要执行的行号列表，默认为第 2 行到最后一行中第一列非空的所有行
+    :return: FleetTask 列表
+    """
+    if rows is None:
+        workbook = op.load_workbook(excel_path, read_only=True)
+        worksheet = workbook['Sheet1']
+        rows = [i for i, row in enumerate(worksheet.iter_rows(min_row=2, max_col=1, values_only=True), start=2)
+                if row[0]]
+        workbook.close()
+    tasks = []
+    for num in rows:
+        app, task, using_method = jiesheng.learn_from_excel(num, excel_path)
+        # learn_from_excel 为了拼接 os.system 命令给任务加了引号，这里使用参数列表启动子进程，去掉引号；
+        # 表格中的 using_method 是布尔值，而 self_explorer.py 判断的是字符串 'TRUE'
+        tasks.append(FleetTask(num, app, task.strip('"'), str(using_method).upper()))
+    return tasks
+
+
+def parse_rows(rows):
+    """
+    解析形如 "2-10,15,18" 的行号参数。
+
+    :param rows: 行号字符串
+    :return: 行号列表
+    """
+    if not rows:
+        return None
+    nums = []
+    for part in rows.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            nums.extend(range(int(start), int(end) + 1))
+        else:
+            nums.append(int(part))
+    return nums
+
+
+class FleetRunner:
+    """
+    把任务分发到多台设备上并行执行。
+
+    每台设备一个工作线程，所有线程共享一个任务队列；每个任务在其设备上启动一个 self_explorer.py 子进程。
+    执行后设备掉线（adb 断开或 offline）时，任务会被放回队列，由其他设备重试，掉线的设备不再领取新任务；
+    设备仍然在线而子进程异常退出时，失败来自任务本身，换一台设备重跑也不会成功，任务直接记为失败。
+    所有任务的统计数据由主线程统一写回 excel 表格，避免多个进程同时改写同一个文件。
+    """
+
+    def __init__(self, devices, tasks, root_dir, log_dir, retries):
+        """
+        初始化 FleetRunner 实例。
+
+        :param devices: 参与执行的设备列表
+        :param tasks: FleetTask 列表
+        :param root_dir: 传给 self_explorer.py 的根目录
+        :param log_dir: 子进程输出和统计结果的保存目录
+        :param retries: 任务因设备故障失败后的最大重试次数
+        """
+        self.devices = devices
+        self.tasks = tasks
+        self.root_dir = root_dir
+        self.log_dir = log_dir
+        self.retries = retries
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = len(tasks)
+
+    def run_task(self, task, device):
+        """
+        在指定设备上执行一个任务。
+
+        :param task: FleetTask 实例
+        :param device: 设备标识符
+        :return: 子进程的退出码以及读取到的统计结果（没有结果时为 None）
+        """
+        name = f"{task.num}_{device.replace(':', '_')}_{task.attempts}"
+        result_path = os.path.join(self.log_dir, f"{name}.json")
+        command = [sys.executable, os.path.join("scripts", "self_explorer.py"), "--app", task.app, "--task",
+                   task.task, "--using_method", str(task.using_method), "--num", str(task.num), "--root_dir",
+                   self.root_dir, "--device", device, "--result_json", result_path]
+        # 所有子进程通过同一个状态文件共用模型接口的 RPM / TPM 额度
+        env = dict(os.environ)
+        env.setdefault(STATE_FILE_ENV, os.path.abspath(os.path.join(self.log_dir, "rate_limit.json")))
+        with open(os.path.join(self.log_dir, f"{name}.log"), "w", encoding="utf-8") as logfile:
+            returncode = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=logfile,
+                                        stderr=subprocess.STDOUT, env=env).returncode
+        if not os.path.exists(result_path):
+            return returncode, None
+        with open(result_path, "r") as f:
+            return returncode, json.load(f)
+
+    def finish(self, task, status):
+        with self.lock:
+            task.status = status
+            self.pending -= 1
+
+    def worker(self, device):
+        """
+        设备工作线程：不断从共享队列中领取任务执行，直到所有任务结束或设备掉线。
+
+        :param device: 设备标识符
+        """
+        while True:
+            with self.lock:
+                if self.pending == 0:
+                    return
+            try:
+                task = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            task.attempts += 1
+            task.device = device
+            print_with_color(f"[{device}] row {task.num}: {task.app} - {task.task} (attempt {task.attempts})", "blue")
+            start = time.time()
+            returncode, result = self.run_task(task, device)
+            task.duration += time.time() - start
+            healthy = device_healthy(device)
+            if returncode == 0 and result is not None and healthy:
+                task.result = result
+                self.finish(task, "complete" if result["task_complete"] else "finished")
+                print_with_color(f"[{device}] row {task.num} done in {task.duration:.0f}s", "green")
+            elif healthy:
+                self.finish(task, "failed")
+                print_with_color(f"[{device}] row {task.num} failed (exit code {returncode})", "red")
+            elif task.attempts <= self.retries:
+                print_with_color(f"[{device}] row {task.num} interrupted by a device fault, requeued", "yellow")
+                self.queue.put(task)
+            else:
+                self.finish(task, "failed")
+                print_with_color(f"[{device}] row {task.num} failed after {task.attempts} attempts", "red")
+            if not healthy:
+                print_with_color(f"[{device}] device is no longer available, worker stopped", "red")
+                return
+
+    def run(self):
+        """
+        启动所有设备的工作线程并等待任务执行完毕。
+
+        :return: FleetTask 列表
+        """
+        for task in self.tasks:
+            self.queue.put(task)
+        threads = [threading.Thread(target=self.worker, args=(device,), name=f"fleet-{device}")
+                   for device in self.devices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 所有设备都掉线时，队列中剩余的任务无法执行
+        while not self.queue.empty():
+            self.finish(self.queue.get(), "no device")
+        return self.tasks
+
+
+def write_results(tasks, excel_path):
+    """
+    把每个任务的统计数据写回 excel 表格。
+
+    :param tasks: FleetTask 列表
+    :param excel_path: excel 表格的路径
+    """
+    for task in tasks:
+        if task.result is None:
+            continue
+        r = task.result
+        jiesheng.write_to_excel(task.num, r["step_num"], r["explore_tokens"], r["reflect_tokens"],
+                                r["similarity_index"], excel_path)
+
+
+def print_summary(tasks, elapsed):
+    print_with_color(f"{'row':<5}{'status':<12}{'device':<22}{'attempts':<10}{'steps':<7}{'time':<8}task", "yellow")
+    for task in sorted(tasks, key=lambda t: t.num):
+        steps = task.result["step_num"] if task.result else "-"
+        print(f"{task.num:<5}{task.status:<12}{str(task.device):<22}{task.attempts:<10}{str(steps):<7}"
+              f"{task.duration:<8.0f}{task.app} - {task.task}")
+    done = sum(1 for task in tasks if task.result is not None)
+    busy = sum(task.duration for task in tasks)
+    print_with_color(f"{done}/{len(tasks)} tasks finished in {elapsed:.0f}s "
+                     f"(device time {busy:.0f}s, speedup x{busy / elapsed if elapsed else 0:.1f})", "yellow")
+
+
+if __name__ == '__main__':
+    arg_desc = "AppAgent - multi-device batch execution"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("--excel", default="./task_result.xlsx")
+    parser.add_argument("--rows", help="要执行的行号，例如 2-10,15；默认执行表格中的所有任务")
+    parser.add_argument("--devices", help="逗号分隔的设备列表；默认使用所有在线设备")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--root_dir", default="./")
+    args = vars(parser.parse_args())
+
+    devices = args["devices"].split(",") if args["devices"] else list_healthy_devices()
+    devices = [device for device in devices if device_healthy(device)]
+    if not devices:
+        print_with_color("ERROR: No device found!", "red")
+        sys.exit(1)
+    print_with_color(f"Devices in the fleet: {devices}", "yellow")
+
+    tasks = load_tasks(args["excel"], parse_rows(args["rows"]))
+    log_dir = os.path.join(args["root_dir"], "fleet_logs",
+                           datetime.datetime.now().strftime("fleet_%Y-%m-%d_%H-%M-%S"))
+    os.makedirs(log_dir)
+
+    start = time.time()
+    FleetRunner(devices, tasks, args["root_dir"], log_dir, args["retries"]).run()
+    elapsed = time.time() - start
+    write_results(tasks, args["excel"])
+    print_summary(tasks, elapsed)
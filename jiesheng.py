@@ -1,13 +1,21 @@
 import cv2
+import numpy as np
 from skimage.metrics import structural_similarity as ssim
 import os
 import openpyxl as op
 
-# 计算两个图像的结构相似性指数
+# 读取图像：已经在内存中的 BGR 数组直接使用，否则从文件中读取
+def read_image(img):
+    if isinstance(img, np.ndarray):
+        return img
+    return cv2.imread(img)
+
+
+# 计算两个图像的结构相似性指数，参数可以是文件路径或 BGR 数组
 def pic_ssim(img1_path, img2_path):
     # 读取两个图像
-    img1 = cv2.imread(img1_path)
-    img2 = cv2.imread(img2_path)
+    img1 = read_image(img1_path)
+    img2 = read_image(img2_path)
 
     if img1 is None:
         raise FileNotFoundError(f"Image file not found: {img1_path}")
@@ -18,6 +26,9 @@ def pic_ssim(img1_path, img2_path):
     # 将图像转换为灰度
     img1_gray = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
     img2_gray = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    # 尺寸不同时把第二个图像缩放到第一个图像的尺寸
+    if img2_gray.shape != img1_gray.shape:
+        img2_gray = cv2.resize(img2_gray, (img1_gray.shape[1], img1_gray.shape[0]), interpolation=cv2.INTER_AREA)
 
     # 计算两个图像的结构相似性指数
     similarity_index = ssim(img1_gray, img2_gray)
@@ -1,17 +1,40 @@
+import atexit
+import collections
+import hashlib
+import io
 import os
+import queue
+import shlex
+import struct
 import subprocess
+import threading
+import time
+import uuid
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
 
 from config import load_config
-from utils import print_with_color
+from element_table import ATTRIB_FLAGS, ElementTable
+from hierarchy_cache import HierarchyCache, screen_key
+from spatial_index import MinDistIndex, far_mask
+from ui_diff import HierarchyDiffer
+from utils import print_with_color, save_artifact
 
 configs = load_config()
 
+# 空输入的 md5 摘要
+EMPTY_MD5 = "d41d8cd98f00b204e9800998ecf8427e"
+
 
 class AndroidElement:
     """
         Class representing an Android UI element.
     """
+    __slots__ = ("uid", "bbox", "attrib")
+
     def __init__(self, uid, bbox, attrib):
         """
         Initialize an AndroidElement instance.
@@ -41,6 +64,289 @@ def execute_adb(adb_command):
     return "ERROR"
 
 
+def execute_adb_exec_out(device, command):
+    """
+    通过 `adb exec-out` 执行命令，并以二进制形式返回其标准输出（不经过设备上的文件）。
+
+    :param device: Android 设备的标识符
+    :param command: 要在设备上执行的命令
+    :return: 命令输出的 bytes，失败时返回 "ERROR"
+    """
+    adb_command = ["adb", "-s", device, "exec-out", command]
+    try:
+        result = subprocess.run(adb_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        print_with_color(f"Command execution failed: {' '.join(adb_command)}", "red")
+        print_with_color(str(e), "red")
+        return "ERROR"
+    if result.returncode == 0:
+        return result.stdout
+    print_with_color(f"Command execution failed: {' '.join(adb_command)}", "red")
+    print_with_color(result.stderr.decode("utf-8", "replace"), "red")
+    return "ERROR"
+
+
+def read_raw_screencap(device):
+    """
+    通过 `adb exec-out screencap` 读取设备的原始 RGBA 帧缓冲。
+
+    screencap 的原始输出以 12 字节（Android 9 之前）或 16 字节（多一个 colorspace 字段）的头部开始，
+    头部包含宽、高和像素格式，之后是 width * height * 4 字节的像素数据。像素数据直接读入一块预先分配的
+    bytearray，返回的数组是这块内存上的视图，既不在手机上编码 PNG，也不在主机上解码或复制。
+
+    :param device: Android 设备的标识符
+    :return: 形状为 (height, width, 4) 的 RGBA uint8 数组，失败时返回 None
+    """
+    adb_command = ["adb", "-s", device, "exec-out", "screencap"]
+    try:
+        proc = subprocess.Popen(adb_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        print_with_color(f"Command execution failed: {' '.join(adb_command)}", "red")
+        print_with_color(str(e), "red")
+        return None
+    with proc:
+        header = proc.stdout.read(12)
+        complete = False
+        if len(header) == 12:
+            width, height, _ = struct.unpack("<III", header)
+            frame_size = width * height * 4
+            buffer = bytearray(frame_size + 4)
+            view = memoryview(buffer)
+            received = 0
+            while received < len(buffer):
+                n = proc.stdout.readinto(view[received:])
+                if not n:
+                    break
+                received += n
+            proc.stdout.read()
+            complete = received in (frame_size, frame_size + 4)
+        stderr = proc.stderr.read()
+        proc.wait()
+    if proc.returncode != 0 or not complete:
+        print_with_color(f"Command execution failed: {' '.join(adb_command)}", "red")
+        print_with_color(stderr.decode("utf-8", "replace") or "unexpected screencap output size", "red")
+        return None
+    offset = received - frame_size
+    return np.frombuffer(buffer, dtype=np.uint8, count=frame_size, offset=offset).reshape(height, width, 4)
+
+
+def _pump_stream(stream, sink):
+    """
+    在后台线程中逐行读取 adb shell 的输出流，读到 EOF 时向 sink 写入 None。
+
+    :param stream: 子进程的 stdout 或 stderr
+    :param sink: 接收每一行的回调
+    """
+    try:
+        for line in iter(stream.readline, ""):
+            sink(line.rstrip("\r\n"))
+    except (OSError, ValueError):
+        pass
+    sink(None)
+
+
+class AdbShellSession:
+    """
+    一个长驻的 `adb -s <device> shell` 会话。
+
+    命令通过 stdin 写入同一个 shell 进程，每条命令之后追加一个带退出码的哨兵行（sentinel），
+    读取 stdout 直到哨兵出现即可得到这条命令的完整输出，避免每次操作都重新启动 adb 客户端。
+    会话断开时会自动重连。
+    """
+
+    def __init__(self, device, timeout):
+        """
+        初始化 AdbShellSession 实例。
+
+        :param device: Android 设备的标识符
+        :param timeout: 单条命令等待输出的最长时间，单位为秒
+        """
+        self.device = device
+        self.timeout = timeout
+        self.proc = None
+        self.lines = None
+        self.errors = None
+
+    def alive(self):
+        """
+        判断 shell 进程是否仍在运行。
+
+        :return: 进程存活时返回 True
+        """
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        """
+        启动 adb shell 进程以及读取 stdout/stderr 的后台线程。
+        """
+        self.proc = subprocess.Popen(["adb", "-s", self.device, "shell"], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding="utf-8",
+                                     errors="replace", bufsize=1)
+        self.lines = queue.Queue()
+        self.errors = collections.deque(maxlen=100)
+        threading.Thread(target=_pump_stream, args=(self.proc.stdout, self.lines.put), daemon=True).start()
+        threading.Thread(target=_pump_stream, args=(self.proc.stderr, self.errors.append), daemon=True).start()
+
+    def close(self):
+        """
+        关闭 shell 进程。
+        """
+        if self.proc is None:
+            return
+        try:
+            if self.proc.poll() is None:
+                self.proc.stdin.close()
+                self.proc.terminate()
+                self.proc.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+        self.proc = None
+
+    def execute(self, command):
+        """
+        在会话中执行一条 shell 命令并返回结果。
+
+        命令作为 `sh -c` 的一个参数（经 shlex.quote 引用）发送，即使命令本身的引号不完整，
+        也只会让这条命令失败，不会吞掉后面的哨兵行。
+        命令写入失败时（例如会话已经断开）会重连后重试一次；已经写入的命令如果等待输出超时或会话中途断开，
+        不会重发，以免重复执行点击等操作，此时会话在下一次调用时重建。
+
+        :param command: 要在设备上执行的 shell 命令（不含 `adb -s <device> shell` 前缀）
+        :return: 命令的输出，失败时返回 "ERROR"
+        """
+        sentinel = f"__MTTIA_{uuid.uuid4().hex}__"
+        for attempt in range(2):
+            try:
+                if not self.alive():
+                    self.close()
+                    self.start()
+                self.errors.clear()
+                self.proc.stdin.write(f"sh -c {shlex.quote(command)} < /dev/null\necho {sentinel} $?\n")
+                self.proc.stdin.flush()
+                break
+            except OSError as e:
+                print_with_color(f"adb shell session to {self.device} is broken ({e}), reconnecting", "yellow")
+                self.close()
+        else:
+            print_with_color(f"Command execution failed: {command}", "red")
+            return "ERROR"
+
+        output = []
+        returncode = None
+        try:
+            while returncode is None:
+                line = self.lines.get(timeout=self.timeout)
+                if line is None:
+                    raise ConnectionError("adb shell session closed")
+                pos = line.find(sentinel)
+                if pos < 0:
+                    output.append(line)
+                    continue
+                if pos > 0:
+                    output.append(line[:pos])
+                returncode = int(line[pos + len(sentinel):].strip() or 1)
+        except (queue.Empty, ConnectionError, ValueError) as e:
+            print_with_color(f"Command execution failed: {command}", "red")
+            print_with_color(f"adb shell session to {self.device} lost: {e or 'timeout'}", "red")
+            self.close()
+            return "ERROR"
+        if returncode == 0:
+            return "\n".join(output).strip()
+        print_with_color(f"Command execution failed: {command}", "red")
+        print_with_color("\n".join(line for line in self.errors if line), "red")
+        return "ERROR"
+
+
+class AdbShellPool:
+    """
+    同一设备上的一组 AdbShellSession。
+
+    每次执行命令时借出一个空闲会话，用完归还；会话按需创建，数量不超过 size，
+    以便截图、dump XML 等操作可以并行执行。
+    """
+
+    def __init__(self, device, size, timeout):
+        """
+        初始化 AdbShellPool 实例。
+
+        :param device: Android 设备的标识符
+        :param size: 会话的最大数量
+        :param timeout: 单条命令等待输出的最长时间，单位为秒
+        """
+        self.device = device
+        self.size = max(1, int(size))
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        借出一个会话；没有空闲会话且未达到上限时新建一个，否则等待其他调用归还。
+
+        :return: AdbShellSession 实例
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.sessions) < self.size:
+                session = AdbShellSession(self.device, self.timeout)
+                self.sessions.append(session)
+                return session
+        return self.idle.get()
+
+    def execute(self, command):
+        """
+        借用一个会话执行 shell 命令。
+
+        :param command: 要在设备上执行的 shell 命令
+        :return: 命令的输出，失败时返回 "ERROR"
+        """
+        session = self.acquire()
+        try:
+            return session.execute(command)
+        finally:
+            self.idle.put(session)
+
+    def close(self):
+        """
+        关闭池中的所有会话。
+        """
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+
+
+_shell_pools = {}
+_shell_pools_lock = threading.Lock()
+
+
+def get_shell_pool(device):
+    """
+    获取（必要时创建）某个设备共享的 adb shell 会话池。
+
+    :param device: Android 设备的标识符
+    :return: AdbShellPool 实例
+    """
+    with _shell_pools_lock:
+        if device not in _shell_pools:
+            _shell_pools[device] = AdbShellPool(device, configs["ADB_SHELL_POOL_SIZE"], configs["ADB_SHELL_TIMEOUT"])
+        return _shell_pools[device]
+
+
+@atexit.register
+def close_all_shell_pools():
+    """
+    关闭所有设备的 adb shell 会话，在解释器退出时自动调用。
+    """
+    with _shell_pools_lock:
+        for pool in _shell_pools.values():
+            pool.close()
+        _shell_pools.clear()
+
+
 def list_all_devices():
     """
         List all connected Android devices.
@@ -85,6 +391,116 @@ def get_id_from_element(elem):
     return elem_id
 
 
+def open_xml_source(xml_source):
+    """
+    把 XML 来源统一成 ET.iterparse 可以读取的对象。
+
+    :param xml_source: XML 文件的路径、内存中的 XML bytes，或者已打开的二进制文件对象
+    :return: 文件路径或文件对象
+    """
+    if isinstance(xml_source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(xml_source)
+    return xml_source
+
+
+INTERESTING_ATTRIBS = ("clickable", "focusable", "scrollable", "long-clickable")
+
+
+# 计算子树内容哈希时使用的节点属性；不包含 bounds，元素只是移动位置时哈希不变
+HASH_ATTRIBS = ("class", "resource-id", "text", "content-desc", "checkable", "checked", "enabled", "focused",
+                "selected")
+
+
+def iter_tree_matches(xml_path, attribs, add_index=False):
+    """
+    只遍历一次 XML 树，按文档顺序产出至少具有 attribs 中一个属性（值为 "true"）的节点。
+
+    每个节点的 ID 在整个遍历过程中只计算一次，作为父节点前缀时直接复用。
+    遍历的同时自底向上计算每个节点的子树内容哈希（节点的 HASH_ATTRIBS 加上所有子节点的哈希），
+    因此结果在整棵树解析完之后才会产出。
+
+    :param xml_path: XML 文件的路径，或者内存中的 XML bytes
+    :param attribs: 要查找的属性
+    :param add_index: 是否在 ID 中添加元素的索引
+    :return: 生成 (elem_id, (x1, y1, x2, y2), matched, flags, subtree_hash) 的迭代器，matched 为节点具有的
+             attribs 中的属性，flags 为节点在 ATTRIB_FLAGS 中全部属性的位标志
+    """
+    path = []
+    ids = []
+    hashers = []
+    pending = []
+    records = []
+
+    def node_id(depth):
+        if ids[depth] is None:
+            ids[depth] = get_id_from_element(path[depth])
+        return ids[depth]
+
+    for event, elem in ET.iterparse(open_xml_source(xml_path), ['start', 'end']):
+        if event == 'start':
+            path.append(elem)
+            ids.append(None)
+            hasher = hashlib.blake2b(digest_size=8)
+            hasher.update("\x1f".join(elem.attrib.get(key, "") for key in HASH_ATTRIBS).encode("utf-8"))
+            hashers.append(hasher)
+            pending.append(None)
+            matched = [attrib for attrib in attribs if elem.attrib.get(attrib) == "true"]
+            if not matched:
+                continue
+            bounds = elem.attrib["bounds"][1:-1].split("][")
+            x1, y1 = map(int, bounds[0].split(","))
+            x2, y2 = map(int, bounds[1].split(","))
+            elem_id = node_id(-1)
+            if len(path) > 1:
+                elem_id = node_id(-2) + "_" + elem_id
+            if add_index:
+                elem_id += f"_{elem.attrib['index']}"
+            flags = 0
+            for attrib, flag in ATTRIB_FLAGS.items():
+                if elem.attrib.get(attrib) == "true":
+                    flags |= flag
+            pending[-1] = [elem_id, (x1, y1, x2, y2), matched, flags, 0]
+            records.append(pending[-1])
+
+        if event == 'end':
+            path.pop()
+            ids.pop()
+            digest = hashers.pop().digest()
+            if hashers:
+                hashers[-1].update(digest)
+            record = pending.pop()
+            if record is not None:
+                record[4] = int.from_bytes(digest, "little")
+    for record in records:
+        yield tuple(record)
+
+
+def traverse_tree_multi(xml_path, elem_lists, add_index=False):
+    """
+    只遍历一次 XML 树，同时按多个属性对元素进行分类。
+
+    elem_lists 的键是要查找的属性（例如 "clickable"、"focusable"），值是对应的元素列表。
+    每个属性的收集规则与 traverse_tree 相同：元素中心与同一列表中已有元素的距离不超过 MIN_DIST 时被丢弃，
+    这一检查通过每个属性一个 MinDistIndex 网格索引完成。
+
+    :param xml_path: XML 文件的路径，或者内存中的 XML bytes
+    :param elem_lists: 属性到元素列表的字典，找到的元素会被追加到对应的列表中
+    :param add_index: 是否在 ID 中添加元素的索引
+    :return: elem_lists
+    """
+    indexes = {}
+    for attrib, elem_list in elem_lists.items():
+        indexes[attrib] = MinDistIndex(configs["MIN_DIST"])
+        for e in elem_list:
+            bbox = e.bbox
+            indexes[attrib].add((bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2)
+    for elem_id, (x1, y1, x2, y2), matched, _, _ in iter_tree_matches(xml_path, list(elem_lists), add_index):
+        for attrib in matched:
+            if indexes[attrib].add_if_far((x1 + x2) // 2, (y1 + y2) // 2):
+                elem_lists[attrib].append(AndroidElement(elem_id, ((x1, y1), (x2, y2)), attrib))
+    return elem_lists
+
+
 def traverse_tree(xml_path, elem_list, attrib, add_index=False):
     """
     遍历 XML 树，查找具有特定属性的元素，并将其添加到列表中。
@@ -92,42 +508,78 @@ def traverse_tree(xml_path, elem_list, attrib, add_index=False):
     这个函数遍历 XML 树，查找具有特定属性的元素。如果找到这样的元素，它会生成一个唯一的 ID，
     并将其添加到提供的列表中。如果元素的父元素存在，那么父元素的 ID 会被添加到元素的 ID 前面。
     如果 `add_index` 参数为 True，那么元素的索引也会被添加到 ID 中。
+    需要同时查找多个属性时，请使用只遍历一次的 traverse_tree_multi。
 
-    :param xml_path: XML 文件的路径
+    :param xml_path: XML 文件的路径，或者 get_xml_stream 返回的内存中的 XML bytes
     :param elem_list: 用于存储找到的元素的列表
     :param attrib: 要查找的属性
     :param add_index: 是否在 ID 中添加元素的索引
     """
-    path = []
-    for event, elem in ET.iterparse(xml_path, ['start', 'end']):
-        if event == 'start':
-            path.append(elem)
-            if attrib in elem.attrib and elem.attrib[attrib] == "true":
-                parent_prefix = ""
-                if len(path) > 1:
-                    parent_prefix = get_id_from_element(path[-2])
-                bounds = elem.attrib["bounds"][1:-1].split("][")
-                x1, y1 = map(int, bounds[0].split(","))
-                x2, y2 = map(int, bounds[1].split(","))
-                center = (x1 + x2) // 2, (y1 + y2) // 2
-                elem_id = get_id_from_element(elem)
-                if parent_prefix:
-                    elem_id = parent_prefix + "_" + elem_id
-                if add_index:
-                    elem_id += f"_{elem.attrib['index']}"
-                close = False
-                for e in elem_list:
-                    bbox = e.bbox
-                    center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-                    dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-                    if dist <= configs["MIN_DIST"]:
-                        close = True
-                        break
-                if not close:
-                    elem_list.append(AndroidElement(elem_id, ((x1, y1), (x2, y2)), attrib))
+    traverse_tree_multi(xml_path, {attrib: elem_list}, add_index)
 
-        if event == 'end':
-            path.pop()
+
+def merge_elem_lists(clickable_list, focusable_list):
+    """
+    合并可点击元素和可聚焦元素；与某个可点击元素中心距离不超过 MIN_DIST 的可聚焦元素会被丢弃。
+    距离检查由 spatial_index.far_mask 完成，方式由配置项 DEDUP_METHOD 决定。
+
+    :param clickable_list: 可点击元素的 ElementTable
+    :param focusable_list: 可聚焦元素的 ElementTable
+    :return: 合并、去重后的 ElementTable
+    """
+    mask = far_mask(focusable_list.centers(), clickable_list.centers(), configs["MIN_DIST"],
+                    configs["DEDUP_METHOD"])
+    return ElementTable.concat([clickable_list, focusable_list.select(np.asarray(mask, dtype=bool))])
+
+
+def get_elem_list(xml_path, elem_lists=None):
+    """
+    从 XML 中获取本轮要标注的元素表。
+
+    只遍历一次 XML，同时收集可点击、可聚焦、可滚动和可长按的元素（每一类内部按 MIN_DIST 去重），
+    直接写入按列存储的 ElementTable，然后按 merge_elem_lists 的规则合并可点击和可聚焦元素。
+
+    :param xml_path: XML 文件的路径，或者内存中的 XML bytes
+    :param elem_lists: 可选的空字典，用于取回按属性分类的全部元素表
+    :return: 合并、去重后的 ElementTable
+    """
+    if elem_lists is None:
+        elem_lists = {}
+    columns = {attrib: ([], [], [], []) for attrib in INTERESTING_ATTRIBS}
+    indexes = {attrib: MinDistIndex(configs["MIN_DIST"]) for attrib in INTERESTING_ATTRIBS}
+    for elem_id, box, matched, flags, subtree_hash in iter_tree_matches(xml_path, INTERESTING_ATTRIBS, True):
+        for attrib in matched:
+            if indexes[attrib].add_if_far((box[0] + box[2]) // 2, (box[1] + box[3]) // 2):
+                uids, boxes, flag_list, hashes = columns[attrib]
+                uids.append(elem_id)
+                boxes.append(box)
+                flag_list.append(flags)
+                hashes.append(subtree_hash)
+    for attrib, (uids, boxes, flag_list, hashes) in columns.items():
+        elem_lists[attrib] = ElementTable(uids, boxes, flag_list, [attrib] * len(uids), hashes)
+    return merge_elem_lists(elem_lists["clickable"], elem_lists["focusable"])
+
+
+class ScreenState:
+    """
+    一轮观察得到的屏幕快照。
+    """
+
+    def __init__(self, image, xml, elem_list, timings, diff=None):
+        """
+        初始化 ScreenState 实例。
+
+        :param image: BGR 格式的截图数组
+        :param xml: XML 内容的 bytes 或 XML 文件的路径
+        :param elem_list: 合并、去重后的 ElementTable
+        :param timings: 各步骤耗时（秒），包括 screenshot、xml、parse 和 total；开启缓存时 cache 为 "hit" 或 "miss"
+        :param diff: 与上一次 capture_state 得到的元素表之间的 UiDiff
+        """
+        self.image = image
+        self.xml = xml
+        self.elem_list = elem_list
+        self.timings = timings
+        self.diff = diff
 
 
 class AndroidController:
@@ -144,10 +596,16 @@ class AndroidController:
         :param device: 要控制的 Android 设备
         """
         self.device = device
+        self.shell = get_shell_pool(device)
         self.screenshot_dir = configs["ANDROID_SCREENSHOT_DIR"]
         self.xml_dir = configs["ANDROID_XML_DIR"]
         self.width, self.height = self.get_device_size()
         self.backslash = "\\"
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"capture-{device}")
+        # 命中缓存时被丢弃、但仍在执行的 uiautomator dump
+        self.pending_dump = None
+        self.differ = HierarchyDiffer()
+        self.xml_cache = HierarchyCache(configs["XML_CACHE_SIZE"])
 
     def get_device_size(self):
         """
@@ -155,8 +613,7 @@ class AndroidController:
 
         :return: 设备的宽度和高度
         """
-        adb_command = f"adb -s {self.device} shell wm size"
-        result = execute_adb(adb_command)
+        result = self.shell.execute("wm size")
         if result != "ERROR":
             return map(int, result.split(": ")[1].split("x"))
         return 0, 0
@@ -169,12 +626,12 @@ class AndroidController:
         :param save_dir: 截图文件的保存目录
         :return: 截图文件的路径
         """
-        cap_command = f"adb -s {self.device} shell screencap -p " \
+        cap_command = "screencap -p " \
                       f"{os.path.join(self.screenshot_dir, prefix + '.png').replace(self.backslash, '/')}"
         pull_command = f"adb -s {self.device} pull " \
                        f"{os.path.join(self.screenshot_dir, prefix + '.png').replace(self.backslash, '/')} " \
                        f"{os.path.join(save_dir, prefix + '.png')}"
-        result = execute_adb(cap_command)
+        result = self.shell.execute(cap_command)
         if result != "ERROR":
             result = execute_adb(pull_command)
             if result != "ERROR":
@@ -182,20 +639,94 @@ class AndroidController:
             return result
         return result
 
+    def get_screenshot_raw(self):
+        """
+        以流的方式获取 Android 设备的原始 RGBA 屏幕截图，不在设备上写文件。
+
+        :return: 形状为 (height, width, 4) 的 RGBA 数组，失败时返回 None
+        """
+        return read_raw_screencap(self.device)
+
+    def get_screenshot_image(self, prefix, save_dir):
+        """
+        获取 Android 设备的屏幕截图并以 BGR 数组的形式返回，同时由后台线程在 save_dir 中保存一份 PNG。
+
+        截图方式由配置项 SCREENSHOT_MODE 决定：
+        "raw" 通过 exec-out 读取原始帧缓冲（手机上不编码 PNG，主机上不解码）；
+        "png" 通过 exec-out 读取 PNG 数据并在内存中解码；
+        "pull" 沿用 get_screenshot 的设备端保存 + adb pull 方式。
+
+        :param prefix: 截图文件的前缀
+        :param save_dir: 截图文件的保存目录
+        :return: BGR 格式的截图数组，失败时返回 None
+        """
+        mode = configs["SCREENSHOT_MODE"]
+        save_path = os.path.join(save_dir, prefix + ".png")
+        if mode == "pull":
+            result = self.get_screenshot(prefix, save_dir)
+            if result == "ERROR":
+                return None
+            return cv2.imread(result)
+        if mode == "png":
+            data = execute_adb_exec_out(self.device, "screencap -p")
+            if data == "ERROR":
+                return None
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                print_with_color("ERROR: failed to decode the screenshot", "red")
+                return None
+            save_artifact(save_path, data)
+            return image
+        rgba = self.get_screenshot_raw()
+        if rgba is None:
+            return None
+        image = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+        save_artifact(save_path, image)
+        return image
+
+    def get_xml_stream(self, prefix=None, save_dir=None):
+        """
+        通过 `uiautomator dump /dev/tty` 把 UI 层次结构直接从标准输出读回内存，不在设备上写文件，也不需要 adb pull。
+
+        配置项 SAVE_XML 为 true 且给出了 save_dir 时，XML 会由后台线程另存一份到 save_dir 中，作为日志产物。
+
+        :param prefix: XML 文件的前缀
+        :param save_dir: XML 文件的保存目录
+        :return: XML 内容的 bytes，失败时返回 "ERROR"
+        """
+        data = execute_adb_exec_out(self.device, "uiautomator dump /dev/tty")
+        if data == "ERROR":
+            return data
+        # 输出的末尾还带有一行 "UI hierchary dumped to: /dev/tty"，只保留 XML 部分
+        start = data.find(b"<?xml")
+        end = data.rfind(b"</hierarchy>")
+        if start < 0 or end < 0:
+            print_with_color(f"ERROR: unexpected uiautomator output\n{data[-200:].decode('utf-8', 'replace')}", "red")
+            return "ERROR"
+        xml = data[start:end + len(b"</hierarchy>")]
+        if configs["SAVE_XML"] and save_dir:
+            save_artifact(os.path.join(save_dir, prefix + ".xml"), xml)
+        return xml
+
     def get_xml(self, prefix, save_dir):
         """
         获取 Android 设备的 XML。
 
+        配置项 XML_MODE 为 "stream" 时使用 get_xml_stream，返回内存中的 XML bytes；
+        为 "pull" 时在设备上保存后再 adb pull，返回主机上 XML 文件的路径。两种返回值都可以直接交给 traverse_tree。
+
         :param prefix: XML 文件的前缀
         :param save_dir: XML 文件的保存目录
-        :return: XML 文件的路径
+        :return: XML 内容的 bytes 或 XML 文件的路径
         """
-        dump_command = f"adb -s {self.device} shell uiautomator dump " \
+        if configs["XML_MODE"] == "stream":
+            return self.get_xml_stream(prefix, save_dir)
+        dump_command = "uiautomator dump " \
                        f"{os.path.join(self.xml_dir, prefix + '.xml').replace(self.backslash, '/')}"
         pull_command = f"adb -s {self.device} pull " \
                        f"{os.path.join(self.xml_dir, prefix + '.xml').replace(self.backslash, '/')} " \
                        f"{os.path.join(save_dir, prefix + '.xml')}"
-        result = execute_adb(dump_command)
+        result = self.shell.execute(dump_command)
         if result != "ERROR":
             result = execute_adb(pull_command)
             if result != "ERROR":
@@ -203,14 +734,161 @@ class AndroidController:
             return result
         return result
 
+    def capture_state(self, prefix, save_dir, xml_prefix=None, xml_dir=None):
+        """
+        同时获取屏幕截图和 XML，并解析出本轮要标注的元素。
+
+        截图与 dump XML 总是在不同的线程中并行执行，因此一轮观察的耗时约等于两者中较慢的那一个。
+        缓存开启时还会并行获取当前获得焦点的窗口，截图完成后用两者计算缓存键：屏幕与之前的某次观察完全相同时
+        直接复用缓存中的 XML 和元素表，不再等待耗时 1~3 秒的 uiautomator dump（已经开始的 dump 在后台结束，
+        结果被丢弃）；未命中时使用并行 dump 得到的 XML 并写入缓存，耗时与关闭缓存时相同。
+
+        :param prefix: 截图文件的前缀
+        :param save_dir: 截图文件的保存目录
+        :param xml_prefix: XML 文件的前缀，默认与截图相同
+        :param xml_dir: XML 文件的保存目录，默认与截图相同
+        :return: ScreenState 实例，截图或 XML 获取失败时返回 None
+        """
+        xml_prefix = prefix if xml_prefix is None else xml_prefix
+        xml_dir = save_dir if xml_dir is None else xml_dir
+        timings = {}
+
+        def capture_xml():
+            # 在线程中 dump 并解析；耗时单独返回，被丢弃的 dump 结束时不会改写本轮的 timings
+            xml_timings = {}
+            begin = time.perf_counter()
+            xml = self.get_xml(xml_prefix, xml_dir)
+            xml_timings["xml"] = time.perf_counter() - begin
+            if xml == "ERROR":
+                return xml, None, xml_timings
+            begin = time.perf_counter()
+            elem_list = get_elem_list(xml)
+            xml_timings["parse"] = time.perf_counter() - begin
+            return xml, elem_list, xml_timings
+
+        begin = time.perf_counter()
+        # 上一轮命中缓存时被丢弃的 dump 可能还在执行，uiautomator 同一时间只能执行一次 dump，先等它结束
+        if self.pending_dump is not None:
+            self.pending_dump.result()
+            self.pending_dump = None
+        xml_future = self.executor.submit(capture_xml)
+        activity_future = self.executor.submit(self.get_foreground_activity) if self.xml_cache.enabled else None
+        image = self.get_screenshot_image(prefix, save_dir)
+        timings["screenshot"] = time.perf_counter() - begin
+        xml, elem_list = "ERROR", None
+        key = None
+        if activity_future is not None and image is not None:
+            key = screen_key(image, activity_future.result())
+            cached = self.xml_cache.get(key)
+            if cached is not None:
+                xml, elem_list = self.reuse_xml(cached, xml_prefix, xml_dir)
+                timings["cache"] = "hit"
+                if not xml_future.cancel():
+                    self.pending_dump = xml_future
+            else:
+                timings["cache"] = "miss"
+        if elem_list is None:
+            xml, elem_list, xml_timings = xml_future.result()
+            timings.update(xml_timings)
+            if key is not None and elem_list is not None:
+                self.xml_cache.put(key, self.read_xml_bytes(xml), elem_list)
+        timings["total"] = time.perf_counter() - begin
+        if image is None or elem_list is None:
+            return None
+        return ScreenState(image, xml, elem_list, timings, self.differ.update(elem_list))
+
+    def reuse_xml(self, cached, prefix, save_dir):
+        """
+        复用缓存中的 XML。与 get_xml 一样，XML_MODE 为 "pull" 时把 XML 写到 save_dir 中并返回文件路径，
+        否则返回 bytes，并在 SAVE_XML 为 true 时在后台另存一份。
+
+        :param cached: 缓存中的 (XML bytes, ElementTable)
+        :param prefix: XML 文件的前缀
+        :param save_dir: XML 文件的保存目录
+        :return: (XML 内容的 bytes 或 XML 文件的路径, ElementTable)
+        """
+        xml, elem_list = cached
+        path = os.path.join(save_dir, prefix + ".xml")
+        if configs["XML_MODE"] != "stream":
+            with open(path, "wb") as f:
+                f.write(xml)
+            return path, elem_list
+        if configs["SAVE_XML"] and save_dir:
+            save_artifact(path, xml)
+        return xml, elem_list
+
+    @staticmethod
+    def read_xml_bytes(xml):
+        """
+        :param xml: XML 内容的 bytes 或 XML 文件的路径
+        :return: XML 内容的 bytes
+        """
+        if isinstance(xml, bytes):
+            return xml
+        with open(xml, "rb") as f:
+            return f.read()
+
+    def get_foreground_activity(self):
+        """
+        获取当前获得焦点的窗口（Activity）。
+
+        :return: dumpsys window 中的 mCurrentFocus 行，获取失败时返回 None
+        """
+        result = self.shell.execute("dumpsys window | grep mCurrentFocus")
+        return None if result == "ERROR" else result
+
+    def get_screen_signature(self):
+        """
+        获取当前屏幕的一个廉价签名，用于判断界面是否已经稳定。
+
+        配置项 SETTLE_PROBE 为 "frame" 时在设备上对原始帧计算 md5（screencap | md5sum），只传回 32 个字符的摘要，
+        不通过 adb 传输帧本身（1080x2400 的原始帧约 10 MB）；
+        为 "window" 时使用 dumpsys window 中当前获得焦点的窗口（Activity），开销最小，但察觉不到同一窗口内的变化。
+
+        :return: 签名，获取失败时返回 None
+        """
+        if configs["SETTLE_PROBE"] == "window":
+            return self.get_foreground_activity()
+        result = self.shell.execute("screencap | md5sum")
+        if result == "ERROR" or not result:
+            return None
+        digest = result.split()[0]
+        # 管道的退出码取自 md5sum，screencap 失败时得到的是空输入的摘要
+        return None if digest == EMPTY_MD5 else digest
+
+    def wait_until_stable(self, timeout=None, interval=None):
+        """
+        等待界面稳定，用来代替动作之后固定时长的 sleep。
+
+        先等待 SETTLE_MIN_WAIT 秒让动作生效，然后每隔 interval 秒采样一次屏幕签名，
+        连续两次采样相同即认为界面已经稳定；超过 timeout 秒仍未稳定时直接返回。
+
+        :param timeout: 最长等待时间（秒），默认为配置项 SETTLE_TIMEOUT
+        :param interval: 两次采样之间的间隔（秒），默认为配置项 SETTLE_INTERVAL
+        :return: 实际等待的时间（秒）
+        """
+        timeout = configs["SETTLE_TIMEOUT"] if timeout is None else timeout
+        interval = configs["SETTLE_INTERVAL"] if interval is None else interval
+        begin = time.perf_counter()
+        time.sleep(configs["SETTLE_MIN_WAIT"])
+        last = self.get_screen_signature()
+        while time.perf_counter() - begin < timeout:
+            time.sleep(interval)
+            current = self.get_screen_signature()
+            if current is not None and current == last:
+                return time.perf_counter() - begin
+            last = current
+        print_with_color(f"WARNING: the screen did not settle within {timeout}s", "yellow")
+        return time.perf_counter() - begin
+
     def back(self):
         """
         发送返回操作到 Android 设备。
 
         :return: 操作的结果
         """
-        adb_command = f"adb -s {self.device} shell input keyevent KEYCODE_BACK"
-        ret = execute_adb(adb_command)
+        adb_command = "input keyevent KEYCODE_BACK"
+        ret = self.shell.execute(adb_command)
         return ret
 
     def tap(self, x, y):
@@ -221,8 +899,8 @@ class AndroidController:
         :param y: 点击位置的 y 坐标
         :return: 操作的结果
         """
-        adb_command = f"adb -s {self.device} shell input tap {x} {y}"
-        ret = execute_adb(adb_command)
+        adb_command = f"input tap {x} {y}"
+        ret = self.shell.execute(adb_command)
         return ret
 
     def text(self, input_str):
@@ -232,10 +910,10 @@ class AndroidController:
         :param input_str: 要输入的文本
         :return: 操作的结果
         """
+        # input text 把 %s 解释为空格；其余字符（引号、&、; 等）由 shlex.quote 原样传给设备
         input_str = input_str.replace(" ", "%s")
-        input_str = input_str.replace("'", "")
-        adb_command = f"adb -s {self.device} shell input text {input_str}"
-        ret = execute_adb(adb_command)
+        adb_command = f"input text {shlex.quote(input_str)}"
+        ret = self.shell.execute(adb_command)
         return ret
 
     def long_press(self, x, y, duration=1000):
@@ -247,8 +925,8 @@ class AndroidController:
         :param duration: 长按的持续时间，单位为毫秒
         :return: 操作的结果
         """
-        adb_command = f"adb -s {self.device} shell input swipe {x} {y} {x} {y} {duration}"
-        ret = execute_adb(adb_command)
+        adb_command = f"input swipe {x} {y} {x} {y} {duration}"
+        ret = self.shell.execute(adb_command)
         return ret
 
     def swipe(self, x, y, direction, dist="medium", quick=False):
@@ -278,8 +956,8 @@ class AndroidController:
         else:
             return "ERROR"
         duration = 100 if quick else 400
-        adb_command = f"adb -s {self.device} shell input swipe {x} {y} {x + offset[0]} {y + offset[1]} {duration}"
-        ret = execute_adb(adb_command)
+        adb_command = f"input swipe {x} {y} {x + offset[0]} {y + offset[1]} {duration}"
+        ret = self.shell.execute(adb_command)
         return ret
 
     def swipe_precise(self, start, end, duration=400):
@@ -293,6 +971,6 @@ class AndroidController:
         """
         start_x, start_y = start
         end_x, end_y = end
-        adb_command = f"adb -s {self.device} shell input swipe {start_x} {start_x} {end_x} {end_y} {duration}"
-        ret = execute_adb(adb_command)
+        adb_command = f"input swipe {start_x} {start_x} {end_x} {end_y} {duration}"
+        ret = self.shell.execute(adb_command)
         return ret
\ No newline at end of file
@@ -0,0 +1,343 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from and_controller import get_elem_list
+from config import load_config
+from reference_store import IMAGE_EXTS, ReferenceStore, read_image, to_gray
+from similarity_metrics import METRICS, create_metric
+from utils import print_with_color, draw_bbox_multi, iter_elem_boxes
+
+
+def find_demo_frames(root_dir):
+    """
+    查找 apps/*/demos 中同时具有 XML 和 _before.png 截图的轮次。
+
+    :param root_dir: 根目录
+    :return: [(XML 路径, 截图路径), ...]
+    """
+    frames = []
+    for xml_path in sorted(glob.glob(os.path.join(root_dir, "apps", "*", "demos", "*", "*.xml"))):
+        image_path = os.path.splitext(xml_path)[0] + "_before.png"
+        if os.path.exists(image_path):
+            frames.append((xml_path, image_path))
+    return frames
+
+
+def time_call(func, repeat):
+    """
+    :return: 多次调用 func 中最快一次的耗时（秒）以及该次的返回值
+    """
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - begin)
+    return best, result
+
+
+def draw_bbox_multi_pyshine(img, elem_list, record_mode=False, dark_mode=False):
+    # 改用 LabelRenderer 之前基于 pyshine.putBText 的实现，作为输出一致性和耗时的参照
+    import pyshine as ps
+    imgcv = img.copy()
+    count = 1
+    for left, top, right, bottom, attrib in iter_elem_boxes(elem_list):
+        try:
+            label = str(count)
+            if record_mode:
+                if attrib == "clickable":
+                    color = (250, 0, 0)
+                elif attrib == "focusable":
+                    color = (0, 0, 250)
+                else:
+                    color = (0, 250, 0)
+                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10,
+                                    text_offset_y=(top + bottom) // 2 + 10, vspace=10, hspace=10, font_scale=1,
+                                    thickness=2, background_RGB=color, text_RGB=(255, 250, 250), alpha=0.5)
+            else:
+                text_color = (10, 10, 10) if dark_mode else (255, 250, 250)
+                bg_color = (255, 250, 250) if dark_mode else (10, 10, 10)
+                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10,
+                                    text_offset_y=(top + bottom) // 2 + 10, vspace=10, hspace=10, font_scale=1,
+                                    thickness=2, background_RGB=bg_color, text_RGB=text_color, alpha=0.5)
+        except Exception:
+            pass
+        count += 1
+    return imgcv
+
+
+def random_elements(image, count, seed=0):
+    # 生成 count 个随机元素（包括贴近和超出屏幕边缘的元素），用于测试元素很多的界面
+    rng = np.random.default_rng(seed)
+    height, width = image.shape[:2]
+    x1 = rng.integers(-60, width, count)
+    y1 = rng.integers(-60, height, count)
+    x2 = x1 + rng.integers(10, 300, count)
+    y2 = y1 + rng.integers(10, 200, count)
+    attribs = rng.choice(["clickable", "focusable", "scrollable"], count)
+    return [(int(a), int(b), int(c), int(d), str(e)) for a, b, c, d, e in zip(x1, y1, x2, y2, attribs)]
+
+
+class BoxList(list):
+    # 让 (x1, y1, x2, y2, attrib) 元组列表可以直接交给 draw_bbox_multi
+    def rows(self):
+        return iter(self)
+
+
+def bench_labels(args):
+    frames = find_demo_frames(args["root_dir"])
+    if not frames:
+        print_with_color("ERROR: no demo frames found", "red")
+        return
+    cases = []
+    for xml_path, image_path in frames[:args["frames"]]:
+        cases.append((os.path.relpath(image_path, args["root_dir"]), cv2.imread(image_path), get_elem_list(xml_path)))
+    image = cases[0][1]
+    cases.append((f"synthetic {args['elements']} elements", image, BoxList(random_elements(image, args["elements"]))))
+
+    total_old, total_new, mismatches = 0.0, 0.0, 0
+    print_with_color(f"{'frame':<70}{'elements':>9}{'pyshine ms':>12}{'cached ms':>11}{'speedup':>9}", "yellow")
+    for name, image, elem_list in cases:
+        for record_mode, dark_mode in ((False, False), (False, True), (True, False)):
+            old_time, old = time_call(lambda: draw_bbox_multi_pyshine(image, elem_list, record_mode, dark_mode),
+                                      args["repeat"])
+            new_time, new = time_call(lambda: draw_bbox_multi(image, None, elem_list, record_mode, dark_mode),
+                                      args["repeat"])
+            if not np.array_equal(old, new):
+                mismatches += 1
+                print_with_color(f"ERROR: output differs for {name} (record_mode={record_mode}, "
+                                 f"dark_mode={dark_mode})", "red")
+            total_old += old_time
+            total_new += new_time
+        print(f"{name[-70:]:<70}{len(elem_list):>9}{old_time * 1000:>12.2f}{new_time * 1000:>11.2f}"
+              f"{old_time / new_time:>8.1f}x")
+    print_with_color(f"{len(cases)} frames x 3 color schemes: pyshine {total_old * 1000:.1f} ms, "
+                     f"cached {total_new * 1000:.1f} ms, speedup x{total_old / total_new:.1f}, "
+                     f"{mismatches} mismatching outputs", "green" if mismatches == 0 else "red")
+
+
+def bench_ssim(args):
+    # 用 assets/result_pic 中的每张目标截图与演示中的 _after 截图逐一比较，
+    # 对比 skimage 全分辨率 SSIM（原 pic_ssim）、ReferenceStore 全分辨率、按图块增量计算的全分辨率
+    # 和由粗到细四种方式的判断与耗时
+    from skimage.metrics import structural_similarity
+    configs = load_config()
+    ref_dir = os.path.join(args["root_dir"], configs["REFERENCE_DIR"])
+    threshold = configs["SSIM_THRESHOLD"]
+    full_store = ReferenceStore(ref_dir, threshold, configs["SSIM_WIDTH"])
+    coarse_store = ReferenceStore(ref_dir, threshold, configs["SSIM_WIDTH"], args["coarse_width"], args["margin"])
+    incremental_store = ReferenceStore(ref_dir, threshold, configs["SSIM_WIDTH"], tile_size=args["tile_size"])
+    keys = []
+    for path in sorted(glob.glob(os.path.join(ref_dir, "*"))):
+        name, ext = os.path.splitext(os.path.basename(path))
+        if "_" in name and ext.lower() in IMAGE_EXTS:
+            keys.append(tuple(name.split("_", 1)))
+    frame_paths = sorted(glob.glob(os.path.join(args["root_dir"], "apps", "*", "demos", "*", "*_after.png")))
+    frames = [cv2.imread(path) for path in frame_paths[::args["stride"]]]
+    if not keys or not frames:
+        print_with_color("ERROR: no reference images or demo frames found", "red")
+        return
+
+    times = {"skimage": 0.0, "full": 0.0, "incremental": 0.0, "coarse": 0.0}
+    pairs, mismatches, worst_gap, worst_error = 0, 0, 0.0, 0.0
+    for app, task in keys:
+        full_store.get(app, task)
+        coarse_store.get(app, task)
+        incremental_store.get(app, task)
+        reference_gray = to_gray(read_image(full_store.get(app, task)[0].path))
+        for frame in frames:
+            begin = time.perf_counter()
+            # 原 pic_ssim 的做法：读取后转灰度，尺寸不同时缩放到目标尺寸
+            frame_gray = to_gray(frame, (reference_gray.shape[1], reference_gray.shape[0]))
+            skimage_score = structural_similarity(reference_gray, frame_gray)
+            times["skimage"] += time.perf_counter() - begin
+            begin = time.perf_counter()
+            full_score, full_done, _ = full_store.match(app, task, frame)
+            times["full"] += time.perf_counter() - begin
+            begin = time.perf_counter()
+            incremental_score, _, _ = incremental_store.match(app, task, frame)
+            times["incremental"] += time.perf_counter() - begin
+            worst_error = max(worst_error, abs(incremental_score - full_score))
+            begin = time.perf_counter()
+            coarse_score, coarse_done, _ = coarse_store.match(app, task, frame)
+            times["coarse"] += time.perf_counter() - begin
+            pairs += 1
+            worst_gap = max(worst_gap, full_score - coarse_score)
+            if coarse_done != full_done or full_done != (skimage_score >= threshold):
+                mismatches += 1
+                print_with_color(f"ERROR: decision differs for {app}_{task}: skimage {skimage_score:.3f}, "
+                                 f"full {full_score:.3f}, coarse {coarse_score:.3f}", "red")
+    checks = coarse_store.coarse_decisions + coarse_store.full_decisions
+    early = coarse_store.coarse_decisions / max(1, checks)
+    print_with_color(f"{pairs} comparisons ({len(keys)} targets x {len(frames)} frames), threshold {threshold}", "yellow")
+    for name, total in times.items():
+        print(f"{name:<10}{total / pairs * 1000:>8.1f} ms/check{times['skimage'] / total:>8.1f}x vs skimage")
+    print_with_color(f"coarse width {args['coarse_width']}, margin {args['margin']}: {early:.0%} of checks exited early, "
+                     f"largest full - coarse gap {worst_gap:.3f}, {mismatches} mismatching decisions",
+                     "green" if mismatches == 0 else "red")
+    updates = [(s.full_updates, s.partial_updates, s.unchanged) for s in incremental_store.incremental.values()]
+    print_with_color(f"tile size {args['tile_size']}: {sum(u[0] for u in updates)} full, "
+                     f"{sum(u[1] for u in updates)} partial and {sum(u[2] for u in updates)} skipped recomputations, "
+                     f"largest incremental - full difference {worst_error:.2e}", "yellow")
+
+
+def bench_metrics(args):
+    # 在已有演示的每张截图上比较各个相似度指标：每次比较的耗时、与全分辨率 SSIM 判断的一致率，
+    # 以及与由日志推断的"已完成"标签（见 threshold_tuning.py）相比的正确率
+    from threshold_tuning import find_goals, load_trajectory
+    configs = load_config()
+    ref_dir = os.path.join(args["root_dir"], configs["REFERENCE_DIR"])
+    mask = configs["TERMINATION_MASK"] if args["mask"] is None else json.loads(args["mask"])
+    metrics = [create_metric(name, configs["SSIM_THRESHOLD"] if name == "ssim" else None, mask)
+               for name in args["metrics"]]
+    samples = []
+    for demo_dir in sorted(glob.glob(os.path.join(args["root_dir"], "apps", "*", "demos", "self_explore_*"))):
+        app = os.path.basename(os.path.dirname(os.path.dirname(demo_dir)))
+        task, _, frames = load_trajectory(demo_dir)
+        goals = find_goals(ref_dir, app, task) if task else []
+        for frame in frames[::args["stride"]]:
+            if goals:
+                samples.append((cv2.imread(frame.path), goals, frame.label))
+    if not samples:
+        print_with_color("ERROR: no labeled demo frames found", "red")
+        return
+
+    decisions = {}
+    print_with_color(f"{'metric':<18}{'threshold':>10}{'prepare ms':>12}{'score ms':>10}{'frames':>8}"
+                     f"{'TP':>5}{'FP':>5}{'FN':>5}", "yellow")
+    for metric in metrics:
+        prepared, prepare_time = {}, 0.0
+        for goal_path in {path for _, goals, _ in samples for path in goals}:
+            begin = time.perf_counter()
+            prepared[goal_path] = metric.prepare(read_image(goal_path))
+            prepare_time += time.perf_counter() - begin
+        score_time, results = 0.0, []
+        for image, goals, label in samples:
+            usable = [prepared[path] for path in goals if prepared[path] is not None]
+            if not usable:
+                results.append(None)
+                continue
+            begin = time.perf_counter()
+            score = max(metric.score(goal, image) for goal in usable)
+            score_time += time.perf_counter() - begin
+            results.append(score >= metric.threshold)
+        decisions[metric.name] = results
+        scored = [(done, label) for done, (_, _, label) in zip(results, samples) if done is not None]
+        if not scored:
+            print(f"{metric.name:<18}{'no usable goal screenshot':>50}")
+            continue
+        tp = sum(1 for done, label in scored if done and label)
+        fp = sum(1 for done, label in scored if done and not label)
+        fn = sum(1 for done, label in scored if not done and label)
+        print(f"{metric.name:<18}{metric.threshold:>10.2f}{prepare_time / len(prepared) * 1000:>12.1f}"
+              f"{score_time / len(scored) * 1000:>10.1f}{len(scored):>8}{tp:>5}{fp:>5}{fn:>5}")
+    if "ssim" in decisions:
+        print_with_color("Agreement with ssim decisions:", "yellow")
+        for name, results in decisions.items():
+            pairs = [(a, b) for a, b in zip(results, decisions["ssim"]) if a is not None and b is not None]
+            if name != "ssim" and pairs:
+                print(f"{name:<18}{sum(a == b for a, b in pairs) / len(pairs):>8.1%} of {len(pairs)} frames")
+
+
+def bench_http(args):
+    # 在本地起一个模拟模型接口的 HTTP 服务，比较每次新建连接的 requests.post 与 HttpClient 连接池的耗时，
+    # 并检查 429 + Retry-After 和持续 5xx 时的重试行为
+    import http.server
+    import threading
+    import requests
+    from http_client import HttpClient
+
+    counters = {"flaky": 0, "connections": 0}
+    body = json.dumps({"choices": [{"message": {"content": "ok"}}],
+                       "usage": {"prompt_tokens": 1, "completion_tokens": 1}}).encode()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # 响应头和响应体分两次写出，不关闭 Nagle 算法时长连接上的每个响应都会多等一个延迟确认（约 40 ms）
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            counters["connections"] += 1
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            status, headers = 200, {}
+            if self.path == "/flaky":
+                counters["flaky"] += 1
+                if counters["flaky"] <= 2:
+                    status, headers = 429, {"Retry-After": "0.2"}
+            elif self.path == "/down":
+                status = 503
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    payload = {"messages": [{"role": "user", "content": "x" * args["payload"]}]}
+    client = HttpClient(max_retries=3, backoff_base=0.05, backoff_max=1)
+
+    before = counters["connections"]
+    plain_time, _ = time_call(lambda: [requests.post(base + "/ok", json=payload).json()
+                                       for _ in range(args["requests"])], 1)
+    plain_connections = counters["connections"] - before
+    before = counters["connections"]
+    pooled_time, _ = time_call(lambda: [client.post_json(base + "/ok", payload) for _ in range(args["requests"])], 1)
+    pooled_connections = counters["connections"] - before
+    print_with_color(f"{args['requests']} requests: requests.post {plain_time / args['requests'] * 1000:.2f} ms/request "
+                     f"over {plain_connections} connections, HttpClient {pooled_time / args['requests'] * 1000:.2f} "
+                     f"ms/request over {pooled_connections} connections", "yellow")
+
+    begin = time.perf_counter()
+    flaky = client.post_json(base + "/flaky", payload)
+    flaky_time = time.perf_counter() - begin
+    down = client.post_json(base + "/down", payload)
+    ok = "error" not in flaky and flaky_time >= 0.4 and "error" in down
+    print_with_color(f"429 twice with Retry-After 0.2s: {'succeeded' if 'error' not in flaky else 'failed'} after "
+                     f"{flaky_time:.2f}s; always 503: {down.get('error', {}).get('message', 'no error')[:60]}",
+                     "green" if ok else "red")
+    print_with_color(f"Client stats: {client.stats()}", "yellow")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    arg_desc = "AppAgent - benchmarks on recorded demos"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("--root_dir", default="./")
+    parser.add_argument("--repeat", type=int, default=5)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    labels_parser = subparsers.add_parser("labels", help="draw_bbox_multi 的标注耗时")
+    labels_parser.add_argument("--frames", type=int, default=20)
+    labels_parser.add_argument("--elements", type=int, default=150)
+    labels_parser.set_defaults(func=bench_labels)
+    ssim_parser = subparsers.add_parser("ssim", help="任务终止判断中 SSIM 的耗时和判断一致性")
+    ssim_parser.add_argument("--stride", type=int, default=1, help="每隔 stride 张演示截图取一张")
+    ssim_parser.add_argument("--coarse_width", type=int, default=270)
+    ssim_parser.add_argument("--margin", type=float, default=0.3)
+    ssim_parser.add_argument("--tile_size", type=int, default=64)
+    ssim_parser.set_defaults(func=bench_ssim)
+    metrics_parser = subparsers.add_parser("metrics", help="各个终止判断相似度指标的耗时和判断一致性")
+    metrics_parser.add_argument("--metrics", nargs="+", default=list(METRICS), choices=list(METRICS))
+    metrics_parser.add_argument("--mask", help="忽略区域的 JSON 列表，默认使用 TERMINATION_MASK")
+    metrics_parser.add_argument("--stride", type=int, default=1, help="每隔 stride 张演示截图取一张")
+    metrics_parser.set_defaults(func=bench_metrics)
+    http_parser = subparsers.add_parser("http", help="模型请求的连接复用和重试（使用本地模拟服务）")
+    http_parser.add_argument("--requests", type=int, default=200)
+    http_parser.add_argument("--payload", type=int, default=200000, help="请求体的大小（字节），接近一张编码后的截图")
+    http_parser.set_defaults(func=bench_http)
+    args = vars(parser.parse_args())
+    args["func"](args)
@@ -0,0 +1,100 @@
+import hashlib
+
+import cv2
+import numpy as np
+
+
+def tile_hashes(gray, tile_size):
+    """
+    把灰度图划分为 tile_size x tile_size 的图块（最后一行、一列可能不足一个图块），计算每个图块内容的哈希。
+
+    :param gray: 灰度图像数组
+    :param tile_size: 图块的边长（像素）
+    :return: 形状为 (图块行数, 图块列数) 的 uint64 哈希数组
+    """
+    height, width = gray.shape[:2]
+    rows, cols = -(-height // tile_size), -(-width // tile_size)
+    hashes = np.empty((rows, cols), dtype=np.uint64)
+    for row in range(rows):
+        band = gray[row * tile_size:(row + 1) * tile_size]
+        for col in range(cols):
+            tile = np.ascontiguousarray(band[:, col * tile_size:(col + 1) * tile_size])
+            hashes[row, col] = int.from_bytes(hashlib.blake2b(tile, digest_size=8).digest(), "little")
+    return hashes
+
+
+def gray_of(image):
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def tile_rects(dirty, tile_size, shape):
+    """
+    把每一行中连续的脏图块合并为矩形。
+
+    :param dirty: bool 数组，标记内容变化的图块
+    :param tile_size: 图块的边长
+    :param shape: 图像的 (height, width)
+    :return: [(y1, y2, x1, x2), ...]，已裁剪到图像范围内
+    """
+    height, width = shape[:2]
+    rects = []
+    for row, col_flags in enumerate(dirty):
+        cols = np.flatnonzero(col_flags)
+        if not len(cols):
+            continue
+        # 按不连续的位置把列号切分成若干段
+        for run in np.split(cols, np.flatnonzero(np.diff(cols) > 1) + 1):
+            rects.append((row * tile_size, min(height, (row + 1) * tile_size),
+                          run[0] * tile_size, min(width, (run[-1] + 1) * tile_size)))
+    return rects
+
+
+class ChangeMap:
+    """
+    两帧截图之间的图块级变化图。
+    """
+
+    def __init__(self, dirty, tile_size, shape):
+        """
+        初始化 ChangeMap 实例。
+
+        :param dirty: bool 数组，标记内容变化的图块
+        :param tile_size: 图块的边长
+        :param shape: 图像的 (height, width)
+        """
+        self.dirty = dirty
+        self.tile_size = tile_size
+        self.shape = shape
+
+    @classmethod
+    def between(cls, previous, current, tile_size=64):
+        """
+        :param previous: 上一帧截图（BGR 或灰度数组）
+        :param current: 当前截图，尺寸与 previous 不同时整帧视为变化
+        :param tile_size: 图块的边长
+        :return: ChangeMap
+        """
+        current_hashes = tile_hashes(gray_of(current), tile_size)
+        if previous is None or previous.shape[:2] != current.shape[:2]:
+            return cls(np.ones(current_hashes.shape, dtype=bool), tile_size, current.shape[:2])
+        return cls(tile_hashes(gray_of(previous), tile_size) != current_hashes, tile_size, current.shape[:2])
+
+    @property
+    def unchanged(self):
+        return not self.dirty.any()
+
+    @property
+    def fraction(self):
+        # 内容变化的图块所占的比例
+        return float(self.dirty.mean())
+
+    def rects(self):
+        return tile_rects(self.dirty, self.tile_size, self.shape)
+
+    def summary(self):
+        if self.unchanged:
+            return "screen unchanged"
+        return f"{int(self.dirty.sum())}/{self.dirty.size} tiles changed ({self.fraction:.0%})"
+
+    def to_dict(self):
+        return {"tile_size": self.tile_size, "changed_tiles": int(self.dirty.sum()), "tiles": int(self.dirty.size)}
@@ -4,12 +4,11 @@ import json
 import os
 import re
 import sys
-import time
 
 import prompts
 from config import load_config
 from model import ask_gpt4v
-from utils import print_with_color, encode_image
+from utils import print_with_color, encode_model_image, format_image_stats, image_options
 
 arg_desc = "AppAgent - Human Demonstration"
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
@@ -48,8 +47,10 @@ with open(record_path, "r") as infile:
     step = len(infile.readlines()) - 1
     infile.seek(0)
     for i in range(1, step + 1):
-        img_before = encode_image(os.path.join(labeled_ss_dir, f"{demo_name}_{i}.png"))
-        img_after = encode_image(os.path.join(labeled_ss_dir, f"{demo_name}_{i + 1}.png"))
+        img_before, stats_before = encode_model_image(os.path.join(labeled_ss_dir, f"{demo_name}_{i}.png"),
+                                                      **image_options(configs))
+        img_after, stats_after = encode_model_image(os.path.join(labeled_ss_dir, f"{demo_name}_{i + 1}.png"),
+                                                    **image_options(configs))
         rec = infile.readline().strip()
         action, resource_id = rec.split(":::")
         action_type = action.split("(")[0]
@@ -111,24 +112,26 @@ with open(record_path, "r") as infile:
             {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{img_before}"
+                    "url": img_before
                 }
             },
             {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{img_after}"
+                    "url": img_after
                 }
             }
         ]
 
+        print_with_color(f"Image payload: {format_image_stats([stats_before, stats_after])}", "yellow")
         rsp = ask_gpt4v(content)
         if "error" not in rsp:
             msg = rsp["choices"][0]["message"]["content"]
             doc_content[action_type] = msg
             with open(log_path, "a") as logfile:
                 log_item = {"step": i, "prompt": prompt, "image_before": f"{demo_name}_{i}.png",
-                            "image_after": f"{demo_name}_{i + 1}.png", "response": rsp}
+                            "image_after": f"{demo_name}_{i + 1}.png", "response": rsp,
+                            "image_stats": [stats_before, stats_after]}
                 logfile.write(json.dumps(log_item) + "\n")
             with open(doc_path, "w") as outfile:
                 outfile.write(str(doc_content))
@@ -136,6 +139,5 @@ with open(record_path, "r") as infile:
             print_with_color(f"Documentation generated and saved to {doc_path}", "yellow")
         else:
             print_with_color(rsp["error"]["message"], "red")
-        time.sleep(configs["REQUEST_INTERVAL"])
 
 print_with_color(f"Documentation generation phase completed. {doc_count} docs generated.", "yellow")
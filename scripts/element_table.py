@@ -0,0 +1,181 @@
+import sys
+
+import numpy as np
+
+# 元素属性的位标志
+CLICKABLE = 1
+FOCUSABLE = 2
+SCROLLABLE = 4
+LONG_CLICKABLE = 8
+ATTRIB_FLAGS = {"clickable": CLICKABLE, "focusable": FOCUSABLE, "scrollable": SCROLLABLE,
+                "long-clickable": LONG_CLICKABLE}
+# ElementTable 中的 NumPy 列
+COLUMNS = ("x1", "y1", "x2", "y2", "cx", "cy", "flags", "hashes", "labels")
+
+
+class ElementRow:
+    """
+    ElementTable 中一行的只读视图，提供与 AndroidElement 相同的 uid、bbox 和 attrib 属性。
+    """
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def uid(self):
+        return self.table.uids[self.index]
+
+    @property
+    def bbox(self):
+        t, i = self.table, self.index
+        return (int(t.x1[i]), int(t.y1[i])), (int(t.x2[i]), int(t.y2[i]))
+
+    @property
+    def attrib(self):
+        return self.table.attribs[self.index]
+
+    @property
+    def flags(self):
+        return int(self.table.flags[self.index])
+
+    @property
+    def hash(self):
+        return int(self.table.hashes[self.index])
+
+    @property
+    def center(self):
+        return self.table.center(self.index)
+
+
+class ElementTable:
+    """
+    按列存储的 UI 元素表。
+
+    每一列是一个 NumPy 数组：x1/y1/x2/y2 为边界框，cx/cy 为预先算好的中心点，flags 为属性位标志
+    （见 ATTRIB_FLAGS），hashes 为元素所在子树内容（不含位置）的 64 位哈希，用于与上一轮对比；
+    labels 为截图上标注的数字编号，默认为 1..n，HierarchyDiffer 会让与上一轮相同的元素沿用上一轮的编号。
+    uids 是经过 sys.intern 的 ID 列表，attribs 记录每个元素是作为哪一类（"clickable" 或 "focusable"）
+    被收集的，用于标注颜色。
+    标注、去重、文档查找和执行动作都可以直接使用这些列，不需要为每个元素创建对象；
+    按下标访问时返回 ElementRow 视图，兼容原来使用 AndroidElement 列表的代码。
+    """
+
+    def __init__(self, uids=(), boxes=None, flags=None, attribs=(), hashes=None):
+        """
+        初始化 ElementTable 实例。
+
+        :param uids: 元素 ID 列表
+        :param boxes: 形如 [(x1, y1, x2, y2), ...] 的边界框
+        :param flags: 每个元素的属性位标志
+        :param attribs: 每个元素被收集时所属的类别
+        :param hashes: 每个元素的子树内容哈希
+        """
+        self.uids = [sys.intern(uid) for uid in uids]
+        boxes = np.asarray(boxes if boxes is not None else [], dtype=np.int32).reshape(-1, 4)
+        self.x1, self.y1, self.x2, self.y2 = (np.ascontiguousarray(boxes[:, k]) for k in range(4))
+        self.cx = (self.x1 + self.x2) // 2
+        self.cy = (self.y1 + self.y2) // 2
+        self.flags = np.asarray(flags if flags is not None else np.zeros(len(self.uids)), dtype=np.uint8)
+        self.attribs = list(attribs)
+        self.hashes = np.asarray(hashes if hashes is not None else np.zeros(len(self.uids)), dtype=np.uint64)
+        self.labels = np.arange(1, len(self.uids) + 1, dtype=np.int32)
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        按顺序拼接多个 ElementTable。
+
+        :param tables: ElementTable 列表
+        :return: ElementTable 实例
+        """
+        table = cls.__new__(cls)
+        table.uids = [uid for t in tables for uid in t.uids]
+        for name in COLUMNS:
+            setattr(table, name, np.concatenate([getattr(t, name) for t in tables]))
+        table.attribs = [attrib for t in tables for attrib in t.attribs]
+        # 拼接得到的是一张新表，按位置重新编号
+        table.labels = np.arange(1, len(table.uids) + 1, dtype=np.int32)
+        return table
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("element index out of range")
+        return ElementRow(self, index)
+
+    def __iter__(self):
+        return (ElementRow(self, i) for i in range(len(self)))
+
+    def center(self, index):
+        """
+        获取第 index 个元素的中心点。
+
+        :param index: 元素下标，支持负数
+        :return: (x, y)
+        """
+        return int(self.cx[index]), int(self.cy[index])
+
+    def label_index(self, label):
+        """
+        获取截图上编号为 label 的元素的下标。
+
+        :param label: 标注的数字编号
+        :return: 元素下标，没有该编号的元素时抛出 IndexError
+        """
+        matches = np.flatnonzero(self.labels == int(label))
+        if not len(matches):
+            raise IndexError(f"no element is labeled {label}")
+        return int(matches[0])
+
+    def centers(self):
+        """
+        :return: 形状为 (n, 2) 的中心点数组
+        """
+        return np.stack([self.cx, self.cy], axis=1)
+
+    def boxes(self):
+        """
+        :return: 形状为 (n, 4) 的边界框数组，列依次为 x1、y1、x2、y2
+        """
+        return np.stack([self.x1, self.y1, self.x2, self.y2], axis=1)
+
+    def rows(self):
+        """
+        逐行迭代 (x1, y1, x2, y2, attrib)，不创建 ElementRow 对象。
+        """
+        return zip(self.x1.tolist(), self.y1.tolist(), self.x2.tolist(), self.y2.tolist(), self.attribs)
+
+    def select(self, indices):
+        """
+        按下标或 bool 掩码选出部分元素，组成新的 ElementTable。
+
+        :param indices: 下标数组或与表等长的 bool 掩码
+        :return: ElementTable 实例
+        """
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = indices.astype(np.intp)
+        table = ElementTable.__new__(ElementTable)
+        table.uids = [self.uids[i] for i in indices.tolist()]
+        for name in COLUMNS:
+            setattr(table, name, getattr(self, name)[indices])
+        table.attribs = [self.attribs[i] for i in indices.tolist()]
+        return table
+
+    def exclude_uids(self, uids):
+        """
+        去掉 ID 在 uids 中的元素。
+
+        :param uids: 要去掉的元素 ID 集合
+        :return: ElementTable 实例
+        """
+        if not uids:
+            return self
+        return self.select(np.array([uid not in uids for uid in self.uids], dtype=bool))
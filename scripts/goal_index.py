@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import re
+
+import cv2
+import numpy as np
+
+from reference_store import IMAGE_EXTS, read_image, to_gray
+from utils import print_with_color
+
+
+def phash(gray):
+    """
+    64 位感知哈希：缩放到 32x32 后做 DCT，取左上角 8x8 的低频系数与其中位数（不含直流分量）比较。
+
+    :param gray: 灰度图像数组
+    :return: 哈希值（int）
+    """
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    coefficients = cv2.dct(small)[:8, :8].ravel()
+    bits = coefficients > np.median(coefficients[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def dhash(gray):
+    """
+    64 位差值哈希：缩放到 9x8 后比较每行相邻像素的大小。
+
+    :param gray: 灰度图像数组
+    :return: 哈希值（int）
+    """
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def popcount(values):
+    # 逐元素统计 uint64 数组中 1 的个数
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values).astype(np.int64)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def parse_goal_name(path, ref_dir):
+    """
+    从目标图像的路径解析出 (app, task)：{app}_{task}.jpg、{app}_{task}_N.jpg 或 {app}_{task}/xxx.jpg。
+
+    :return: (app, task)，无法解析时返回 None
+    """
+    rel = os.path.relpath(path, ref_dir)
+    parts = rel.split(os.sep)
+    name = parts[0] if len(parts) > 1 else re.sub(r"_\d+$", "", os.path.splitext(parts[0])[0])
+    if "_" not in name:
+        return None
+    app, task = name.split("_", 1)
+    return app, task
+
+
+class GoalIndex:
+    """
+    所有目标截图的感知哈希索引，按 (app, task) 记录每张目标图像的 pHash 和 dHash。
+
+    索引保存在 JSON 文件中。update 只为新增或修改过（大小、修改时间变化）的图像计算哈希，并去掉已经删除的图像；
+    查询时用 NumPy 一次计算当前截图与所有目标之间的汉明距离（pHash 与 dHash 距离之和，0~128）。
+    可以用来查找当前界面最接近哪个已知的目标状态，也可以在精确的 SSIM 比较之前排除明显不同的目标。
+    """
+
+    def __init__(self, ref_dir, index_path):
+        """
+        初始化 GoalIndex 实例并加载已有的索引文件。
+
+        :param ref_dir: 目标图像所在的目录
+        :param index_path: 索引文件的路径
+        """
+        self.ref_dir = ref_dir
+        self.index_path = index_path
+        self.entries = {}
+        if os.path.exists(index_path):
+            # 索引文件损坏或无法读取时当作空索引，由 update 重新建立
+            try:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    for entry in json.load(f)["entries"]:
+                        self.entries[entry["path"]] = entry
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print_with_color(f"ERROR: failed to read the goal index {index_path}, rebuilding it: {e}", "red")
+                self.entries = {}
+        self.build_arrays()
+
+    def build_arrays(self):
+        self.paths = sorted(self.entries)
+        self.phashes = np.array([int(self.entries[p]["phash"], 16) for p in self.paths], dtype=np.uint64)
+        self.dhashes = np.array([int(self.entries[p]["dhash"], 16) for p in self.paths], dtype=np.uint64)
+
+    def scan(self):
+        """
+        :return: ref_dir 中所有目标图像相对于 ref_dir 的路径
+        """
+        paths = []
+        for root, _, files in os.walk(self.ref_dir):
+            for name in files:
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTS:
+                    paths.append(os.path.relpath(os.path.join(root, name), self.ref_dir))
+        return paths
+
+    def update(self):
+        """
+        增量更新索引：为新增或修改过的图像计算哈希，去掉已删除的图像，有变化时写回索引文件。
+
+        :return: (新增或更新的数量, 删除的数量)
+        """
+        added, found = 0, set()
+        for rel in self.scan():
+            found.add(rel)
+            path = os.path.join(self.ref_dir, rel)
+            stat = os.stat(path)
+            entry = self.entries.get(rel)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+            key = parse_goal_name(path, self.ref_dir)
+            image = read_image(path)
+            if key is None or image is None:
+                print_with_color(f"ERROR: failed to index the reference image {path}", "red")
+                continue
+            gray = to_gray(image)
+            self.entries[rel] = {"path": rel, "app": key[0], "task": key[1], "size": stat.st_size,
+                                 "mtime": stat.st_mtime, "phash": f"{phash(gray):016x}", "dhash": f"{dhash(gray):016x}"}
+            added += 1
+        removed = [rel for rel in self.entries if rel not in found]
+        for rel in removed:
+            del self.entries[rel]
+        if added or removed:
+            self.save()
+        self.build_arrays()
+        return added, len(removed)
+
+    def save(self):
+        # 先写入临时文件再整体替换，多个进程同时更新索引时，读取方不会看到写了一半的文件
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": [self.entries[p] for p in sorted(self.entries)]}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    def distances(self, image):
+        """
+        :param image: 当前截图（BGR 或灰度数组）
+        :return: 与 self.paths 中每张目标图像的汉明距离数组
+        """
+        gray = to_gray(image)
+        return (popcount(self.phashes ^ np.uint64(phash(gray))) +
+                popcount(self.dhashes ^ np.uint64(dhash(gray))))
+
+    def distance_map(self, image):
+        """
+        :param image: 当前截图
+        :return: {目标图像的完整路径: 汉明距离}
+        """
+        return {os.path.join(self.ref_dir, p): int(d) for p, d in zip(self.paths, self.distances(image))}
+
+    def query(self, image, k=5, app=None):
+        """
+        查找与当前截图最接近的已知目标状态。
+
+        :param image: 当前截图
+        :param k: 返回的数量
+        :param app: 只在该应用的目标中查找
+        :return: [(汉明距离, app, task, 目标图像的路径), ...]，按距离从小到大排列
+        """
+        if not self.paths:
+            return []
+        distances = self.distances(image)
+        order = np.argsort(distances, kind="stable")
+        results = []
+        for i in order.tolist():
+            entry = self.entries[self.paths[i]]
+            if app is not None and entry["app"].lower() != app.lower():
+                continue
+            results.append((int(distances[i]), entry["app"], entry["task"],
+                            os.path.join(self.ref_dir, self.paths[i])))
+            if len(results) == k:
+                break
+        return results
+
+
+if __name__ == '__main__':
+    from config import load_config
+    configs = load_config()
+    arg_desc = "AppAgent - goal screenshot index"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("--root_dir", default="./")
+    parser.add_argument("--query", help="查找与该截图最接近的目标状态")
+    parser.add_argument("--app")
+    parser.add_argument("-k", type=int, default=5)
+    args = vars(parser.parse_args())
+
+    index = GoalIndex(os.path.join(args["root_dir"], configs["REFERENCE_DIR"]),
+                      os.path.join(args["root_dir"], configs["GOAL_INDEX_PATH"]))
+    added, removed = index.update()
+    print_with_color(f"{len(index.paths)} goal screenshots indexed ({added} added or updated, {removed} removed)",
+                     "yellow")
+    if args["query"]:
+        for distance, app, task, path in index.query(read_image(args["query"]), args["k"], args["app"]):
+            print(f"{distance:>4}  {app}  {task}  {path}")
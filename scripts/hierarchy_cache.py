@@ -0,0 +1,84 @@
+import collections
+import hashlib
+import threading
+
+import numpy as np
+
+
+def screen_key(image, activity, step=4):
+    """
+    计算屏幕的缓存键：按 step 像素步长降采样后的截图的 blake2b 哈希，加上当前获得焦点的窗口。
+
+    :param image: 截图数组
+    :param activity: 当前获得焦点的窗口（Activity），获取失败时为 None
+    :param step: 降采样步长
+    :return: 缓存键
+    """
+    digest = hashlib.blake2b(np.ascontiguousarray(image[::step, ::step]), digest_size=16).hexdigest()
+    return digest, activity
+
+
+class HierarchyCache:
+    """
+    按屏幕内容缓存 uiautomator dump 的结果。
+
+    键由 screen_key 计算，值为 (XML 内容的 bytes, 解析得到的 ElementTable)。
+    屏幕与之前某次观察完全相同（例如一次无效的点击之后）时直接复用之前的解析结果，不再执行 dump。
+    超过 max_size 个条目时淘汰最久未使用的条目；max_size 为 0 时缓存关闭。
+    """
+
+    def __init__(self, max_size):
+        """
+        初始化 HierarchyCache 实例。
+
+        :param max_size: 最多缓存的条目数
+        """
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        """
+        :param key: 缓存键
+        :return: (xml, elem_list)，未命中时返回 None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, xml, elem_list):
+        """
+        :param key: 缓存键
+        :param xml: XML 内容的 bytes
+        :param elem_list: 解析得到的 ElementTable
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries[key] = (xml, elem_list)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: 命中次数、未命中次数、命中率和当前条目数
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self.entries)}
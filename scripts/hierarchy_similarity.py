@@ -0,0 +1,244 @@
+import argparse
+import collections
+import os
+import xml.etree.ElementTree as ET
+
+from and_controller import open_xml_source
+from reference_store import ReferenceStore
+from utils import print_with_color
+
+
+class HierarchyTree:
+    """
+    为结构比较而精简的 uiautomator UI 层次结构。
+
+    每个节点的标签为 (class, resource-id, text)。dump 中的所有顶层节点（例如应用窗口和弹出的对话框、输入法窗口）
+    挂在一个虚拟的根节点下，树编辑距离覆盖整个森林。只起布局作用的节点（没有 resource-id、text、content-desc，
+    不可点击，且只有一个子节点）被折叠到其子节点上，中心点落在忽略区域内的节点（连同子树）被去掉。
+    同时记录 resource-id、text、class 三个多重集合，以及 Zhang-Shasha 树编辑距离需要的后序遍历信息。
+    """
+
+    def __init__(self, xml, mask=None):
+        """
+        初始化 HierarchyTree 实例。
+
+        :param xml: XML 文件的路径或 XML bytes
+        :param mask: 要忽略的区域列表，每个区域为相对屏幕的 [x1, y1, x2, y2]（0~1）
+        """
+        root = ET.parse(open_xml_source(xml)).getroot()
+        nodes = list(root.iter("node"))
+        width = max((self.bounds(node)[2] for node in nodes), default=0) or 1
+        height = max((self.bounds(node)[3] for node in nodes), default=0) or 1
+        self.mask = [(x1 * width, y1 * height, x2 * width, y2 * height) for x1, y1, x2, y2 in (mask or [])]
+        self.labels = []
+        self.leftmost = []
+        self.ids = collections.Counter()
+        self.texts = collections.Counter()
+        self.classes = collections.Counter()
+        for child in root:
+            self.add(child)
+        # 虚拟根节点：后序遍历中排在最后，最左叶子为第一个节点；不计入多重集合
+        self.labels.append(("hierarchy", "", ""))
+        self.leftmost.append(0)
+        self.keyroots = self.find_keyroots()
+
+    @staticmethod
+    def bounds(node):
+        bounds = node.attrib.get("bounds", "[0,0][0,0]")[1:-1].split("][")
+        x1, y1 = map(int, bounds[0].split(","))
+        x2, y2 = map(int, bounds[1].split(","))
+        return x1, y1, x2, y2
+
+    def masked(self, node):
+        x1, y1, x2, y2 = self.bounds(node)
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        return any(mx1 <= cx < mx2 and my1 <= cy < my2 for mx1, my1, mx2, my2 in self.mask)
+
+    def add(self, node):
+        """
+        按后序遍历把 node 的子树加入树中。
+
+        :return: 子树根节点的后序编号，整个子树被去掉时返回 None
+        """
+        if node.tag != "node" or self.masked(node):
+            return None
+        attrib = node.attrib
+        children = [child for child in node if child.tag == "node"]
+        if (len(children) == 1 and not attrib.get("resource-id") and not attrib.get("text")
+                and not attrib.get("content-desc") and attrib.get("clickable") != "true"):
+            return self.add(children[0])
+        first = None
+        for child in children:
+            index = self.add(child)
+            if index is not None and first is None:
+                first = self.leftmost[index]
+        label = (attrib.get("class", ""), attrib.get("resource-id", ""), attrib.get("text", ""))
+        self.labels.append(label)
+        self.leftmost.append(len(self.labels) - 1 if first is None else first)
+        self.classes[label[0]] += 1
+        if label[1]:
+            self.ids[label[1]] += 1
+        if label[2]:
+            self.texts[label[2]] += 1
+        return len(self.labels) - 1
+
+    def find_keyroots(self):
+        # 关键根：每个最左叶子对应的编号最大的节点
+        keyroots = {}
+        for index, leftmost in enumerate(self.leftmost):
+            keyroots[leftmost] = index
+        return sorted(keyroots.values())
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def multiset_similarity(a, b):
+    """
+    :return: 两个多重集合（Counter）的加权 Jaccard 系数，两者都为空时为 1
+    """
+    union = sum((a | b).values())
+    return sum((a & b).values()) / union if union else 1.0
+
+
+def tree_edit_distance(a, b):
+    """
+    Zhang-Shasha 树编辑距离：插入、删除节点的代价为 1，标签不同的节点替换的代价为 1。
+
+    :param a: HierarchyTree
+    :param b: HierarchyTree
+    :return: 编辑距离
+    """
+    labels_a, labels_b = a.labels, b.labels
+    left_a, left_b = a.leftmost, b.leftmost
+    tree_dist = [[0] * len(b) for _ in range(len(a))]
+    for i in a.keyroots:
+        for j in b.keyroots:
+            li, lj = left_a[i], left_b[j]
+            rows, cols = i - li + 2, j - lj + 2
+            forest = [[0] * cols for _ in range(rows)]
+            for x in range(1, rows):
+                forest[x][0] = x
+            forest[0] = list(range(cols))
+            for x in range(1, rows):
+                node_a = li + x - 1
+                same_left_a = left_a[node_a] == li
+                row, prev_row = forest[x], forest[x - 1]
+                for y in range(1, cols):
+                    node_b = lj + y - 1
+                    if same_left_a and left_b[node_b] == lj:
+                        relabel = prev_row[y - 1] + (labels_a[node_a] != labels_b[node_b])
+                        row[y] = min(prev_row[y] + 1, row[y - 1] + 1, relabel)
+                        tree_dist[node_a][node_b] = row[y]
+                    else:
+                        subtree = forest[left_a[node_a] - li][left_b[node_b] - lj] + tree_dist[node_a][node_b]
+                        row[y] = min(prev_row[y] + 1, row[y - 1] + 1, subtree)
+    return tree_dist[-1][-1]
+
+
+def hierarchy_similarity(goal, current, threshold=0.0):
+    """
+    两棵 UI 层次结构的相似度：resource-id、text、class 三个多重集合的加权 Jaccard 系数与树编辑距离相似度
+    （1 - 编辑距离 / 较大的节点数）的平均值。
+
+    树编辑距离的计算量远大于多重集合。即使树的相似度为 1 平均值也达不到 threshold 时，不再计算树编辑距离，
+    返回的是这个上限，因此判断结果与完整计算时一致。
+
+    :param goal: 目标的 HierarchyTree
+    :param current: 当前屏幕的 HierarchyTree
+    :param threshold: 判定任务完成的阈值
+    :return: (相似度, 是否计算了树编辑距离)
+    """
+    parts = [multiset_similarity(goal.ids, current.ids), multiset_similarity(goal.texts, current.texts),
+             multiset_similarity(goal.classes, current.classes)]
+    upper_bound = (sum(parts) + 1) / 4
+    if upper_bound < threshold:
+        return upper_bound, False
+    tree = 1 - tree_edit_distance(goal, current) / max(len(goal), len(current))
+    return (sum(parts) + tree) / 4, True
+
+
+class HierarchyStore(ReferenceStore):
+    """
+    按 (app, task) 缓存任务完成时的目标 UI 层次结构，用于不依赖像素的任务终止判断。
+
+    目标文件与目标截图放在一起，命名规则相同，只是扩展名为 .xml：{app}_{task}.xml、{app}_{task}_1.xml
+    或者目录 {app}_{task}/ 下的 .xml 文件。与截图相比，UI 层次结构不受主题、动画和壁纸的影响。
+    """
+
+    exts = (".xml",)
+
+    def __init__(self, ref_dir, threshold=0.8, mask=None):
+        """
+        初始化 HierarchyStore 实例。
+
+        :param ref_dir: 目标文件所在的目录
+        :param threshold: 判定任务完成的相似度阈值
+        :param mask: 要忽略的区域列表，每个区域为相对屏幕的 [x1, y1, x2, y2]（0~1）
+        """
+        super().__init__(ref_dir, threshold)
+        self.mask = mask or []
+        self.tree_comparisons = 0
+        self.multiset_rejections = 0
+
+    def get(self, app, task):
+        """
+        :return: (app, task) 的 [(目标文件的路径, HierarchyTree), ...]
+        """
+        key = (app, task)
+        if key not in self.references:
+            references = []
+            for path in self.find_paths(app, task):
+                try:
+                    references.append((path, HierarchyTree(path, self.mask)))
+                except (ET.ParseError, OSError) as e:
+                    print_with_color(f"ERROR: failed to read the reference hierarchy {path}: {e}", "red")
+            self.references[key] = references
+        return self.references[key]
+
+    def match(self, app, task, xml):
+        """
+        把当前屏幕的 UI 层次结构与任务的所有目标比较。
+
+        :param xml: 当前屏幕的 XML 文件路径或 XML bytes
+        :return: (最高的相似度, 是否达到阈值, 对应的目标文件路径)，没有目标或 XML 无法解析时返回 None
+        """
+        references = self.get(app, task)
+        if not references:
+            return None
+        try:
+            current = HierarchyTree(xml, self.mask)
+        except ET.ParseError as e:
+            print_with_color(f"ERROR: failed to parse the current hierarchy: {e}", "red")
+            return None
+        best_score, best_path = 0.0, None
+        for path, goal in references:
+            score, full = hierarchy_similarity(goal, current, self.threshold)
+            if full:
+                self.tree_comparisons += 1
+            else:
+                self.multiset_rejections += 1
+            if best_path is None or score > best_score:
+                best_score, best_path = score, path
+        return best_score, best_score >= self.threshold, best_path
+
+
+if __name__ == '__main__':
+    from config import load_config
+    configs = load_config()
+    arg_desc = "AppAgent - compare a UI hierarchy with the goal hierarchies"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("xml", nargs="+", help="要比较的 XML 文件")
+    parser.add_argument("--app", required=True)
+    parser.add_argument("--task", required=True)
+    parser.add_argument("--root_dir", default="./")
+    args = vars(parser.parse_args())
+
+    store = HierarchyStore(os.path.join(args["root_dir"], configs["REFERENCE_DIR"]), configs["HIERARCHY_THRESHOLD"],
+                           configs["TERMINATION_MASK"])
+    if not store.get(args["app"], args["task"]):
+        print_with_color(f"ERROR: no goal hierarchy found for {args['app']}_{args['task']}", "red")
+    else:
+        for xml_path in args["xml"]:
+            score, done, path = store.match(args["app"], args["task"], xml_path)
+            print(f"{score:.3f}  {'done' if done else '    '}  {xml_path}")
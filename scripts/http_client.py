@@ -0,0 +1,150 @@
+import email.utils
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import print_with_color
+
+# 遇到这些状态码时重试：请求过于频繁，以及服务端的临时错误
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# 遇到这些异常时重试：连接错误、超时以及响应传输中断；其他 requests 异常（如 URL 无效）直接返回错误
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def parse_retry_after(value):
+    """
+    解析 Retry-After 响应头：秒数或 HTTP 日期。
+
+    :return: 需要等待的秒数，无法解析时返回 None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    """
+    复用连接的 JSON HTTP 客户端。
+
+    所有请求共用一个 requests.Session，连接池中的连接保持 keep-alive，连续的请求不再重复 TCP + TLS 握手。
+    遇到 429、5xx、连接错误或超时时按带随机抖动的指数退避重试（full jitter），响应中有 Retry-After 时至少等待该时间
+    （不受 backoff_max 限制）。其他请求异常不重试，和重试用尽一样以错误字典返回。
+    响应只解析一次；每次请求（包括重试）的状态码和耗时记录在 records 中。
+    """
+
+    def __init__(self, connect_timeout=10, read_timeout=120, max_retries=4, backoff_base=1.0, backoff_max=30.0,
+                 pool_size=4):
+        """
+        初始化 HttpClient 实例。
+
+        :param connect_timeout: 建立连接的超时时间（秒）
+        :param read_timeout: 等待响应的超时时间（秒）
+        :param max_retries: 最多重试的次数
+        :param backoff_base: 第一次重试前等待时间的上限（秒），之后每次翻倍
+        :param backoff_max: 单次退避等待时间的上限（秒），不限制 Retry-After
+        :param pool_size: 连接池中保持的连接数
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.records = []
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        :param attempt: 已经失败的次数（从 1 开始）
+        :param retry_after: 服务端要求的等待时间
+        :return: 下一次重试前等待的秒数
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def record(self, url, status, latency, attempt):
+        with self.lock:
+            self.records.append({"url": url, "status": status, "latency": latency, "attempt": attempt})
+
+    def post_json(self, url, payload, headers=None):
+        """
+        发送 JSON POST 请求，失败时按需重试。
+
+        :param url: 请求的地址
+        :param payload: 请求体，按 JSON 编码
+        :param headers: 请求头
+        :return: 解析后的响应 JSON；重试用尽或响应不是 JSON 时返回 {"error": {"message": ...}}
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            begin = time.perf_counter()
+            retry_after = None
+            try:
+                response = self.session.post(url, headers=headers, json=payload, timeout=self.timeout)
+                self.record(url, response.status_code, time.perf_counter() - begin, attempt)
+                if response.status_code not in RETRY_STATUS:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        return {"error": {"message": f"HTTP {response.status_code}: invalid JSON response "
+                                                     f"{response.text[:200]!r}"}}
+                message = f"HTTP {response.status_code}: {response.text[:200]}"
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            except RETRY_EXCEPTIONS as e:
+                self.record(url, None, time.perf_counter() - begin, attempt)
+                message = f"{type(e).__name__}: {e}"
+            except requests.RequestException as e:
+                self.record(url, None, time.perf_counter() - begin, attempt)
+                return {"error": {"message": f"Request failed. {type(e).__name__}: {e}"}}
+            if attempt > self.max_retries:
+                return {"error": {"message": f"Request failed after {attempt} attempts. {message}"}}
+            delay = self.backoff(attempt, retry_after)
+            print_with_color(f"{message}, retrying in {delay:.1f}s ({attempt}/{self.max_retries})", "yellow")
+            time.sleep(delay)
+
+    def stats(self):
+        """
+        :return: 请求次数、重试次数、失败次数以及耗时的平均值和最大值（秒）
+        """
+        with self.lock:
+            records = list(self.records)
+        latencies = [record["latency"] for record in records]
+        return {"requests": len(records), "retries": sum(1 for record in records if record["attempt"] > 1),
+                "failures": sum(1 for record in records if record["status"] is None or record["status"] in RETRY_STATUS),
+                "mean_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+                "max_latency": max(latencies, default=0.0)}
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(configs):
+    """
+    :return: 进程内共享的 HttpClient，参数取自 config.yaml 的 HTTP_* 配置项
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient(configs["HTTP_CONNECT_TIMEOUT"], configs["HTTP_READ_TIMEOUT"],
+                                 configs["HTTP_MAX_RETRIES"], configs["HTTP_BACKOFF_BASE"], configs["HTTP_BACKOFF_MAX"],
+                                 configs["HTTP_POOL_SIZE"])
+        return _client
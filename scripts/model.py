@@ -1,10 +1,30 @@
 import re
-import requests
 
 from config import load_config
-from utils import print_with_color
+from http_client import get_client
+from rate_limiter import get_limiter
+from utils import estimate_image_tokens, print_with_color
 
 configs = load_config()
+# 估算请求 token 时每张图像按一张竖屏手机截图计算，实际用量在响应返回后校正
+IMAGE_TOKEN_ESTIMATE = estimate_image_tokens(1080, 2400)
+
+
+def estimate_request_tokens(content, max_tokens):
+    """
+    粗略估算一次请求消耗的 token：文本按 4 个字符一个 token，每张图像按 IMAGE_TOKEN_ESTIMATE，再加上回复的上限。
+
+    :param content: 发送给模型的 content 列表
+    :param max_tokens: 回复的 token 上限
+    :return: 估算的 token 数
+    """
+    tokens = max_tokens
+    for item in content:
+        if item["type"] == "text":
+            tokens += len(item["text"]) // 4
+        else:
+            tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
 
 
 def ask_gpt4v(content):
@@ -38,23 +58,35 @@ def ask_gpt4v(content):
         "max_tokens": configs["MAX_TOKENS"]
     }
 
-    # 向OpenAI API发送POST请求
-    response = requests.post(configs["OPENAI_API_BASE"], headers=headers, json=payload)
+    # 发送前从共享的令牌桶中取得 RPM / TPM 额度，只有额度确实用完时才等待
+    limiter = get_limiter(configs)
+    estimated_tokens = estimate_request_tokens(content, configs["MAX_TOKENS"])
+    waited = limiter.acquire(estimated_tokens)
+    if waited:
+        print_with_color(f"Rate limit reached, waited {waited:.1f}s", "yellow")
+
+    # 通过共享的连接池向OpenAI API发送POST请求，429 / 5xx 时自动退避重试，响应只解析一次
+    rsp = get_client(configs).post_json(configs["OPENAI_API_BASE"], payload, headers)
 
     # 如果响应中没有错误
-    if "error" not in response.json():
+    if "error" not in rsp:
         # 从响应中获取使用详情
-        usage = response.json()["usage"]
+        usage = rsp["usage"]
         prompt_tokens = usage["prompt_tokens"]
         completion_tokens = usage["completion_tokens"]
+        # 按实际用量校正令牌桶
+        limiter.settle(estimated_tokens, prompt_tokens + completion_tokens)
 
         # 打印请求的成本
         print_with_color(f"请求的成本是 "
                          f"${'{0:.2f}'.format(prompt_tokens / 1000 * 0.01 + completion_tokens / 1000 * 0.03)}",
                          "yellow")
+    else:
+        # 重试用尽仍然失败的请求没有消耗 token，退回预先扣除的估算值，免得挤占共用额度的其他进程
+        limiter.settle(estimated_tokens, 0)
 
     # 返回GPT-4模型的响应
-    return response.json()
+    return rsp
 
 
 def parse_explore_rsp(rsp):
@@ -0,0 +1,185 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# 批量执行时由 fleet.py 设置，让所有子进程共用同一个限流状态文件
+STATE_FILE_ENV = "APPAGENT_RATE_LIMIT_FILE"
+
+
+@contextlib.contextmanager
+def locked_file(path):
+    """
+    以独占文件锁打开限流状态文件（不存在时创建），POSIX 上使用 fcntl.flock，Windows 上使用 msvcrt.locking。
+
+    :param path: 状态文件的路径
+    :return: 已加锁的二进制文件对象
+    """
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK 重试约 10 秒后仍拿不到锁时抛出 OSError，继续等待
+                    continue
+            try:
+                yield f
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """
+    按每分钟请求数（RPM）和每分钟 token 数（TPM）限流的令牌桶。
+
+    两个桶的容量都是一分钟的额度，并按额度匀速补充；请求只在额度确实用完时才等待，而不是每次固定休眠。
+    请求前按估算的 token 扣除，响应返回后用 settle 按实际用量校正。
+    给出 state_path 时桶的状态保存在该文件中并用文件锁保护，多个进程（例如 fleet.py 同时执行的任务）共用同一份额度；
+    否则只在进程内的线程之间共享。rpm 或 tpm 为 0 表示不限制该项。
+    """
+
+    def __init__(self, rpm, tpm, state_path=None):
+        """
+        初始化 RateLimiter 实例。
+
+        :param rpm: 每分钟的请求数上限
+        :param tpm: 每分钟的 token 数上限
+        :param state_path: 跨进程共享的状态文件路径，None 表示只在进程内共享
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.state = None
+        self.waits = 0
+        self.wait_time = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.rpm or self.tpm)
+
+    def load(self, f):
+        if f is not None:
+            f.seek(0)
+            data = f.read()
+            try:
+                return json.loads(data) if data else None
+            except ValueError:
+                return None
+        return self.state
+
+    def save(self, f, state):
+        if f is not None:
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state).encode("utf-8"))
+            f.flush()
+        else:
+            self.state = state
+
+    def update(self, func):
+        """
+        在锁内读取并补充两个桶，调用 func(state) 修改后写回。
+
+        :return: func 的返回值
+        """
+        with self.lock, (locked_file(self.state_path) if self.state_path else contextlib.nullcontext()) as f:
+            now = time.time()
+            state = self.load(f)
+            if state is None:
+                state = {"requests": self.rpm, "tokens": self.tpm, "time": now}
+            elapsed = max(0.0, now - state["time"])
+            state["requests"] = min(self.rpm, state["requests"] + elapsed * self.rpm / 60)
+            state["tokens"] = min(self.tpm, state["tokens"] + elapsed * self.tpm / 60)
+            state["time"] = now
+            result = func(state)
+            self.save(f, state)
+            return result
+
+    def acquire(self, tokens):
+        """
+        等到两个桶都有足够的额度后扣除一次请求和 tokens 个 token。
+
+        :param tokens: 估算的 token 数，超过一分钟额度时按一分钟额度计算
+        :return: 等待的秒数
+        """
+        if not self.enabled:
+            return 0.0
+        need = min(tokens, self.tpm) if self.tpm else 0
+
+        def take(state):
+            waits = []
+            if self.rpm and state["requests"] < 1:
+                waits.append((1 - state["requests"]) * 60 / self.rpm)
+            if self.tpm and state["tokens"] < need:
+                waits.append((need - state["tokens"]) * 60 / self.tpm)
+            if waits:
+                return max(waits)
+            if self.rpm:
+                state["requests"] -= 1
+            if self.tpm:
+                state["tokens"] -= need
+            return 0.0
+
+        waited = 0.0
+        while True:
+            wait = self.update(take)
+            if wait == 0.0:
+                break
+            time.sleep(wait)
+            waited += wait
+        if waited:
+            with self.lock:
+                self.waits += 1
+                self.wait_time += waited
+        return waited
+
+    def settle(self, estimated, actual):
+        """
+        按实际用量校正 token 桶：多扣的退回，少扣的补扣（可以暂时为负）。
+
+        :param estimated: acquire 时估算的 token 数
+        :param actual: 实际消耗的 token 数
+        """
+        if not self.tpm:
+            return
+
+        def adjust(state):
+            state["tokens"] = min(self.tpm, state["tokens"] + min(estimated, self.tpm) - actual)
+
+        self.update(adjust)
+
+    def stats(self):
+        """
+        :return: 因额度不足而等待的次数和总时间（秒）
+        """
+        return {"waits": self.waits, "wait_time": self.wait_time}
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter(configs):
+    """
+    :return: 进程内共享的 RateLimiter；环境变量 APPAGENT_RATE_LIMIT_FILE 或 RATE_LIMIT_STATE_FILE 给出状态文件时跨进程共享
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            state_path = os.environ.get(STATE_FILE_ENV) or configs["RATE_LIMIT_STATE_FILE"] or None
+            _limiter = RateLimiter(configs["RATE_LIMIT_RPM"], configs["RATE_LIMIT_TPM"], state_path)
+        return _limiter
@@ -0,0 +1,309 @@
+import glob
+import os
+import re
+
+import cv2
+import numpy as np
+
+from change_map import tile_hashes, tile_rects
+from utils import print_with_color
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+# 与 skimage.metrics.structural_similarity 的默认参数一致：7x7 均值窗口、样本协方差、uint8 的数据范围 255
+SSIM_WIN_SIZE = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+SSIM_DATA_RANGE = 255
+
+
+def read_image(path):
+    """
+    读取图像文件。使用 np.fromfile + cv2.imdecode，文件名包含中文时在 Windows 上也能读取。
+
+    :param path: 图像文件的路径
+    :return: BGR 图像数组，读取失败时返回 None
+    """
+    try:
+        data = np.fromfile(path, dtype=np.uint8)
+    except OSError:
+        return None
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+def to_gray(image, size=None):
+    """
+    转换为灰度图，并在给定 size 时缩放到该尺寸。
+
+    :param image: BGR 或灰度图像数组
+    :param size: 目标尺寸 (width, height)
+    :return: 灰度图像数组
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    if size is not None and (gray.shape[1], gray.shape[0]) != size:
+        gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def local_mean(image):
+    # 7x7 均值滤波，边界按 scipy.ndimage.uniform_filter 的 reflect 方式处理
+    return cv2.boxFilter(image, cv2.CV_64F, (SSIM_WIN_SIZE, SSIM_WIN_SIZE), normalize=True,
+                         borderType=cv2.BORDER_REFLECT)
+
+
+class SsimReference:
+    """
+    一张目标图像及其预先计算好的 SSIM 统计量。
+
+    灰度图、局部均值 ux 和局部方差 vx 在加载时计算一次，每次比较只需要对候选图像计算 uy、uyy、uxy 三个均值图。
+    计算结果与 skimage.metrics.structural_similarity 的默认设置一致（误差在浮点精度范围内）。
+    """
+
+    def __init__(self, path, image, width=0, coarse_width=0):
+        """
+        初始化 SsimReference 实例。
+
+        :param path: 目标图像的路径
+        :param image: 目标图像（BGR 或灰度数组）
+        :param width: 归一化后的宽度（保持宽高比），0 表示保持原尺寸
+        :param coarse_width: 粗略比较时使用的降采样宽度，0 表示不做粗略比较
+        """
+        self.path = path
+        height, orig_width = image.shape[:2]
+        if width and width != orig_width:
+            self.size = (width, max(1, round(height * width / orig_width)))
+        else:
+            self.size = (orig_width, height)
+        self.gray = to_gray(image, self.size)
+        x = self.gray.astype(np.float64)
+        self.x = x
+        self.ux = local_mean(x)
+        cov_norm = SSIM_WIN_SIZE ** 2 / (SSIM_WIN_SIZE ** 2 - 1)
+        self.cov_norm = cov_norm
+        self.c1 = (SSIM_K1 * SSIM_DATA_RANGE) ** 2
+        self.c2 = (SSIM_K2 * SSIM_DATA_RANGE) ** 2
+        vx = cov_norm * (local_mean(x * x) - self.ux * self.ux)
+        self.b1_x = self.ux * self.ux + self.c1
+        self.b2_x = vx + self.c2
+        self.coarse = None
+        if coarse_width and coarse_width < self.size[0]:
+            self.coarse = SsimReference(path, self.gray, coarse_width)
+
+    def ssim_map(self, gray, region=None):
+        """
+        计算候选灰度图与目标图像的逐像素 SSIM。
+
+        :param gray: 尺寸与 self.size 相同的灰度图像数组
+        :param region: 只计算该区域 (y1, y2, x1, x2)；向外多取 3 个像素作为窗口的输入，结果与整幅计算时的对应部分一致
+        :return: SSIM 图（region 给出时为该区域的部分）
+        """
+        height, width = self.gray.shape
+        y1, y2, x1, x2 = region if region is not None else (0, height, 0, width)
+        pad = (SSIM_WIN_SIZE - 1) // 2
+        # 输入区域在图像边界处被截断，此时 BORDER_REFLECT 的效果与整幅计算相同
+        in_y1, in_y2, in_x1, in_x2 = max(0, y1 - pad), min(height, y2 + pad), max(0, x1 - pad), min(width, x2 + pad)
+        inner = (slice(y1 - in_y1, y2 - in_y1), slice(x1 - in_x1, x2 - in_x1))
+        y = gray[in_y1:in_y2, in_x1:in_x2].astype(np.float64)
+        uy = local_mean(y)[inner]
+        vy = self.cov_norm * (local_mean(y * y)[inner] - uy * uy)
+        ux = self.ux[y1:y2, x1:x2]
+        vxy = self.cov_norm * (local_mean(self.x[in_y1:in_y2, in_x1:in_x2] * y)[inner] - ux * uy)
+        return ((2 * ux * uy + self.c1) * (2 * vxy + self.c2)) / \
+            ((self.b1_x[y1:y2, x1:x2] + uy * uy) * (self.b2_x[y1:y2, x1:x2] + vy))
+
+    def ssim(self, gray):
+        """
+        计算候选灰度图与目标图像的 SSIM。
+
+        :param gray: 尺寸与 self.size 相同的灰度图像数组
+        :return: 平均 SSIM
+        """
+        pad = (SSIM_WIN_SIZE - 1) // 2
+        return float(self.ssim_map(gray)[pad:-pad, pad:-pad].mean())
+
+
+class IncrementalSsim:
+    """
+    与一张目标图像的增量 SSIM。
+
+    保存上一次计算时的图块哈希和逐像素 SSIM 图。新的截图只有部分图块变化时，只重新计算这些图块（及其 3 像素的窗口半径）
+    的 SSIM，耗时与变化区域的大小成正比；图块完全没有变化时直接返回上一次的结果。
+    变化的图块超过 full_fraction 时整幅重新计算。
+    """
+
+    def __init__(self, reference, tile_size, full_fraction=0.5):
+        """
+        初始化 IncrementalSsim 实例。
+
+        :param reference: SsimReference
+        :param tile_size: 图块的边长（像素）
+        :param full_fraction: 变化的图块超过该比例时整幅重新计算
+        """
+        self.reference = reference
+        self.tile_size = tile_size
+        self.full_fraction = full_fraction
+        self.hashes = None
+        self.smap = None
+        self.total = 0.0
+        height, width = reference.gray.shape
+        pad = (SSIM_WIN_SIZE - 1) // 2
+        # 平均 SSIM 不包括边缘 pad 个像素；SSIM 图中这些位置记为 0，总和即为参与平均的部分之和
+        self.interior = np.zeros((height, width), dtype=bool)
+        self.interior[pad:-pad, pad:-pad] = True
+        self.count = int(self.interior.sum())
+        self.full_updates = 0
+        self.partial_updates = 0
+        self.unchanged = 0
+
+    def ssim(self, gray, hashes):
+        """
+        :param gray: 尺寸与目标图像相同的灰度图像数组
+        :param hashes: gray 的图块哈希（change_map.tile_hashes）
+        :return: 平均 SSIM
+        """
+        if self.hashes is not None and hashes.shape == self.hashes.shape:
+            dirty = hashes != self.hashes
+            if not dirty.any():
+                self.unchanged += 1
+                return self.total / self.count
+        else:
+            dirty = None
+        if dirty is None or dirty.mean() > self.full_fraction:
+            self.smap = self.reference.ssim_map(gray)
+            self.smap[~self.interior] = 0
+            self.total = float(self.smap.sum())
+            self.full_updates += 1
+        else:
+            height, width = self.smap.shape
+            pad = (SSIM_WIN_SIZE - 1) // 2
+            for y1, y2, x1, x2 in tile_rects(dirty, self.tile_size, self.smap.shape):
+                # 变化的像素会影响窗口半径内的 SSIM
+                y1, y2, x1, x2 = max(0, y1 - pad), min(height, y2 + pad), max(0, x1 - pad), min(width, x2 + pad)
+                values = self.reference.ssim_map(gray, (y1, y2, x1, x2))
+                values[~self.interior[y1:y2, x1:x2]] = 0
+                self.total += float(values.sum() - self.smap[y1:y2, x1:x2].sum())
+                self.smap[y1:y2, x1:x2] = values
+            self.partial_updates += 1
+        self.hashes = hashes
+        return self.total / self.count
+
+
+class ReferenceStore:
+    """
+    按 (app, task) 缓存任务完成时的目标截图，用于基于相似度的任务终止判断。
+
+    目标图像位于 ref_dir 中，可以有多张：{app}_{task}.jpg、{app}_{task}_1.png ……，
+    或者目录 {app}_{task}/ 下的所有图像。每个任务的目标只在第一次使用时读取和预处理一次。
+    与任意一张目标的 SSIM 达到阈值即认为任务已经完成。
+
+    开启由粗到细的比较（coarse_width > 0）时，先在宽度为 coarse_width 的降采样图像上计算 SSIM，
+    结果低于阈值超过 margin 时直接判定为未完成（返回的是粗略的 SSIM），只有落在阈值附近或以上时才计算全分辨率的 SSIM。
+    降采样图像上的 SSIM 通常低于全分辨率的结果，margin 需要大于两者之差，才能保证判断与全分辨率一致，
+    可以用 benchmark.py ssim 在已有的演示上校准。
+
+    tile_size > 0 时全分辨率的 SSIM 以增量方式计算（IncrementalSsim）：只重新计算与上一次相比内容变化的图块。
+    """
+
+    # 目标文件的扩展名
+    exts = IMAGE_EXTS
+
+    def __init__(self, ref_dir, threshold=0.8, width=0, coarse_width=0, margin=0.1, tile_size=0):
+        """
+        初始化 ReferenceStore 实例。
+
+        :param ref_dir: 目标图像所在的目录
+        :param threshold: 判定任务完成的 SSIM 阈值
+        :param width: 目标图像和截图归一化后的宽度，0 表示使用目标图像的原尺寸
+        :param coarse_width: 粗略比较使用的宽度，0 表示总是计算全分辨率的 SSIM
+        :param margin: 粗略比较的 SSIM 低于阈值超过该值时不再计算全分辨率的 SSIM
+        :param tile_size: 增量 SSIM 的图块边长，0 表示每次整幅计算
+        """
+        self.ref_dir = ref_dir
+        self.threshold = threshold
+        self.width = width
+        self.coarse_width = coarse_width
+        self.margin = margin
+        self.references = {}
+        self.coarse_decisions = 0
+        self.full_decisions = 0
+        self.tile_size = tile_size
+        self.incremental = {}
+
+    def find_paths(self, app, task):
+        """
+        :return: (app, task) 的所有目标图像路径
+        """
+        prefix = f"{app}_{task}"
+        paths = []
+        for path in glob.glob(os.path.join(glob.escape(self.ref_dir), glob.escape(prefix) + "*")):
+            name, ext = os.path.splitext(os.path.basename(path))
+            if ext.lower() in self.exts and (name == prefix or re.fullmatch(re.escape(prefix) + r"_\d+", name)):
+                paths.append(path)
+        sub_dir = os.path.join(self.ref_dir, prefix)
+        if os.path.isdir(sub_dir):
+            paths.extend(os.path.join(sub_dir, name) for name in os.listdir(sub_dir)
+                         if os.path.splitext(name)[1].lower() in self.exts)
+        return sorted(paths)
+
+    def get(self, app, task):
+        """
+        :return: (app, task) 的 SsimReference 列表，没有目标图像时为空列表
+        """
+        key = (app, task)
+        if key not in self.references:
+            references = []
+            for path in self.find_paths(app, task):
+                image = read_image(path)
+                if image is None:
+                    print_with_color(f"ERROR: failed to read the reference image {path}", "red")
+                    continue
+                reference = SsimReference(path, image, self.width, self.coarse_width)
+                references.append(reference)
+                if self.tile_size:
+                    self.incremental[path] = IncrementalSsim(reference, self.tile_size)
+            self.references[key] = references
+        return self.references[key]
+
+    def match(self, app, task, frame):
+        """
+        把当前截图与任务的所有目标图像比较。
+
+        :param app: 应用名称
+        :param task: 任务描述
+        :param frame: 当前截图（BGR 数组）
+        :return: (最高的 SSIM, 是否达到阈值, 对应的目标图像路径)，没有目标图像时返回 None
+        """
+        references = self.get(app, task)
+        if not references:
+            return None
+        frame_gray = to_gray(frame)
+        grays = {}
+        hashes = {}
+
+        def gray_at(size):
+            if size not in grays:
+                grays[size] = to_gray(frame_gray, size)
+            return grays[size]
+
+        def hashes_at(size):
+            if size not in hashes:
+                hashes[size] = tile_hashes(gray_at(size), self.tile_size)
+            return hashes[size]
+
+        best_score, best_path = 0.0, None
+        for reference in references:
+            score = None
+            if reference.coarse is not None:
+                coarse_score = reference.coarse.ssim(gray_at(reference.coarse.size))
+                if coarse_score < self.threshold - self.margin:
+                    score = coarse_score
+                    self.coarse_decisions += 1
+            if score is None:
+                if self.tile_size:
+                    score = self.incremental[reference.path].ssim(gray_at(reference.size),
+                                                                  hashes_at(reference.size))
+                else:
+                    score = reference.ssim(gray_at(reference.size))
+                self.full_decisions += 1
+            if best_path is None or score > best_score:
+                best_score, best_path = score, reference.path
+        return best_score, best_score >= self.threshold, best_path
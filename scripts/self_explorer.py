@@ -9,9 +9,16 @@ import time
 import jiesheng
 import prompts
 from config import load_config
-from and_controller import list_all_devices, AndroidController, traverse_tree
+from and_controller import list_all_devices, AndroidController
+from change_map import ChangeMap
 from model import ask_gpt4v, parse_explore_rsp, parse_reflect_rsp
-from utils import print_with_color, draw_bbox_multi, encode_image
+from hierarchy_similarity import HierarchyStore
+from http_client import get_client
+from rate_limiter import get_limiter
+from similarity_metrics import create_store
+from termination import TerminationChecker, goal_reached
+from utils import print_with_color, draw_bbox_multi, encode_model_image, format_image_stats, image_options, \
+    save_artifact
 
 # 定义命令行参数的描述
 arg_desc = "AppAgent - Autonomous Exploration"
@@ -21,6 +28,8 @@ parser.add_argument("--task")
 parser.add_argument("--using_method")
 parser.add_argument("--num")
 parser.add_argument("--root_dir", default="./")
+parser.add_argument("--device")
+parser.add_argument("--result_json")
 args = vars(parser.parse_args())
 
 # 加载配置
@@ -31,6 +40,8 @@ app = args["app"]
 task = args["task"]
 using_method = args["using_method"]
 root_dir = args["root_dir"]
+device = args["device"]
+result_json = args["result_json"]  # 批量运行时把本次任务的统计数据写入该 JSON 文件，而不是直接写 excel
 num = int(args["num"])  # 此时执行excel表格中的第num行的任务
 similarity_index = 0
 
@@ -51,9 +62,15 @@ demo_dir = os.path.join(work_dir, "demos")
 if not os.path.exists(demo_dir):
     os.mkdir(demo_dir)
 demo_timestamp = int(time.time())
-task_name = datetime.datetime.fromtimestamp(demo_timestamp).strftime("self_explore_%Y-%m-%d_%H-%M-%S")
-task_dir = os.path.join(demo_dir, task_name)
-os.mkdir(task_dir)
+# 多台设备同时执行同一个应用的任务时目录名可能重复，此时顺延一秒
+while True:
+    task_name = datetime.datetime.fromtimestamp(demo_timestamp).strftime("self_explore_%Y-%m-%d_%H-%M-%S")
+    task_dir = os.path.join(demo_dir, task_name)
+    try:
+        os.mkdir(task_dir)
+        break
+    except FileExistsError:
+        demo_timestamp += 1
 docs_dir = os.path.join(work_dir, "auto_docs")
 if not os.path.exists(docs_dir):
     os.mkdir(docs_dir)
@@ -66,7 +83,9 @@ if not device_list:
     print_with_color("ERROR: No device found!", "red")
     sys.exit()
 print_with_color(f"List of devices attached:\n{str(device_list)}", "yellow")
-if len(device_list) == 1:
+if device:
+    print_with_color(f"Device selected: {device}", "yellow")
+elif len(device_list) == 1:
     device = device_list[0]
     print_with_color(f"Device selected: {device}", "yellow")
 else:
@@ -92,79 +111,96 @@ doc_count = 0
 useless_list = set()
 last_act = "None"
 task_complete = False
+# 按 TERMINATION_MODE 使用截图和/或 UI 层次结构判断任务是否完成；缺少某一类目标时只使用另一类
+termination_mode = configs["TERMINATION_MODE"]
+check_image = using_method == 'TRUE' and termination_mode != "hierarchy"
+check_hierarchy = using_method == 'TRUE' and termination_mode != "image"
+# 只在使用截图判断时创建目标截图缓存和后台检查
+reference_store = termination_checker = None
+if check_image:
+    # 任务完成时的目标截图，每个任务只读取、预处理一次；
+    # 终止判断使用的相似度指标和忽略区域可以按应用在 config.yaml 中设置
+    reference_store = create_store(configs, root_dir, app)
+    if reference_store.find_paths(app, task):
+        termination_checker = TerminationChecker(reference_store, app, task)
+    else:
+        print_with_color(f"ERROR: no reference image found for {app}_{task} in {reference_store.ref_dir}", "red")
+        check_image = False
+# 只在使用 UI 层次结构判断时读取目标 XML
+hierarchy_store = None
+if check_hierarchy:
+    hierarchy_store = HierarchyStore(os.path.join(root_dir, configs["REFERENCE_DIR"]),
+                                     configs["HIERARCHY_THRESHOLD"], configs["TERMINATION_MASK"])
+    if not hierarchy_store.find_paths(app, task):
+        print_with_color(f"ERROR: no reference hierarchy found for {app}_{task} in {hierarchy_store.ref_dir}", "red")
+        check_hierarchy = False
+if not check_image and not check_hierarchy:
+    using_method = 'FALSE'
+# 只靠截图就能判断任务完成时，后台的截图检查可以跳过或放弃反思请求
+image_decides = check_image and (termination_mode != "both" or not check_hierarchy)
 
 # 开始自主探索
 # 这段代码是一个循环，用于在达到最大轮数之前进行自主探索
 while round_count < configs["MAX_ROUNDS"]:
 
-    if using_method == 'TRUE':  # jiesheng.py中的代码
+    image_result = None
+    if using_method == 'TRUE' and check_image:  # jiesheng.py中的代码
         if round_count != 0:
-            # 设置一个函数与之前的上一步的图片进行比对，相似度为70%以上则跳出循环，视作任务已经完成了
-            img_result = os.path.join(
-                task_dir, "assets", "result_pic", f"{app}_{task}.jpg")
-            img2_path = os.path.join(task_dir, f"{round_count}_after.png")
-            similarity = jiesheng.pic_ssim(img_result, img2_path)
-            similarity_index = similarity[0]
-            if similarity[1] == True:
-                print(f"与最终任务相似度为{similarity[0]}，任务已经完成了")
+            # 上一轮操作后的截图已经在后台与缓存的目标截图比对，相似度达到 SSIM_THRESHOLD 则跳出循环，视作任务已经完成了
+            image_result = termination_checker.result()
+            if image_result is None or image_result == "ERROR":
+                print_with_color(f"ERROR: image termination check failed for {app}_{task}", "red")
+                image_result = None
+                check_image = image_decides = False
+                if not check_hierarchy:
+                    using_method = 'FALSE'
+            elif not image_decides:
+                similarity_index = image_result[0]
+                print(f"与最终任务相似度为{image_result[0]}")
+            elif image_result[1]:
+                similarity_index = image_result[0]
+                print(f"与最终任务相似度为{image_result[0]}，任务已经完成了")
                 task_complete = True
                 break
             else:
-                print(f"与最终任务相似度为{similarity[0]}，任务还未完成")
+                similarity_index = image_result[0]
+                print(f"与最终任务相似度为{image_result[0]}，任务还未完成")
 
     # 每次循环开始时，轮数加一
     round_count += 1
     # 打印当前轮数
     print_with_color(f"Round {round_count}", "yellow")
-    # 获取当前屏幕截图
-    screenshot_before = controller.get_screenshot(f"{round_count}_before", task_dir)
-    # 获取当前屏幕的XML
-    xml_path = controller.get_xml(f"{round_count}", task_dir)
+    # 同时获取当前屏幕截图和XML，并解析出可点击（按钮，触摸等）和可聚焦（键盘输入文本）元素
+    state = controller.capture_state(f"{round_count}_before", task_dir, f"{round_count}")
     # 如果获取截图或XML失败，则跳出循环
-    if screenshot_before == "ERROR" or xml_path == "ERROR":
+    if state is None:
         break
-    # 初始化可点击（按钮，触摸等）和可聚焦（键盘输入文本）元素列表
-    clickable_list = []
-    focusable_list = []
-    # 遍历XML，获取可点击和可聚焦元素
-    traverse_tree(xml_path, clickable_list, "clickable", True)
-    traverse_tree(xml_path, focusable_list, "focusable", True)
-    # 初始化元素列表
-    elem_list = []
-    # 遍历可点击元素，如果元素不在无用列表中，则添加到元素列表
-    for elem in clickable_list:
-        if elem.uid in useless_list:
-            continue
-        elem_list.append(elem)
-    # 遍历可聚焦元素，如果元素不在无用列表中，则添加到元素列表
-    for elem in focusable_list:
-        if elem.uid in useless_list:
-            continue
-        # 计算元素的中心点
-        bbox = elem.bbox
-        center = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-        # 初始化关闭标志
-        close = False
-        # 遍历可点击元素，计算元素中心点之间的距离，如果距离小于最小距离，则设置关闭标志为True
-        for e in clickable_list:
-            bbox = e.bbox
-            center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-            dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-            if dist <= configs["MIN_DIST"]:
-                close = True
-                break
-        # 如果关闭标志为False，则将元素添加到元素列表
-        if not close:
-            elem_list.append(elem)
+    screenshot_before = state.image
+    # 用本轮观察到的 UI 层次结构与目标比对，不需要额外的 dump
+    if using_method == 'TRUE' and check_hierarchy:
+        hierarchy_result = hierarchy_store.match(app, task, state.xml)
+        if hierarchy_result is not None:
+            print(f"与最终任务的 UI 层次结构相似度为{hierarchy_result[0]:.3f}")
+            if not check_image:
+                similarity_index = hierarchy_result[0]
+        results = [image_result, hierarchy_result] if check_image else [hierarchy_result]
+        if goal_reached(termination_mode, results):
+            print("任务已经完成了")
+            task_complete = True
+            break
+    # 打印与上一轮相比界面元素的变化
+    print_with_color(f"UI changes since last round: {state.diff.summary()}", "yellow")
+    # 过滤掉无用列表中的元素
+    elem_list = state.elem_list.exclude_uids(useless_list)
     # 在截图上绘制元素的边界框
-    draw_bbox_multi(screenshot_before, os.path.join(task_dir, f"{round_count}_before_labeled.png"), elem_list,
-                    dark_mode=configs["DARK_MODE"])
+    labeled_before = draw_bbox_multi(screenshot_before, None, elem_list, dark_mode=configs["DARK_MODE"])
 
     # 生成提示，替换任务描述和最后的动作
     prompt = re.sub(r"<task_description>", task_desc, prompts.self_explore_task_template)
     prompt = re.sub(r"<last_act>", last_act, prompt)
-    # 编码截图
-    base64_img_before = encode_image(os.path.join(task_dir, f"{round_count}_before_labeled.png"))
+    # 标注后的截图由后台线程保存为 PNG；发送给模型的图像按 IMAGE_PRESET 缩放、编码
+    save_artifact(os.path.join(task_dir, f"{round_count}_before_labeled.png"), labeled_before)
+    url_before, stats_before = encode_model_image(labeled_before, **image_options(configs))
     # 生成内容，包括提示和截图
     content = [
         {
@@ -174,10 +210,11 @@ while round_count < configs["MAX_ROUNDS"]:
         {
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_img_before}"
+                "url": url_before
             }
         }
     ]
+    print_with_color(f"Image payload: {format_image_stats([stats_before])}", "yellow")
     # 打印正在思考下一步的动作
     print_with_color("Thinking about what to do in the next step...", "yellow")
     # 向GPT-4V发送请求，获取响应
@@ -188,7 +225,7 @@ while round_count < configs["MAX_ROUNDS"]:
         # 将步骤、提示、图片和响应写入日志文件
         with open(explore_log_path, "a") as logfile:
             log_item = {"step": round_count, "prompt": prompt, "image": f"{round_count}_before_labeled.png",
-                        "response": rsp}
+                        "response": rsp, "ui_diff": state.diff.to_dict(), "image_stats": [stats_before]}
             logfile.write(json.dumps(log_item) + "\n")
         # 解析响应，获取动作名称和最后的动作
         res = parse_explore_rsp(rsp)
@@ -202,8 +239,7 @@ while round_count < configs["MAX_ROUNDS"]:
         # 如果动作名称是"tap"，则执行点击操作
         if act_name == "tap":
             _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+            x, y = elem_list.center(elem_list.label_index(area))
             ret = controller.tap(x, y)
             if ret == "ERROR":
                 print_with_color("ERROR: tap execution failed", "red")
@@ -218,8 +254,7 @@ while round_count < configs["MAX_ROUNDS"]:
         # 如果动作名称是"long_press"，则执行长按操作
         elif act_name == "long_press":
             _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+            x, y = elem_list.center(elem_list.label_index(area))
             ret = controller.long_press(x, y)
             if ret == "ERROR":
                 print_with_color("ERROR: long press execution failed", "red")
@@ -227,8 +262,7 @@ while round_count < configs["MAX_ROUNDS"]:
         # 如果动作名称是"swipe"，则执行滑动操作
         elif act_name == "swipe":
             _, area, swipe_dir, dist = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+            x, y = elem_list.center(elem_list.label_index(area))
             ret = controller.swipe(x, y, swipe_dir, dist)
             if ret == "ERROR":
                 print_with_color("ERROR: swipe execution failed", "red")
@@ -236,23 +270,32 @@ while round_count < configs["MAX_ROUNDS"]:
         # 如果动作名称不是以上任何一个，跳出循环
         else:
             break
-        # 等待一段时间
-        time.sleep(configs["REQUEST_INTERVAL"])
+        # 等待界面稳定
+        settle_time = controller.wait_until_stable()
+        print_with_color(f"Screen settled after {settle_time:.2f}s", "yellow")
     # 如果响应中有错误，打印错误信息，跳出循环
     else:
         print_with_color(rsp["error"]["message"], "red")
         break
 
     # 获取操作后的屏幕截图
-    screenshot_after = controller.get_screenshot(f"{round_count}_after", task_dir)
+    screenshot_after = controller.get_screenshot_image(f"{round_count}_after", task_dir)
     # 如果获取截图失败，跳出循环
-    if screenshot_after == "ERROR":
+    if screenshot_after is None:
         break
+    # 截图一到手就在后台开始终止判断，与下面的标注、编码和反思请求并行
+    if using_method == 'TRUE' and check_image:
+        termination_checker.submit(screenshot_after)
+    # 按图块比较操作前后的截图，判断这次操作是否改变了屏幕
+    change_map = None
+    if configs["CHANGE_TILE_SIZE"]:
+        change_map = ChangeMap.between(screenshot_before, screenshot_after, configs["CHANGE_TILE_SIZE"])
+        print_with_color(f"Screen changes after the action: {change_map.summary()}", "yellow")
     # 在截图上绘制元素的边界框
-    draw_bbox_multi(screenshot_after, os.path.join(task_dir, f"{round_count}_after_labeled.png"), elem_list,
-                    dark_mode=configs["DARK_MODE"])
-    # 编码截图
-    base64_img_after = encode_image(os.path.join(task_dir, f"{round_count}_after_labeled.png"))
+    labeled_after = draw_bbox_multi(screenshot_after, None, elem_list, dark_mode=configs["DARK_MODE"])
+    # 标注后的截图由后台线程保存为 PNG；发送给模型的图像按 IMAGE_PRESET 缩放、编码
+    save_artifact(os.path.join(task_dir, f"{round_count}_after_labeled.png"), labeled_after)
+    url_after, stats_after = encode_model_image(labeled_after, **image_options(configs))
 
     # 根据动作名称生成提示
     if act_name == "tap":
@@ -271,6 +314,12 @@ while round_count < configs["MAX_ROUNDS"]:
     else:
         print_with_color("ERROR: Undefined act!", "red")
         break
+    # 操作前后屏幕完全相同时，不再请求模型反思，直接把这次操作视为无效
+    if change_map is not None and change_map.unchanged and configs["SKIP_REFLECT_ON_UNCHANGED"]:
+        print_with_color("The screen did not change, marking the action as INEFFECTIVE without reflection", "yellow")
+        useless_list.add(elem_list.uids[elem_list.label_index(area)])
+        last_act = "None"
+        continue
     # 替换提示中的UI元素、任务描述和最后的动作
     prompt = re.sub(r"<ui_element>", str(area), prompt)
     prompt = re.sub(r"<task_desc>", task_desc, prompt)
@@ -285,28 +334,34 @@ while round_count < configs["MAX_ROUNDS"]:
         {
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_img_before}"
+                "url": url_before
             }
         },
         {
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_img_after}"
+                "url": url_after
             }
         }
     ]
     # 打印正在反思上一步的动作
+    print_with_color(f"Image payload: {format_image_stats([stats_before, stats_after])}", "yellow")
     print_with_color("Reflecting on my previous action...", "yellow")
-    # 向GPT-4V发送请求，获取响应
-    rsp = ask_gpt4v(content)
+    # 向GPT-4V发送请求，获取响应；后台的终止判断得出任务已完成时跳过或放弃这次请求，回到循环开头结束任务
+    rsp = termination_checker.request(ask_gpt4v, content) if image_decides else ask_gpt4v(content)
+    if rsp is None:
+        print_with_color("Goal reached during reflection, skipping the reflection request", "yellow")
+        continue
     # 如果响应中没有错误
     if "error" not in rsp:
         # 获取元素的资源ID
-        resource_id = elem_list[int(area) - 1].uid
+        resource_id = elem_list.uids[elem_list.label_index(area)]
         # 将步骤、提示、图片和响应写入日志文件
         with open(reflect_log_path, "a") as logfile:
             log_item = {"step": round_count, "prompt": prompt, "image_before": f"{round_count}_before_labeled.png",
-                        "image_after": f"{round_count}_after.png", "response": rsp}
+                        "image_after": f"{round_count}_after.png", "response": rsp,
+                        "image_stats": [stats_before, stats_after],
+                        "screen_change": change_map.to_dict() if change_map is not None else None}
             logfile.write(json.dumps(log_item) + "\n")
         # 解析响应，获取决策
         res = parse_reflect_rsp(rsp)
@@ -369,7 +424,7 @@ while round_count < configs["MAX_ROUNDS"]:
     else:
         print_with_color(rsp["error"]["message"], "red")
         break
-    time.sleep(configs["REQUEST_INTERVAL"])
+    controller.wait_until_stable()
 
 # 根据任务是否完成打印相应的消息
 if task_complete:
@@ -379,6 +434,17 @@ elif round_count == configs["MAX_ROUNDS"]:
                      "yellow")
 else:
     print_with_color(f"Autonomous exploration finished unexpectedly. {doc_count} docs generated.", "red")
+# 打印 UI 层次结构缓存的命中情况
+print_with_color(f"Hierarchy cache: {controller.xml_cache.stats()}", "yellow")
+# 打印模型请求的次数、重试和耗时
+print_with_color(f"Model requests: {get_client(configs).stats()}", "yellow")
+print_with_color(f"Rate limiter: {get_limiter(configs).stats()}", "yellow")
+if termination_checker is not None:
+    print_with_color(f"Termination check: {termination_checker.stats()}", "yellow")
+    termination_checker.close()
+if hierarchy_store is not None:
+    print_with_color(f"Hierarchy check: {hierarchy_store.tree_comparisons} tree comparisons, "
+                     f"{hierarchy_store.multiset_rejections} rejected by multisets", "yellow")
 
 # 调用jiesheng.py内的方法将相关数据存入excel表格中
 txt_path1 = os.path.join(root_dir, "apps", app, "demos", task_name,
@@ -388,5 +454,11 @@ txt_path2 = os.path.join(root_dir, "apps", app, "demos", task_name,
 step_num, explore_tokens, reflect_tokens = jiesheng.read_json_from_txt(txt_path1, txt_path2)
 print("step_num:", step_num, "explore_tokens:", explore_tokens, "reflect_tokens:", reflect_tokens)  # test
 print("similarity_index:", similarity_index)  # test
-jiesheng.write_to_excel(num, step_num, explore_tokens, reflect_tokens, similarity_index,
-                        "D:\Desktop\projects\AppAgent-main\\task_result.xlsx")
+if result_json:
+    with open(result_json, "w") as f:
+        json.dump({"step_num": step_num, "explore_tokens": explore_tokens, "reflect_tokens": reflect_tokens,
+                   "similarity_index": float(similarity_index), "task_complete": task_complete,
+                   "round_count": round_count}, f)
+else:
+    jiesheng.write_to_excel(num, step_num, explore_tokens, reflect_tokens, similarity_index,
+                            "D:\Desktop\projects\AppAgent-main\\task_result.xlsx")
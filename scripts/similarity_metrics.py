@@ -0,0 +1,283 @@
+import os
+
+import cv2
+import numpy as np
+
+from goal_index import dhash, phash
+from reference_store import SSIM_WIN_SIZE, ReferenceStore, SsimReference, read_image, to_gray
+from utils import print_with_color
+
+# 已注册的相似度指标：名称 -> SimilarityMetric 的子类
+METRICS = {}
+
+
+def register_metric(cls):
+    METRICS[cls.name] = cls
+    return cls
+
+
+def mask_array(shape, regions):
+    """
+    :param shape: 图像的 (height, width)
+    :param regions: 要忽略的区域列表，每个区域为相对屏幕的 [x1, y1, x2, y2]（0~1）
+    :return: uint8 数组，参与比较的像素为 255，被忽略的像素为 0；没有要忽略的区域时返回 None
+    """
+    if not regions:
+        return None
+    height, width = shape[:2]
+    mask = np.full((height, width), 255, dtype=np.uint8)
+    for x1, y1, x2, y2 in regions:
+        mask[round(y1 * height):round(y2 * height), round(x1 * width):round(x2 * width)] = 0
+    return mask
+
+
+class SimilarityMetric:
+    """
+    相似度指标的基类。
+
+    prepare 对目标截图做一次预处理，score 把当前截图与预处理的结果比较，返回 0~1 的相似度，
+    越大越接近目标；得分达到 threshold 即认为任务已经完成。
+    mask 为比较时忽略的区域（例如会随时间变化的状态栏），在目标和当前截图上同时生效。
+    """
+
+    name = None
+    default_threshold = 0.8
+
+    def __init__(self, threshold=None, mask=None, **options):
+        """
+        初始化 SimilarityMetric 实例。
+
+        :param threshold: 判定任务完成的阈值，默认使用 default_threshold
+        :param mask: 要忽略的区域列表，每个区域为相对屏幕的 [x1, y1, x2, y2]（0~1）
+        :param options: 指标自身的参数
+        """
+        self.threshold = self.default_threshold if threshold is None else threshold
+        self.mask = mask or []
+        self.options = options
+
+    def masked_gray(self, image, size=None):
+        # 转灰度、缩放到 size，并把忽略的区域填为 0
+        gray = to_gray(image, size)
+        mask = mask_array(gray.shape, self.mask)
+        if mask is not None:
+            gray = cv2.bitwise_and(gray, mask)
+        return gray
+
+    def prepare(self, image):
+        """
+        :param image: 目标截图（BGR 数组）
+        :return: 预处理的结果，无法用于比较时返回 None
+        """
+        raise NotImplementedError
+
+    def score(self, prepared, image):
+        """
+        :param prepared: prepare 的返回值
+        :param image: 当前截图（BGR 数组）
+        :return: 0~1 的相似度
+        """
+        raise NotImplementedError
+
+
+@register_metric
+class SsimMetric(SimilarityMetric):
+    """
+    目标截图原尺寸（或 width 给出的宽度）上的灰度 SSIM，与 skimage.metrics.structural_similarity 一致；
+    有忽略区域时只对其余像素求平均。
+    """
+
+    name = "ssim"
+    width = 0
+
+    def prepare(self, image):
+        reference = SsimReference(None, image, self.options.get("width", self.width))
+        mask = mask_array(reference.gray.shape, self.mask)
+        pad = (SSIM_WIN_SIZE - 1) // 2
+        weights = np.zeros(reference.gray.shape, dtype=bool)
+        weights[pad:-pad, pad:-pad] = True
+        if mask is not None:
+            weights &= mask > 0
+        return reference, weights
+
+    def score(self, prepared, image):
+        reference, weights = prepared
+        ssim_map = reference.ssim_map(to_gray(image, reference.size))
+        return float(ssim_map[weights].mean())
+
+
+@register_metric
+class DownsampledSsimMetric(SsimMetric):
+    """
+    降采样到宽度 width（默认 270）后的 SSIM。比全分辨率快得多，但得分普遍偏低，阈值需要单独校准。
+    """
+
+    name = "ssim_downsampled"
+    default_threshold = 0.7
+    width = 270
+
+
+@register_metric
+class HistogramMetric(SimilarityMetric):
+    """
+    HSV 色调-饱和度直方图的相关系数（负相关记为 0）。对元素的位置不敏感，适合区分颜色明显不同的界面。
+    """
+
+    name = "histogram"
+    default_threshold = 0.95
+
+    def histogram(self, image):
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        hist = cv2.calcHist([hsv], [0, 1], mask_array(hsv.shape, self.mask), [30, 32], [0, 180, 0, 256])
+        return cv2.normalize(hist, hist)
+
+    def prepare(self, image):
+        return self.histogram(image)
+
+    def score(self, prepared, image):
+        return max(0.0, float(cv2.compareHist(prepared, self.histogram(image), cv2.HISTCMP_CORREL)))
+
+
+@register_metric
+class OrbMetric(SimilarityMetric):
+    """
+    ORB 特征点匹配：目标截图的特征点中，在当前截图里找到交叉匹配（汉明距离不超过 max_distance）的比例。
+    对滚动、小幅平移不敏感。
+    """
+
+    name = "orb"
+    default_threshold = 0.3
+
+    def __init__(self, threshold=None, mask=None, **options):
+        super().__init__(threshold, mask, **options)
+        self.orb = cv2.ORB_create(nfeatures=options.get("features", 500))
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self.max_distance = options.get("max_distance", 40)
+
+    def prepare(self, image):
+        gray = to_gray(image)
+        _, descriptors = self.orb.detectAndCompute(gray, mask_array(gray.shape, self.mask))
+        if descriptors is None:
+            return None
+        return gray.shape, descriptors
+
+    def score(self, prepared, image):
+        shape, goal_descriptors = prepared
+        gray = to_gray(image, (shape[1], shape[0]))
+        _, descriptors = self.orb.detectAndCompute(gray, mask_array(gray.shape, self.mask))
+        if descriptors is None:
+            return 0.0
+        matches = self.matcher.match(goal_descriptors, descriptors)
+        good = sum(1 for match in matches if match.distance <= self.max_distance)
+        return good / len(goal_descriptors)
+
+
+@register_metric
+class PerceptualHashMetric(SimilarityMetric):
+    """
+    pHash + dHash（共 128 位）的汉明距离换算成的相似度：1 - 距离 / 128。
+    """
+
+    name = "phash"
+    default_threshold = 0.85
+
+    def prepare(self, image):
+        gray = self.masked_gray(image)
+        return gray.shape, phash(gray), dhash(gray)
+
+    def score(self, prepared, image):
+        shape, goal_phash, goal_dhash = prepared
+        gray = self.masked_gray(image, (shape[1], shape[0]))
+        distance = bin(goal_phash ^ phash(gray)).count("1") + bin(goal_dhash ^ dhash(gray)).count("1")
+        return 1 - distance / 128
+
+
+def create_metric(name, threshold=None, mask=None, **options):
+    """
+    :param name: 指标名称，见 METRICS
+    :return: SimilarityMetric 实例
+    """
+    if name == "xml":
+        # UI 层次结构的比较由 hierarchy_similarity.HierarchyStore 完成，复用每轮 capture_state 得到的 XML
+        raise ValueError("the xml metric is not an image metric, set TERMINATION_MODE to hierarchy, both or either")
+    if name not in METRICS:
+        raise ValueError(f"unknown similarity metric {name}, available: {', '.join(METRICS)}")
+    return METRICS[name](threshold, mask, **options)
+
+
+def metric_settings(configs, app):
+    """
+    读取应用使用的终止判断指标：TERMINATION_APP_METRICS 中该应用（不区分大小写）的设置优先，
+    否则使用 TERMINATION_METRIC 和 TERMINATION_MASK。指标为 ssim 时阈值默认使用 SSIM_THRESHOLD。
+
+    :return: (指标名称, 阈值, 忽略区域列表, 指标参数)
+    """
+    app_settings = {key.lower(): value for key, value in (configs.get("TERMINATION_APP_METRICS") or {}).items()}
+    settings = dict(app_settings.get(app.lower(), {}))
+    name = settings.pop("metric", configs["TERMINATION_METRIC"])
+    threshold = settings.pop("threshold", configs["SSIM_THRESHOLD"] if name == "ssim" else None)
+    mask = settings.pop("mask", configs["TERMINATION_MASK"])
+    return name, threshold, mask, settings
+
+
+class MetricStore(ReferenceStore):
+    """
+    使用任意 SimilarityMetric 的目标截图缓存，接口与 ReferenceStore 相同，目标图像的查找规则也与 ReferenceStore 一致。
+    """
+
+    def __init__(self, ref_dir, metric):
+        """
+        初始化 MetricStore 实例。
+
+        :param ref_dir: 目标图像所在的目录
+        :param metric: SimilarityMetric 实例
+        """
+        super().__init__(ref_dir, metric.threshold)
+        self.metric = metric
+
+    def get(self, app, task):
+        """
+        :return: (app, task) 的 [(目标图像的路径, 预处理的结果), ...]
+        """
+        key = (app, task)
+        if key not in self.references:
+            references = []
+            for path in self.find_paths(app, task):
+                image = read_image(path)
+                prepared = None if image is None else self.metric.prepare(image)
+                if prepared is None:
+                    print_with_color(f"ERROR: failed to prepare the reference {path} for {self.metric.name}", "red")
+                    continue
+                references.append((path, prepared))
+            self.references[key] = references
+        return self.references[key]
+
+    def match(self, app, task, frame):
+        """
+        :param frame: 当前截图（BGR 数组）
+        :return: (最高的相似度, 是否达到阈值, 对应的目标图像路径)，没有可用的目标时返回 None
+        """
+        references = self.get(app, task)
+        if not references:
+            return None
+        best_score, best_path = 0.0, None
+        for path, prepared in references:
+            score = self.metric.score(prepared, frame)
+            if best_path is None or score > best_score:
+                best_score, best_path = score, path
+        self.full_decisions += 1
+        return best_score, best_score >= self.threshold, best_path
+
+
+def create_store(configs, root_dir, app):
+    """
+    按配置创建应用的终止判断使用的目标截图缓存：不带忽略区域的 ssim 使用带有由粗到细、增量计算的 ReferenceStore，
+    其余情况使用 MetricStore。
+
+    :return: ReferenceStore 或 MetricStore
+    """
+    ref_dir = os.path.join(root_dir, configs["REFERENCE_DIR"])
+    name, threshold, mask, options = metric_settings(configs, app)
+    if name == "ssim" and not mask and not options:
+        return ReferenceStore(ref_dir, threshold, configs["SSIM_WIDTH"], configs["SSIM_COARSE_WIDTH"],
+                              configs["SSIM_COARSE_MARGIN"], configs["CHANGE_TILE_SIZE"])
+    return MetricStore(ref_dir, create_metric(name, threshold, mask, **options))
@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+
+class MinDistIndex:
+    """
+    用于 MIN_DIST 去重的均匀网格空间索引。
+
+    网格的边长等于 min_dist，因此与某个点距离不超过 min_dist 的点一定落在该点所在格子及其相邻的 8 个格子中，
+    每次查询只需要检查这 9 个格子里的点，整体去重的复杂度接近线性。距离比较使用平方距离，不需要开方。
+    """
+
+    def __init__(self, min_dist):
+        """
+        初始化 MinDistIndex 实例。
+
+        :param min_dist: 两个元素中心之间允许的最小距离
+        """
+        self.min_dist_sq = min_dist * min_dist
+        self.cell = max(1, math.ceil(min_dist))
+        self.grid = {}
+
+    def add(self, x, y):
+        """
+        向索引中加入一个点。
+
+        :param x: 点的 x 坐标
+        :param y: 点的 y 坐标
+        """
+        self.grid.setdefault((x // self.cell, y // self.cell), []).append((x, y))
+
+    def is_close(self, x, y):
+        """
+        判断索引中是否存在与 (x, y) 距离不超过 min_dist 的点。
+
+        :param x: 点的 x 坐标
+        :param y: 点的 y 坐标
+        :return: 存在这样的点时返回 True
+        """
+        cx, cy = x // self.cell, y // self.cell
+        for gx in (cx - 1, cx, cx + 1):
+            for gy in (cy - 1, cy, cy + 1):
+                for px, py in self.grid.get((gx, gy), ()):
+                    if (px - x) ** 2 + (py - y) ** 2 <= self.min_dist_sq:
+                        return True
+        return False
+
+    def add_if_far(self, x, y):
+        """
+        当索引中没有与 (x, y) 距离不超过 min_dist 的点时，把它加入索引。
+
+        :param x: 点的 x 坐标
+        :param y: 点的 y 坐标
+        :return: 点被加入时返回 True
+        """
+        if self.is_close(x, y):
+            return False
+        self.add(x, y)
+        return True
+
+
+def far_mask(points, reference, min_dist, method="grid"):
+    """
+    判断 points 中的每个点是否与 reference 中的所有点距离都大于 min_dist。
+
+    points 之间不互相比较。method 为 "grid" 时使用 MinDistIndex；为 "numpy" 时分块计算平方距离矩阵，
+    在 C 层完成所有比较，适合点数在几千以内的场景。
+
+    :param points: 待检查的点，形如 [(x, y), ...]
+    :param reference: 参照点，形如 [(x, y), ...]
+    :param min_dist: 最小距离
+    :param method: "grid" 或 "numpy"
+    :return: 长度与 points 相同的 bool 列表
+    """
+    if not len(points) or not len(reference):
+        return [True] * len(points)
+    if method == "numpy":
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+        reference = np.asarray(reference, dtype=np.int64).reshape(-1, 2)
+        mask = np.ones(len(points), dtype=bool)
+        chunk = max(1, 4_000_000 // len(reference))
+        for start in range(0, len(points), chunk):
+            diff = points[start:start + chunk, None, :] - reference[None, :, :]
+            dist_sq = (diff * diff).sum(axis=2)
+            mask[start:start + chunk] = ~(dist_sq <= min_dist * min_dist).any(axis=1)
+        return mask.tolist()
+    index = MinDistIndex(min_dist)
+    for x, y in np.asarray(reference).reshape(-1, 2).tolist():
+        index.add(x, y)
+    return [not index.is_close(x, y) for x, y in np.asarray(points).reshape(-1, 2).tolist()]
@@ -7,7 +7,7 @@ import shutil
 import sys
 import time
 
-from and_controller import list_all_devices, AndroidController, traverse_tree
+from and_controller import list_all_devices, AndroidController
 from config import load_config
 from utils import print_with_color, draw_bbox_multi
 
@@ -85,29 +85,13 @@ print_with_color("All interactive elements on the screen are labeled with red an
 step = 0
 while True:
     step += 1
-    screenshot_path = controller.get_screenshot(f"{demo_name}_{step}", raw_ss_dir)
-    xml_path = controller.get_xml(f"{demo_name}_{step}", xml_dir)
-    if screenshot_path == "ERROR" or xml_path == "ERROR":
+    state = controller.capture_state(f"{demo_name}_{step}", raw_ss_dir, xml_dir=xml_dir)
+    if state is None:
         break
-    clickable_list = []
-    focusable_list = []
-    traverse_tree(xml_path, clickable_list, "clickable", True)
-    traverse_tree(xml_path, focusable_list, "focusable", True)
-    elem_list = clickable_list.copy()
-    for elem in focusable_list:
-        bbox = elem.bbox
-        center = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-        close = False
-        for e in clickable_list:
-            bbox = e.bbox
-            center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-            dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-            if dist <= configs["MIN_DIST"]:
-                close = True
-                break
-        if not close:
-            elem_list.append(elem)
-    labeled_img = draw_bbox_multi(screenshot_path, os.path.join(labeled_ss_dir, f"{demo_name}_{step}.png"), elem_list,
+    elem_list = state.elem_list
+    # 与上一步相同的元素沿用上一步的编号，编号不一定连续
+    labels = set(elem_list.labels.tolist())
+    labeled_img = draw_bbox_multi(state.image, os.path.join(labeled_ss_dir, f"{demo_name}_{step}.png"), elem_list,
                                   True)
     # cv2.imshow("image", labeled_img)
     # cv2.waitKey(0)
@@ -123,42 +107,43 @@ while True:
             and user_input.lower() != "swipe" and user_input.lower() != "stop":
         user_input = input()
     if user_input.lower() == "tap":
-        print_with_color(f"Which element do you want to tap? Choose a numeric tag from 1 to {len(elem_list)}:", "blue")
+        print_with_color(f"Which element do you want to tap? Choose one of the numeric tags on the screenshot:", "blue")
         user_input = "xxx"
-        while not user_input.isnumeric() or int(user_input) > len(elem_list) or int(user_input) < 1:
+        while not user_input.isnumeric() or int(user_input) not in labels:
             user_input = input()
-        tl, br = elem_list[int(user_input) - 1].bbox
-        x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+        index = elem_list.label_index(user_input)
+        x, y = elem_list.center(index)
         ret = controller.tap(x, y)
         if ret == "ERROR":
             print_with_color("ERROR: tap execution failed", "red")
             break
-        record_file.write(f"tap({int(user_input)}):::{elem_list[int(user_input) - 1].uid}\n")
+        record_file.write(f"tap({int(user_input)}):::{elem_list.uids[index]}\n")
     elif user_input.lower() == "text":
-        print_with_color(f"Which element do you want to input the text string? Choose a numeric tag from 1 to "
-                         f"{len(elem_list)}:", "blue")
+        print_with_color(f"Which element do you want to input the text string? Choose one of the "
+                         f"numeric tags on the screenshot:", "blue")
         input_area = "xxx"
-        while not input_area.isnumeric() or int(input_area) > len(elem_list) or int(input_area) < 1:
+        while not input_area.isnumeric() or int(input_area) not in labels:
             input_area = input()
         print_with_color("Enter your input text below:", "blue")
         user_input = ""
         while not user_input:
             user_input = input()
         controller.text(user_input)
-        record_file.write(f"text({input_area}:sep:\"{user_input}\"):::{elem_list[int(input_area) - 1].uid}\n")
+        uid = elem_list.uids[elem_list.label_index(input_area)]
+        record_file.write(f"text({input_area}:sep:\"{user_input}\"):::{uid}\n")
     elif user_input.lower() == "long press":
-        print_with_color(f"Which element do you want to long press? Choose a numeric tag from 1 to {len(elem_list)}:",
+        print_with_color(f"Which element do you want to long press? Choose one of the numeric tags on the screenshot:",
                          "blue")
         user_input = "xxx"
-        while not user_input.isnumeric() or int(user_input) > len(elem_list) or int(user_input) < 1:
+        while not user_input.isnumeric() or int(user_input) not in labels:
             user_input = input()
-        tl, br = elem_list[int(user_input) - 1].bbox
-        x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+        index = elem_list.label_index(user_input)
+        x, y = elem_list.center(index)
         ret = controller.long_press(x, y)
         if ret == "ERROR":
             print_with_color("ERROR: long press execution failed", "red")
             break
-        record_file.write(f"long_press({int(user_input)}):::{elem_list[int(user_input) - 1].uid}\n")
+        record_file.write(f"long_press({int(user_input)}):::{elem_list.uids[index]}\n")
     elif user_input.lower() == "swipe":
         print_with_color(f"What is the direction of your swipe? Choose one from the following options:\nup, down, left,"
                          f" right", "blue")
@@ -166,22 +151,23 @@ while True:
         while user_input != "up" and user_input != "down" and user_input != "left" and user_input != "right":
             user_input = input()
         swipe_dir = user_input
-        print_with_color(f"Which element do you want to swipe? Choose a numeric tag from 1 to {len(elem_list)}:")
-        while not user_input.isnumeric() or int(user_input) > len(elem_list) or int(user_input) < 1:
+        print_with_color(f"Which element do you want to swipe? Choose one of the numeric tags on the screenshot:")
+        while not user_input.isnumeric() or int(user_input) not in labels:
             user_input = input()
-        tl, br = elem_list[int(user_input) - 1].bbox
-        x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+        index = elem_list.label_index(user_input)
+        x, y = elem_list.center(index)
         ret = controller.swipe(x, y, swipe_dir)
         if ret == "ERROR":
             print_with_color("ERROR: swipe execution failed", "red")
             break
-        record_file.write(f"swipe({int(user_input)}:sep:{swipe_dir}):::{elem_list[int(user_input) - 1].uid}\n")
+        record_file.write(f"swipe({int(user_input)}:sep:{swipe_dir}):::{elem_list.uids[index]}\n")
     elif user_input.lower() == "stop":
         record_file.write("stop\n")
         record_file.close()
         break
     else:
         break
-    time.sleep(3)
+    controller.wait_until_stable()
 
 print_with_color(f"Demonstration phase completed. {step} steps were recorded.", "yellow")
+print_with_color(f"Hierarchy cache: {controller.xml_cache.stats()}", "yellow")
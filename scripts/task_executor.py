@@ -9,19 +9,29 @@ import time
 
 import prompts
 from config import load_config
-from and_controller import list_all_devices, AndroidController, traverse_tree
+from and_controller import list_all_devices, AndroidController
+from hierarchy_similarity import HierarchyStore
+from http_client import get_client
+from rate_limiter import get_limiter
 from model import ask_gpt4v, parse_explore_rsp, parse_grid_rsp
-from utils import print_with_color, draw_bbox_multi, encode_image, draw_grid
+from similarity_metrics import create_store
+from termination import goal_reached
+from utils import print_with_color, draw_bbox_multi, draw_grid, encode_model_image, format_image_stats, \
+    get_grid_overlay, image_options
 
 arg_desc = "AppAgent Executor"
 parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
 parser.add_argument("--app")
+parser.add_argument("--task")
+parser.add_argument("--using_method")
 parser.add_argument("--root_dir", default="./")
 args = vars(parser.parse_args())
 
 configs = load_config()
 
 app = args["app"]
+task = args["task"]
+using_method = args["using_method"]
 root_dir = args["root_dir"]
 
 if not app:
@@ -91,74 +101,71 @@ if not width and not height:
     sys.exit()
 print_with_color(f"Screen resolution of {device}: {width}x{height}", "yellow")
 
-print_with_color("Please enter the description of the task you want me to complete in a few sentences:", "blue")
-task_desc = input()
+if not task:
+    print_with_color("Please enter the description of the task you want me to complete in a few sentences:", "blue")
+    task_desc = input()
+else:
+    task_desc = task
+
+# 按 TERMINATION_MODE 用目标截图和/或目标 UI 层次结构判断任务是否完成，缺少某一类目标时只使用另一类
+termination_mode = configs["TERMINATION_MODE"]
+check_image = using_method == 'TRUE' and termination_mode != "hierarchy"
+check_hierarchy = using_method == 'TRUE' and termination_mode != "image"
+reference_store = hierarchy_store = None
+if check_image:
+    reference_store = create_store(configs, root_dir, app)
+    check_image = bool(reference_store.find_paths(app, task_desc))
+if check_hierarchy:
+    hierarchy_store = HierarchyStore(os.path.join(root_dir, configs["REFERENCE_DIR"]), configs["HIERARCHY_THRESHOLD"],
+                                     configs["TERMINATION_MASK"])
+    check_hierarchy = bool(hierarchy_store.find_paths(app, task_desc))
+if using_method == 'TRUE' and not check_image and not check_hierarchy:
+    print_with_color(f"ERROR: no reference image or hierarchy found for {app}_{task_desc}", "red")
 
 round_count = 0
 last_act = "None"
 task_complete = False
 grid_on = False
 rows, cols = 0, 0
-
-
-def area_to_xy(area, subarea):
-    area -= 1
-    row, col = area // cols, area % cols
-    x_0, y_0 = col * (width // cols), row * (height // rows)
-    if subarea == "top-left":
-        x, y = x_0 + (width // cols) // 4, y_0 + (height // rows) // 4
-    elif subarea == "top":
-        x, y = x_0 + (width // cols) // 2, y_0 + (height // rows) // 4
-    elif subarea == "top-right":
-        x, y = x_0 + (width // cols) * 3 // 4, y_0 + (height // rows) // 4
-    elif subarea == "left":
-        x, y = x_0 + (width // cols) // 4, y_0 + (height // rows) // 2
-    elif subarea == "right":
-        x, y = x_0 + (width // cols) * 3 // 4, y_0 + (height // rows) // 2
-    elif subarea == "bottom-left":
-        x, y = x_0 + (width // cols) // 4, y_0 + (height // rows) * 3 // 4
-    elif subarea == "bottom":
-        x, y = x_0 + (width // cols) // 2, y_0 + (height // rows) * 3 // 4
-    elif subarea == "bottom-right":
-        x, y = x_0 + (width // cols) * 3 // 4, y_0 + (height // rows) * 3 // 4
-    else:
-        x, y = x_0 + (width // cols) // 2, y_0 + (height // rows) // 2
-    return x, y
+grid = None
+# 按元素 ID 缓存已经读取的文档内容；与上一轮相比未变化或只移动了位置的元素直接沿用，其余元素重新读取，消失的元素被移出缓存
+doc_cache = {}
 
 
 while round_count < configs["MAX_ROUNDS"]:
     round_count += 1
     print_with_color(f"Round {round_count}", "yellow")
-    screenshot_path = controller.get_screenshot(f"{dir_name}_{round_count}", task_dir)
-    xml_path = controller.get_xml(f"{dir_name}_{round_count}", task_dir)
-    if screenshot_path == "ERROR" or xml_path == "ERROR":
+    state = controller.capture_state(f"{dir_name}_{round_count}", task_dir)
+    if state is None:
         break
+    screenshot = state.image
+    if check_image or check_hierarchy:
+        results = []
+        if check_image:
+            results.append(reference_store.match(app, task_desc, screenshot))
+        if check_hierarchy:
+            results.append(hierarchy_store.match(app, task_desc, state.xml))
+        print_with_color("Similarity to the goal: " + ", ".join(f"{result[0]:.3f}" for result in results
+                                                                  if result is not None), "yellow")
+        if goal_reached(termination_mode, results):
+            print_with_color("The current screen matches the goal, stopping before the next request", "yellow")
+            task_complete = True
+            break
     if grid_on:
-        rows, cols = draw_grid(screenshot_path, os.path.join(task_dir, f"{dir_name}_{round_count}_grid.png"))
-        base64_img = encode_image(os.path.join(task_dir, f"{dir_name}_{round_count}_grid.png"))
+        rows, cols, grid_img = draw_grid(screenshot, os.path.join(task_dir, f"{dir_name}_{round_count}_grid.png"))
+        # 与叠加层同一分辨率的坐标表，动作坐标直接查表
+        grid = get_grid_overlay(*screenshot.shape[:2])
+        image_url, image_stats = encode_model_image(grid_img, **image_options(configs))
         prompt = prompts.task_template_grid
     else:
-        clickable_list = []
-        focusable_list = []
-        traverse_tree(xml_path, clickable_list, "clickable", True)
-        traverse_tree(xml_path, focusable_list, "focusable", True)
-        elem_list = clickable_list.copy()
-        for elem in focusable_list:
-            bbox = elem.bbox
-            center = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-            close = False
-            for e in clickable_list:
-                bbox = e.bbox
-                center_ = (bbox[0][0] + bbox[1][0]) // 2, (bbox[0][1] + bbox[1][1]) // 2
-                dist = (abs(center[0] - center_[0]) ** 2 + abs(center[1] - center_[1]) ** 2) ** 0.5
-                if dist <= configs["MIN_DIST"]:
-                    close = True
-                    break
-            if not close:
-                elem_list.append(elem)
-        draw_bbox_multi(screenshot_path, os.path.join(task_dir, f"{dir_name}_{round_count}_labeled.png"), elem_list,
-                        dark_mode=configs["DARK_MODE"])
-        base64_img = encode_image(os.path.join(task_dir, f"{dir_name}_{round_count}_labeled.png"))
+        elem_list = state.elem_list
+        print_with_color(f"UI changes since last round: {state.diff.summary()}", "yellow")
+        for uid in state.diff.removed_uids():
+            doc_cache.pop(uid, None)
+        reused_uids = state.diff.reused_uids()
+        labeled_img = draw_bbox_multi(screenshot, os.path.join(task_dir, f"{dir_name}_{round_count}_labeled.png"),
+                                      elem_list, dark_mode=configs["DARK_MODE"])
+        image_url, image_stats = encode_model_image(labeled_img, **image_options(configs))
         if no_doc:
             prompt = re.sub(r"<ui_document>", "", prompts.task_template)
         else:
@@ -166,12 +173,14 @@ while round_count < configs["MAX_ROUNDS"]:
             You also have access to the following documentations that describes the functionalities of UI 
             elements you can interact on the screen. These docs are crucial for you to determine the target of your 
             next action. You should always prioritize these documented elements for interaction:"""
-            for i, elem in enumerate(elem_list):
-                doc_path = os.path.join(docs_dir, f"{elem.uid}.txt")
-                if not os.path.exists(doc_path):
+            for uid, label in zip(elem_list.uids, elem_list.labels.tolist()):
+                if uid not in reused_uids or uid not in doc_cache:
+                    doc_path = os.path.join(docs_dir, f"{uid}.txt")
+                    doc_cache[uid] = ast.literal_eval(open(doc_path, "r").read()) if os.path.exists(doc_path) else None
+                doc_content = doc_cache[uid]
+                if doc_content is None:
                     continue
-                ui_doc += f"Documentation of UI element labeled with the numeric tag '{i + 1}':\n"
-                doc_content = ast.literal_eval(open(doc_path, "r").read())
+                ui_doc += f"Documentation of UI element labeled with the numeric tag '{label}':\n"
                 if doc_content["tap"]:
                     ui_doc += f"This UI element is clickable. {doc_content['tap']}\n\n"
                 if doc_content["text"]:
@@ -197,17 +206,18 @@ while round_count < configs["MAX_ROUNDS"]:
         {
             "type": "image_url",
             "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_img}"
+                "url": image_url
             }
         }
     ]
+    print_with_color(f"Image payload: {format_image_stats([image_stats])}", "yellow")
     print_with_color("Thinking about what to do in the next step...", "yellow")
     rsp = ask_gpt4v(content)
 
     if "error" not in rsp:
         with open(log_path, "a") as logfile:
             log_item = {"step": round_count, "prompt": prompt, "image": f"{dir_name}_{round_count}_labeled.png",
-                        "response": rsp}
+                        "response": rsp, "image_stats": [image_stats]}
             logfile.write(json.dumps(log_item) + "\n")
         if grid_on:
             res = parse_grid_rsp(rsp)
@@ -223,8 +233,7 @@ while round_count < configs["MAX_ROUNDS"]:
         res = res[:-1]
         if act_name == "tap":
             _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+            x, y = elem_list.center(elem_list.label_index(area))
             ret = controller.tap(x, y)
             if ret == "ERROR":
                 print_with_color("ERROR: tap execution failed", "red")
@@ -237,16 +246,14 @@ while round_count < configs["MAX_ROUNDS"]:
                 break
         elif act_name == "long_press":
             _, area = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+            x, y = elem_list.center(elem_list.label_index(area))
             ret = controller.long_press(x, y)
             if ret == "ERROR":
                 print_with_color("ERROR: long press execution failed", "red")
                 break
         elif act_name == "swipe":
             _, area, swipe_dir, dist = res
-            tl, br = elem_list[area - 1].bbox
-            x, y = (tl[0] + br[0]) // 2, (tl[1] + br[1]) // 2
+            x, y = elem_list.center(elem_list.label_index(area))
             ret = controller.swipe(x, y, swipe_dir, dist)
             if ret == "ERROR":
                 print_with_color("ERROR: swipe execution failed", "red")
@@ -255,7 +262,11 @@ while round_count < configs["MAX_ROUNDS"]:
             grid_on = True
         elif act_name == "tap_grid" or act_name == "long_press_grid":
             _, area, subarea = res
-            x, y = area_to_xy(area, subarea)
+            xy = grid.area_to_xy(area, subarea)
+            if xy is None:
+                print_with_color(f"ERROR: grid area {area} is out of range", "red")
+                break
+            x, y = xy
             if act_name == "tap_grid":
                 ret = controller.tap(x, y)
                 if ret == "ERROR":
@@ -268,15 +279,20 @@ while round_count < configs["MAX_ROUNDS"]:
                     break
         elif act_name == "swipe_grid":
             _, start_area, start_subarea, end_area, end_subarea = res
-            start_x, start_y = area_to_xy(start_area, start_subarea)
-            end_x, end_y = area_to_xy(end_area, end_subarea)
+            start_xy = grid.area_to_xy(start_area, start_subarea)
+            end_xy = grid.area_to_xy(end_area, end_subarea)
+            if start_xy is None or end_xy is None:
+                print_with_color(f"ERROR: grid area {start_area} or {end_area} is out of range", "red")
+                break
+            (start_x, start_y), (end_x, end_y) = start_xy, end_xy
             ret = controller.swipe_precise((start_x, start_y), (end_x, end_y))
             if ret == "ERROR":
                 print_with_color("ERROR: tap execution failed", "red")
                 break
         if act_name != "grid":
             grid_on = False
-        time.sleep(configs["REQUEST_INTERVAL"])
+        settle_time = controller.wait_until_stable()
+        print_with_color(f"Screen settled after {settle_time:.2f}s", "yellow")
     else:
         print_with_color(rsp["error"]["message"], "red")
         break
@@ -287,3 +303,7 @@ elif round_count == configs["MAX_ROUNDS"]:
     print_with_color("Task finished due to reaching max rounds", "yellow")
 else:
     print_with_color("Task finished unexpectedly", "red")
+print_with_color(f"Hierarchy cache: {controller.xml_cache.stats()}", "yellow")
+# 打印模型请求的次数、重试和耗时
+print_with_color(f"Model requests: {get_client(configs).stats()}", "yellow")
+print_with_color(f"Rate limiter: {get_limiter(configs).stats()}", "yellow")
@@ -0,0 +1,112 @@
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from utils import print_with_color
+
+# TERMINATION_MODE 的取值：只看截图、只看 UI 层次结构、两者都达到阈值、任意一个达到阈值
+TERMINATION_MODES = ("image", "hierarchy", "both", "either")
+
+
+def goal_reached(mode, results):
+    """
+    按 TERMINATION_MODE 合并各项终止判断的结果。
+
+    :param mode: TERMINATION_MODE
+    :param results: 参与判断的各项结果 (相似度, 是否达到阈值, 目标路径)，本轮还没有结果的项为 None
+    :return: 任务是否已经完成
+    """
+    if mode == "both":
+        return all(result is not None and result[1] for result in results)
+    return any(result is not None and result[1] for result in results)
+
+
+class TerminationChecker:
+    """
+    在后台线程中执行基于相似度的任务终止判断。
+
+    操作后的截图一到手就调用 submit 提交检查，检查与标注、编码截图以及反思请求并行执行。
+    检查在发送反思请求之前已经得出"已完成"时，request 直接跳过这次请求；请求发出后检查才得出"已完成"时，
+    不再等待请求的响应（响应在后台线程中被丢弃）。下一轮开始时用 result 取得检查结果。
+    """
+
+    def __init__(self, reference_store, app, task):
+        """
+        初始化 TerminationChecker 实例。
+
+        :param reference_store: 目标截图的 ReferenceStore 或 MetricStore
+        :param app: 应用名称
+        :param task: 任务描述
+        """
+        self.reference_store = reference_store
+        self.app = app
+        self.task = task
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="termination")
+        self.pending = None
+        self.skipped_requests = 0
+        self.abandoned_requests = 0
+
+    def submit(self, frame):
+        """
+        提交一次检查，替换之前未取走的检查。
+
+        :param frame: 操作后的截图（BGR 数组）
+        """
+        self.pending = self.executor.submit(self.reference_store.match, self.app, self.task, frame)
+
+    def reached(self):
+        """
+        :return: 已经完成的检查是否判定任务完成（不阻塞，检查尚未完成时返回 False）
+        """
+        if self.pending is None or not self.pending.done() or self.pending.exception() is not None:
+            return False
+        result = self.pending.result()
+        return result is not None and result[1]
+
+    def result(self):
+        """
+        等待并取走当前的检查结果。
+
+        :return: ReferenceStore.match 的返回值，检查出错时返回 "ERROR"
+        """
+        future, self.pending = self.pending, None
+        try:
+            return future.result()
+        except Exception as e:
+            print_with_color(f"ERROR: termination check failed: {e}", "red")
+            return "ERROR"
+
+    def request(self, func, *args):
+        """
+        在检查进行期间执行模型请求 func(*args)。
+
+        :return: func 的返回值；检查判定任务已完成、请求被跳过或放弃时返回 None
+        """
+        if self.pending is None:
+            return func(*args)
+        if self.reached():
+            self.skipped_requests += 1
+            return None
+        response = Future()
+
+        def run():
+            try:
+                response.set_result(func(*args))
+            except BaseException as e:
+                response.set_exception(e)
+
+        # 使用守护线程：被放弃的请求不会阻止进程退出
+        threading.Thread(target=run, name="model-request", daemon=True).start()
+        wait([response, self.pending], return_when=FIRST_COMPLETED)
+        if not response.done() and self.reached():
+            self.abandoned_requests += 1
+            return None
+        return response.result()
+
+    def stats(self):
+        """
+        :return: 跳过和放弃的模型请求数量
+        """
+        return {"skipped_requests": self.skipped_requests, "abandoned_requests": self.abandoned_requests}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,260 @@
+import argparse
+import glob
+import json
+import os
+import re
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+from goal_index import dhash, parse_goal_name, phash
+from reference_store import IMAGE_EXTS, SsimReference, read_image, to_gray
+from utils import print_with_color
+
+# 参与评估的相似度指标，每个指标的值越大表示越接近目标
+METRICS = ("ssim", "ssim_coarse", "hash")
+
+_worker_references = {}
+
+
+class Frame:
+    """
+    演示轨迹中的一张截图。
+    """
+
+    def __init__(self, demo, step, kind, path, label):
+        """
+        初始化 Frame 实例。
+
+        :param demo: 轨迹目录
+        :param step: 轮数
+        :param kind: "before" 或 "after"
+        :param path: 截图的路径
+        :param label: 该截图是否处于任务已完成的状态
+        """
+        self.demo = demo
+        self.step = step
+        self.kind = kind
+        self.path = path
+        self.label = label
+        self.scores = {}
+
+
+def read_log(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_trajectory(demo_dir):
+    """
+    读取一条 self_explore 轨迹：任务描述、每一轮的 token 数以及每张截图的标签。
+
+    标签默认由日志推断：模型回复 FINISH 的那一轮的 _before 截图和上一轮的 _after 截图为"已完成"，其余为"未完成"。
+    轨迹目录中存在 goal_labels.json（形如 {"done": ["12_after", "13_before"]}）时以其为准。
+
+    :param demo_dir: 轨迹目录
+    :return: (任务描述, {轮数: token 数}, Frame 列表)，没有日志时任务描述为 None
+    """
+    name = os.path.basename(demo_dir)
+    explore_log = read_log(os.path.join(demo_dir, f"log_explore_{name}.txt"))
+    reflect_log = read_log(os.path.join(demo_dir, f"log_reflect_{name}.txt"))
+    if not explore_log:
+        return None, {}, []
+    match = re.search(r"The task you need to complete is to (.*?)\. Your past actions", explore_log[0]["prompt"], re.S)
+    task = match.group(1).strip() if match else None
+    tokens = {}
+    for item in explore_log + reflect_log:
+        tokens[item["step"]] = tokens.get(item["step"], 0) + item["response"]["usage"]["total_tokens"]
+
+    labels_path = os.path.join(demo_dir, "goal_labels.json")
+    if os.path.exists(labels_path):
+        with open(labels_path, "r", encoding="utf-8") as f:
+            done = set(json.load(f)["done"])
+    else:
+        done = set()
+        for item in explore_log:
+            if "FINISH" in item["response"]["choices"][0]["message"]["content"]:
+                done.update({f"{item['step']}_before", f"{item['step'] - 1}_after"})
+                break
+    frames = []
+    for path in glob.glob(os.path.join(demo_dir, "*_before.png")) + glob.glob(os.path.join(demo_dir, "*_after.png")):
+        step, kind = os.path.basename(path)[:-4].split("_")
+        frames.append(Frame(demo_dir, int(step), kind, path, f"{step}_{kind}" in done))
+    frames.sort(key=lambda frame: (frame.step, frame.kind == "after"))
+    return task, tokens, frames
+
+
+def find_goals(ref_dir, app, task):
+    """
+    查找轨迹对应的目标截图，只使用与 (app, task) 完全一致的目标。
+    用同一应用其他任务的目标代替会把别的任务的完成状态当作正样本的目标，使 ROC / PR 曲线失真，没有目标的轨迹应当跳过。
+
+    :return: 目标图像路径列表，没有对应的目标时为空列表
+    """
+    goals = {}
+    for root, _, files in os.walk(ref_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            key = parse_goal_name(path, ref_dir)
+            if key is not None and os.path.splitext(name)[1].lower() in IMAGE_EXTS:
+                goals.setdefault(key, []).append(path)
+    return sorted(goals.get((app, task), []))
+
+
+def score_frame(job):
+    """
+    在工作进程中计算一张截图与其目标截图在各个指标上的得分（多个目标时取最大值）。
+
+    :param job: (截图路径, 目标图像路径列表, SSIM_WIDTH, SSIM_COARSE_WIDTH)
+    :return: {指标: 得分}；SSIM_COARSE_WIDTH 为 0 时 ssim_coarse 与 ssim 相同
+    """
+    path, goal_paths, width, coarse_width = job
+    gray = to_gray(cv2.imread(path))
+    frame_hashes = phash(gray), dhash(gray)
+    scores = {metric: 0.0 for metric in METRICS}
+    for goal_path in goal_paths:
+        if goal_path not in _worker_references:
+            reference = SsimReference(goal_path, read_image(goal_path), width, coarse_width)
+            _worker_references[goal_path] = (reference, phash(reference.gray), dhash(reference.gray))
+        reference, goal_phash, goal_dhash = _worker_references[goal_path]
+        distance = bin(goal_phash ^ frame_hashes[0]).count("1") + bin(goal_dhash ^ frame_hashes[1]).count("1")
+        ssim = reference.ssim(to_gray(gray, reference.size))
+        scores["ssim"] = max(scores["ssim"], ssim)
+        if reference.coarse is not None:
+            ssim = reference.coarse.ssim(to_gray(gray, reference.coarse.size))
+        scores["ssim_coarse"] = max(scores["ssim_coarse"], ssim)
+        scores["hash"] = max(scores["hash"], 1 - distance / 128)
+    return scores
+
+
+def curves(scores, labels):
+    """
+    计算 ROC 和 PR 曲线。
+
+    :param scores: 得分数组
+    :param labels: bool 标签数组
+    :return: 阈值、FPR、TPR、precision、recall 数组，以及 ROC AUC 和 average precision
+    """
+    order = np.argsort(-scores, kind="stable")
+    scores, labels = scores[order], labels[order]
+    # 每个不同的得分作为一个阈值（得分 >= 阈值判定为已完成）
+    last = np.r_[np.flatnonzero(np.diff(scores)), len(scores) - 1]
+    tp = np.cumsum(labels)[last]
+    fp = np.cumsum(~labels)[last]
+    positives, negatives = max(1, labels.sum()), max(1, (~labels).sum())
+    tpr, fpr = tp / positives, fp / negatives
+    precision, recall = tp / (tp + fp), tpr
+    roc_x, roc_y = np.r_[0, fpr], np.r_[0, tpr]
+    auc = float(np.sum(np.diff(roc_x) * (roc_y[1:] + roc_y[:-1]) / 2))
+    average_precision = float(np.sum(np.diff(np.r_[0, recall]) * precision))
+    return scores[last], fpr, tpr, precision, recall, auc, average_precision
+
+
+def simulate(trajectories, metric, threshold):
+    """
+    估算以 threshold 作为终止阈值时可以节省的轮数和 token。
+
+    self_explorer 在每轮开始时检查上一轮的 _after 截图，得分达到阈值即停止。触发停止的截图标注为"未完成"时记为提前误停；
+    误停的任务没有完成，不计入节省的轮数和 token。
+
+    :return: (节省的轮数, 节省的 token, 提前误停的轨迹数)
+    """
+    rounds_saved, tokens_saved, premature = 0, 0, 0
+    for tokens, frames in trajectories:
+        afters = [frame for frame in frames if frame.kind == "after"]
+        if not afters:
+            continue
+        last_step = max(tokens) if tokens else afters[-1].step
+        for frame in afters:
+            if frame.scores[metric] >= threshold:
+                if not frame.label:
+                    premature += 1
+                else:
+                    rounds_saved += last_step - frame.step
+                    tokens_saved += sum(count for step, count in tokens.items() if step > frame.step)
+                break
+    return rounds_saved, tokens_saved, premature
+
+
+def save_plots(results, out_dir):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print_with_color("matplotlib is not installed, curves are only saved as JSON", "yellow")
+        return
+    figure, (roc_axis, pr_axis) = plt.subplots(1, 2, figsize=(12, 5))
+    for metric, result in results.items():
+        roc_axis.plot(result["fpr"], result["tpr"], label=f"{metric} (AUC {result['auc']:.3f})")
+        pr_axis.plot(result["recall"], result["precision"], label=f"{metric} (AP {result['average_precision']:.3f})")
+    roc_axis.set(xlabel="False positive rate", ylabel="True positive rate", title="ROC")
+    pr_axis.set(xlabel="Recall", ylabel="Precision", title="Precision-Recall")
+    roc_axis.legend()
+    pr_axis.legend()
+    figure.savefig(os.path.join(out_dir, "curves.png"), dpi=120, bbox_inches="tight")
+
+
+if __name__ == '__main__':
+    from config import load_config
+    configs = load_config()
+    arg_desc = "AppAgent - offline tuning of the similarity termination threshold"
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=arg_desc)
+    parser.add_argument("--root_dir", default="./")
+    parser.add_argument("--out_dir", default="./tuning_results")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = vars(parser.parse_args())
+
+    ref_dir = os.path.join(args["root_dir"], configs["REFERENCE_DIR"])
+    trajectories, jobs, frames_all = [], [], []
+    for demo_dir in sorted(glob.glob(os.path.join(args["root_dir"], "apps", "*", "demos", "self_explore_*"))):
+        app = os.path.basename(os.path.dirname(os.path.dirname(demo_dir)))
+        task, tokens, frames = load_trajectory(demo_dir)
+        goals = find_goals(ref_dir, app, task) if task else []
+        if not frames or not goals:
+            print_with_color(f"Skipping {demo_dir}: {'no goal image' if frames else 'no log'}", "yellow")
+            continue
+        print_with_color(f"{demo_dir}: {task} -> {len(goals)} goal(s), {len(frames)} frames, "
+                         f"{sum(frame.label for frame in frames)} labeled done", "blue")
+        trajectories.append((tokens, frames))
+        for frame in frames:
+            jobs.append((frame.path, goals, configs["SSIM_WIDTH"], configs["SSIM_COARSE_WIDTH"]))
+            frames_all.append(frame)
+    if not frames_all or not any(frame.label for frame in frames_all):
+        print_with_color("ERROR: no labeled frames to evaluate", "red")
+        raise SystemExit(1)
+
+    with Pool(args["workers"]) as pool:
+        for frame, scores in zip(frames_all, pool.imap(score_frame, jobs, chunksize=4)):
+            frame.scores = scores
+
+    os.makedirs(args["out_dir"], exist_ok=True)
+    labels = np.array([frame.label for frame in frames_all])
+    results = {}
+    print_with_color(f"{len(frames_all)} frames ({labels.sum()} done) from {len(trajectories)} trajectories", "yellow")
+    print_with_color(f"{'metric':<13}{'AUC':>7}{'AP':>7}{'best thr':>10}{'F1':>7}{'prec':>7}{'recall':>8}"
+                     f"{'rounds saved':>14}{'tokens saved':>14}{'premature':>11}", "yellow")
+    for metric in METRICS:
+        scores = np.array([frame.scores[metric] for frame in frames_all])
+        thresholds, fpr, tpr, precision, recall, auc, average_precision = curves(scores, labels)
+        f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-12)
+        best = int(np.argmax(f1))
+        rounds_saved, tokens_saved, premature = simulate(trajectories, metric, thresholds[best])
+        results[metric] = {"auc": auc, "average_precision": average_precision, "best_threshold": float(thresholds[best]),
+                           "f1": float(f1[best]), "precision": precision.tolist(), "recall": recall.tolist(),
+                           "fpr": fpr.tolist(), "tpr": tpr.tolist(), "thresholds": thresholds.tolist(),
+                           "rounds_saved": rounds_saved, "tokens_saved": tokens_saved, "premature_stops": premature}
+        print(f"{metric:<13}{auc:>7.3f}{average_precision:>7.3f}{thresholds[best]:>10.3f}{f1[best]:>7.3f}"
+              f"{precision[best]:>7.3f}{recall[best]:>8.3f}{rounds_saved:>14}{tokens_saved:>14}{premature:>11}")
+    rounds_saved, tokens_saved, premature = simulate(trajectories, "ssim", configs["SSIM_THRESHOLD"])
+    print_with_color(f"Current setting (ssim >= {configs['SSIM_THRESHOLD']}): {rounds_saved} rounds / {tokens_saved} "
+                     f"tokens saved, {premature} premature stops", "yellow")
+
+    with open(os.path.join(args["out_dir"], "threshold_tuning.json"), "w", encoding="utf-8") as f:
+        json.dump({"frames": [{"path": frame.path, "label": bool(frame.label), "scores": frame.scores}
+                              for frame in frames_all], "metrics": results}, f, ensure_ascii=False, indent=1)
+    save_plots(results, args["out_dir"])
+    print_with_color(f"Results saved to {args['out_dir']}", "yellow")
@@ -0,0 +1,169 @@
+import collections
+import itertools
+
+import numpy as np
+
+
+class UiDiff:
+    """
+    相邻两轮 ElementTable 之间的差异。
+
+    下标均为元素在各自 ElementTable 中的位置：added 为新一轮中的下标，removed 为上一轮中的下标，
+    unchanged、moved、changed 为 (上一轮下标, 新一轮下标) 对。
+    unchanged 表示子树内容和边界框都没有变化；moved 表示内容不变但位置或大小改变；changed 表示同一个元素的子树内容发生了变化。
+    与上一轮配对的元素沿用上一轮的标注编号（见 labels），unchanged 和 moved 的元素沿用已经查找到的文档。
+    """
+
+    def __init__(self, previous, current, added, removed, unchanged, moved, changed):
+        """
+        初始化 UiDiff 实例。
+
+        :param previous: 上一轮的 ElementTable，第一轮时为 None
+        :param current: 新一轮的 ElementTable
+        :param added: 新出现的元素下标
+        :param removed: 消失的元素下标
+        :param unchanged: 未变化的元素下标对
+        :param moved: 只改变了位置的元素下标对
+        :param changed: 内容改变的元素下标对
+        """
+        self.previous = previous
+        self.current = current
+        self.added = added
+        self.removed = removed
+        self.unchanged = unchanged
+        self.moved = moved
+        self.changed = changed
+
+    @property
+    def first(self):
+        return self.previous is None
+
+    def reused_uids(self):
+        """
+        :return: 子树内容没有变化（unchanged 或 moved）的元素 ID 集合，这些元素的文档可以直接沿用上一轮的查找结果
+        """
+        return {self.current.uids[new] for _, new in self.unchanged + self.moved}
+
+    def labels(self):
+        """
+        为新一轮的元素分配标注编号：与上一轮配对的元素（unchanged、moved 以及同一元素内容变化的 changed）沿用上一轮的编号，
+        未变化的元素因此编号和标注位置都不变；新出现的元素按顺序使用未被占用的最小编号。第一轮为 1..n。
+
+        :return: 与新一轮 ElementTable 等长的编号数组
+        """
+        labels = np.arange(1, len(self.current) + 1, dtype=np.int32)
+        if self.first:
+            return labels
+        for old, new in self.unchanged + self.moved + self.changed:
+            labels[new] = self.previous.labels[old]
+        used = {int(labels[new]) for _, new in self.unchanged + self.moved + self.changed}
+        free = (label for label in itertools.count(1) if label not in used)
+        for new in self.added:
+            labels[new] = next(free)
+        return labels
+
+    def removed_uids(self):
+        """
+        :return: 上一轮中存在、新一轮中已经不存在的元素 ID 集合
+        """
+        if self.first:
+            return set()
+        return set(self.previous.uids) - set(self.current.uids)
+
+    def summary(self):
+        if self.first:
+            return f"{len(self.current)} elements on the first screen"
+        return (f"{len(self.added)} added, {len(self.removed)} removed, {len(self.moved)} moved, "
+                f"{len(self.changed)} changed, {len(self.unchanged)} unchanged")
+
+    def to_dict(self):
+        """
+        :return: 可以写入 JSON 日志的差异事件，元素使用 ID 表示
+        """
+        if self.first:
+            return {"first": True, "added": list(self.current.uids)}
+        old_uids, new_uids = self.previous.uids, self.current.uids
+        return {
+            "first": False,
+            "added": [new_uids[i] for i in self.added],
+            "removed": [old_uids[i] for i in self.removed],
+            "moved": [new_uids[new] for _, new in self.moved],
+            "changed": [new_uids[new] for _, new in self.changed],
+            "unchanged": len(self.unchanged),
+        }
+
+
+def diff_tables(previous, current):
+    """
+    对比两轮的 ElementTable。
+
+    先按元素 ID 配对（同一 ID 出现多次时按出现顺序配对），再用子树内容哈希比较配对的元素；
+    ID 没有配对上的元素再按子树哈希配对，这样 ID 因尺寸变化而改变、但内容不变的元素会被识别为 moved。
+
+    :param previous: 上一轮的 ElementTable，第一轮时为 None
+    :param current: 新一轮的 ElementTable
+    :return: UiDiff 实例
+    """
+    if previous is None:
+        return UiDiff(None, current, list(range(len(current))), [], [], [], [])
+    old_boxes = previous.boxes().tolist()
+    new_boxes = current.boxes().tolist()
+    old_hashes = previous.hashes.tolist()
+    new_hashes = current.hashes.tolist()
+
+    by_uid = collections.defaultdict(collections.deque)
+    for i, uid in enumerate(previous.uids):
+        by_uid[uid].append(i)
+    pairs = []
+    unmatched_new = []
+    for j, uid in enumerate(current.uids):
+        if by_uid.get(uid):
+            pairs.append((by_uid[uid].popleft(), j))
+        else:
+            unmatched_new.append(j)
+
+    matched_old = {i for i, _ in pairs}
+    by_hash = collections.defaultdict(collections.deque)
+    for i in range(len(previous)):
+        if i not in matched_old and old_hashes[i]:
+            by_hash[old_hashes[i]].append(i)
+    added = []
+    for j in unmatched_new:
+        if by_hash.get(new_hashes[j]):
+            pairs.append((by_hash[new_hashes[j]].popleft(), j))
+        else:
+            added.append(j)
+
+    matched_old = {i for i, _ in pairs}
+    removed = [i for i in range(len(previous)) if i not in matched_old]
+    unchanged, moved, changed = [], [], []
+    for i, j in sorted(pairs, key=lambda pair: pair[1]):
+        if old_hashes[i] != new_hashes[j]:
+            changed.append((i, j))
+        elif old_boxes[i] != new_boxes[j]:
+            moved.append((i, j))
+        else:
+            unchanged.append((i, j))
+    return UiDiff(previous, current, added, removed, unchanged, moved, changed)
+
+
+class HierarchyDiffer:
+    """
+    记住上一轮的 ElementTable，每次传入新一轮的 ElementTable 时返回两者之间的 UiDiff，并按差异为新一轮的元素分配标注编号。
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def update(self, current):
+        """
+        :param current: 新一轮的 ElementTable，其 labels 列会被改写
+        :return: UiDiff 实例
+        """
+        diff = diff_tables(self.previous, current)
+        current.labels = diff.labels()
+        self.previous = current
+        return diff
+
+    def reset(self):
+        self.previous = None
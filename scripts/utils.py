@@ -1,6 +1,13 @@
+import atexit
 import base64
+import itertools
+import math
+import os
+import queue
+import threading
+
 import cv2
-import pyshine as ps
+import numpy as np
 
 from colorama import Fore, Style
 
@@ -27,74 +34,360 @@ def print_with_color(text: str, color=""):
     print(Style.RESET_ALL)
 
 
+def load_image(img):
+    # 截图既可能是文件路径，也可能是已经在内存中的 BGR 数组；数组会被复制，避免标注时改写原图
+    if isinstance(img, np.ndarray):
+        return img.copy()
+    return cv2.imread(img)
+
+
+_artifact_queue = None
+_artifact_lock = threading.Lock()
+
+
+def _artifact_worker(artifact_queue):
+    while True:
+        path, data = artifact_queue.get()
+        try:
+            if isinstance(data, np.ndarray):
+                data = encode_png(data, os.path.splitext(path)[1] or ".png")
+            with open(path, "wb") as f:
+                f.write(data)
+        except Exception as e:
+            # 单个产物编码或写入失败时只记录错误，写盘线程继续处理队列中的其他产物
+            print_with_color(f"ERROR: failed to save {path}\n{e}", "red")
+        finally:
+            artifact_queue.task_done()
+
+
+def save_artifact(path, data):
+    # 由后台线程把日志产物（XML、截图等）写入磁盘，不阻塞主循环；解释器退出前会等待队列写完。
+    # data 为图像数组时按 path 的扩展名在后台线程中编码，调用方之后不能再原地修改这个数组
+    global _artifact_queue
+    with _artifact_lock:
+        if _artifact_queue is None:
+            _artifact_queue = queue.Queue()
+            threading.Thread(target=_artifact_worker, args=(_artifact_queue,), daemon=True).start()
+            atexit.register(_artifact_queue.join)
+    _artifact_queue.put((path, data))
+
+
+def encode_png(image, ext=".png"):
+    ok, buffer = cv2.imencode(ext, image)
+    if not ok:
+        raise ValueError(f"failed to encode the image as {ext}")
+    return buffer.tobytes()
+
+
+def iter_elem_boxes(elem_list):
+    # ElementTable 直接按列迭代 (left, top, right, bottom, attrib)；普通的元素列表从 bbox 中取值
+    if hasattr(elem_list, "rows"):
+        return elem_list.rows()
+    return ((e.bbox[0][0], e.bbox[0][1], e.bbox[1][0], e.bbox[1][1], e.attrib) for e in elem_list)
+
+
+class LabelRenderer:
+    """
+    绘制 draw_bbox_multi 中的数字标签，结果与 pyshine.putBText 逐像素一致。
+
+    每种配色一个实例。每个标签文本的尺寸和对应大小的背景色块只在第一次出现时生成，之后缓存复用；
+    绘制时只在标签下方的小块区域上原地做一次 addWeighted 混合，然后绘制文字，
+    不再为每个标签重新计算文字尺寸、用 split / merge 构造背景矩形、复制混合结果。
+    这只省去了 putBText 中的少量开销（benchmark.py labels 中演示截图约 1.1~1.3 倍，150 个元素时约 2 倍）：文字仍由 cv2.putText 绘制，
+    每个标签只需几微秒，预先渲染文字贴图再用 NumPy 混合反而更慢。
+    """
+
+    def __init__(self, background_RGB, text_RGB, font=cv2.FONT_HERSHEY_DUPLEX, font_scale=1, thickness=2,
+                 vspace=10, hspace=10, alpha=0.5):
+        """
+        初始化 LabelRenderer 实例，参数与 pyshine.putBText 相同。
+
+        :param background_RGB: 背景颜色 (R, G, B)
+        :param text_RGB: 文字颜色 (R, G, B)
+        :param font: 字体
+        :param font_scale: 字号
+        :param thickness: 笔画粗细
+        :param vspace: 文字与背景上下边缘的距离
+        :param hspace: 文字与背景左右边缘的距离
+        :param alpha: 原图在混合中所占的比例
+        """
+        self.background = tuple(int(c) for c in background_RGB[::-1])
+        self.text_color = tuple(int(c) for c in text_RGB[::-1])
+        self.font = font
+        self.font_scale = font_scale
+        self.thickness = thickness
+        self.vspace = vspace
+        self.hspace = hspace
+        self.alpha = alpha
+        self.blocks = {}
+
+    def block(self, label):
+        """
+        :param label: 标签文本
+        :return: (文字宽度, 文字高度, 背景色块)
+        """
+        block = self.blocks.get(label)
+        if block is None:
+            w, h = cv2.getTextSize(label, self.font, fontScale=self.font_scale, thickness=self.thickness)[0]
+            background = np.empty((h + 2 * self.vspace, w + 2 * self.hspace, 3), dtype=np.uint8)
+            background[:] = self.background
+            block = self.blocks[label] = (w, h, background)
+        return block
+
+    def draw(self, img, label, x, y):
+        """
+        在 img 上原地绘制一个标签，效果等同于 pyshine.putBText(img, label, x, y, ...)。
+
+        :param img: BGR 图像数组
+        :param label: 标签文本
+        :param x: 文字左上角的 x 坐标
+        :param y: 文字左上角的 y 坐标
+        :return: img
+        """
+        w, h, background = self.block(label)
+        # 与 putBText 使用相同的切片方式，超出图像的部分被截断；起点为负数时得到空区域，与 putBText 一样抛出异常
+        crop = img[y - self.vspace:y + h + self.vspace, x - self.hspace:x + w + self.hspace]
+        if crop.size == 0:
+            raise ValueError(f"label {label} at ({x}, {y}) is outside the image")
+        ch, cw = crop.shape[:2]
+        if ch <= background.shape[0] and cw <= background.shape[1]:
+            background = background[:ch, :cw]
+        else:
+            background = np.full(crop.shape, self.background, dtype=np.uint8)
+        cv2.addWeighted(crop, self.alpha, background, 1 - self.alpha, 0, dst=crop)
+        cv2.putText(img, label, (x, y + h), self.font, fontScale=self.font_scale, color=self.text_color,
+                    thickness=self.thickness)
+        return img
+
+
+_label_renderers = {}
+
+
+def get_label_renderer(background_RGB, text_RGB):
+    # 每种配色（普通 / 深色模式 / 录制模式下的各属性颜色）共用一个 LabelRenderer 及其缓存
+    key = (tuple(background_RGB), tuple(text_RGB))
+    renderer = _label_renderers.get(key)
+    if renderer is None:
+        renderer = _label_renderers[key] = LabelRenderer(background_RGB, text_RGB)
+    return renderer
+
+
 def draw_bbox_multi(img_path, output_path, elem_list, record_mode=False, dark_mode=False):
-    imgcv = cv2.imread(img_path)
-    count = 1
-    for elem in elem_list:
+    imgcv = load_image(img_path)
+    # ElementTable 使用其 labels 列（与上一轮相同的元素沿用上一轮的编号），其他列表按顺序从 1 编号
+    labels = elem_list.labels.tolist() if hasattr(elem_list, "labels") else itertools.count(1)
+    for (left, top, right, bottom, attrib), count in zip(iter_elem_boxes(elem_list), labels):
         try:
-            top_left = elem.bbox[0]
-            bottom_right = elem.bbox[1]
-            left, top = top_left[0], top_left[1]
-            right, bottom = bottom_right[0], bottom_right[1]
             label = str(count)
             if record_mode:
-                if elem.attrib == "clickable":
+                if attrib == "clickable":
                     color = (250, 0, 0)
-                elif elem.attrib == "focusable":
+                elif attrib == "focusable":
                     color = (0, 0, 250)
                 else:
                     color = (0, 250, 0)
-                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10, text_offset_y=(top + bottom) // 2 + 10,
-                                    vspace=10, hspace=10, font_scale=1, thickness=2, background_RGB=color,
-                                    text_RGB=(255, 250, 250), alpha=0.5)
+                get_label_renderer(color, (255, 250, 250)).draw(imgcv, label, (left + right) // 2 + 10,
+                                                                (top + bottom) // 2 + 10)
             else:
                 text_color = (10, 10, 10) if dark_mode else (255, 250, 250)
                 bg_color = (255, 250, 250) if dark_mode else (10, 10, 10)
-                imgcv = ps.putBText(imgcv, label, text_offset_x=(left + right) // 2 + 10, text_offset_y=(top + bottom) // 2 + 10,
-                                    vspace=10, hspace=10, font_scale=1, thickness=2, background_RGB=bg_color,
-                                    text_RGB=text_color, alpha=0.5)
+                get_label_renderer(bg_color, text_color).draw(imgcv, label, (left + right) // 2 + 10,
+                                                              (top + bottom) // 2 + 10)
         except Exception as e:
             print_with_color(f"ERROR: An exception occurs while labeling the image\n{e}", "red")
-        count += 1
-    cv2.imwrite(output_path, imgcv)
+    if output_path:
+        save_artifact(output_path, imgcv)
     return imgcv
 
 
-def draw_grid(img_path, output_path):
-    def get_unit_len(n):
-        for i in range(1, n + 1):
-            if n % i == 0 and 120 <= i <= 180:
-                return i
-        return -1
+GRID_SUBAREAS = ("center", "top-left", "top", "top-right", "left", "right", "bottom-left", "bottom", "bottom-right")
+
+
+class GridOverlay:
+    """
+    某一分辨率下网格模式的叠加层和坐标表。
 
-    image = cv2.imread(img_path)
+    网格线和编号只在创建时绘制一次：分别画在全黑和全白的画布上，由两者之差得到每个像素的透光率和预乘颜色，
+    之后每一帧只需要一次乘法和一次加法完成 alpha 合成。
+    (格子编号, 子区域) 到点击坐标的映射也在创建时算好，与叠加层使用同一套格子尺寸，两者不会不一致。
+    """
+
+    def __init__(self, height, width):
+        """
+        初始化 GridOverlay 实例。
+
+        :param height: 截图的高度
+        :param width: 截图的宽度
+        """
+        def get_unit_len(n):
+            for i in range(1, n + 1):
+                if n % i == 0 and 120 <= i <= 180:
+                    return i
+            return -1
+
+        self.height, self.width = height, width
+        unit_height = get_unit_len(height)
+        if unit_height < 0:
+            unit_height = 120
+        unit_width = get_unit_len(width)
+        if unit_width < 0:
+            unit_width = 120
+        self.unit_height, self.unit_width = unit_height, unit_width
+        self.rows = height // unit_height
+        self.cols = width // unit_width
+
+        black = np.zeros((height, width, 3), dtype=np.uint8)
+        white = np.full((height, width, 3), 255, dtype=np.uint8)
+        self.draw(black)
+        self.draw(white)
+        # 合成公式：out = frame * (255 - alpha) / 255 + premultiplied，其中 255 - alpha 等于 white - black
+        self.transmittance = cv2.subtract(white, black)
+        self.premultiplied = black
+
+        table = np.empty((self.rows * self.cols, len(GRID_SUBAREAS), 2), dtype=np.int32)
+        fractions = {"center": (2, 2), "top-left": (1, 1), "top": (2, 1), "top-right": (3, 1), "left": (1, 2),
+                     "right": (3, 2), "bottom-left": (1, 3), "bottom": (2, 3), "bottom-right": (3, 3)}
+        for area in range(self.rows * self.cols):
+            row, col = area // self.cols, area % self.cols
+            x_0, y_0 = col * unit_width, row * unit_height
+            for k, subarea in enumerate(GRID_SUBAREAS):
+                fx, fy = fractions[subarea]
+                table[area, k] = (x_0 + unit_width * fx // 4, y_0 + unit_height * fy // 4)
+        self.table = table
+
+    def draw(self, image):
+        # 原来 draw_grid 的绘制逻辑
+        color = (255, 116, 113)
+        unit_height, unit_width = self.unit_height, self.unit_width
+        thick = int(unit_width // 50)
+        for i in range(self.rows):
+            for j in range(self.cols):
+                label = i * self.cols + j + 1
+                left = int(j * unit_width)
+                top = int(i * unit_height)
+                right = int((j + 1) * unit_width)
+                bottom = int((i + 1) * unit_height)
+                cv2.rectangle(image, (left, top), (right, bottom), color, thick // 2)
+                cv2.putText(image, str(label), (left + int(unit_width * 0.05) + 3, top + int(unit_height * 0.3) + 3),
+                            0, int(0.01 * unit_width), (0, 0, 0), thick)
+                cv2.putText(image, str(label), (left + int(unit_width * 0.05), top + int(unit_height * 0.3)), 0,
+                            int(0.01 * unit_width), color, thick)
+
+    def apply(self, image):
+        """
+        把网格叠加到 image 上（原地修改）。
+
+        :param image: 与创建时分辨率相同的 BGR 图像数组
+        :return: image
+        """
+        cv2.multiply(image, self.transmittance, dst=image, scale=1 / 255)
+        cv2.add(image, self.premultiplied, dst=image)
+        return image
+
+    def area_to_xy(self, area, subarea):
+        """
+        :param area: 格子编号（从 1 开始）
+        :param subarea: 子区域名称，未知的名称按 "center" 处理
+        :return: 点击坐标 (x, y)，格子编号超出范围时返回 None
+        """
+        if not 1 <= area <= len(self.table):
+            return None
+        k = GRID_SUBAREAS.index(subarea) if subarea in GRID_SUBAREAS else 0
+        x, y = self.table[area - 1, k]
+        return int(x), int(y)
+
+
+_grid_overlays = {}
+
+
+def get_grid_overlay(height, width):
+    # 每种分辨率只创建一次 GridOverlay
+    overlay = _grid_overlays.get((height, width))
+    if overlay is None:
+        overlay = _grid_overlays[(height, width)] = GridOverlay(height, width)
+    return overlay
+
+
+def draw_grid(img_path, output_path):
+    image = load_image(img_path)
     height, width, _ = image.shape
-    color = (255, 116, 113)
-    unit_height = get_unit_len(height)
-    if unit_height < 0:
-        unit_height = 120
-    unit_width = get_unit_len(width)
-    if unit_width < 0:
-        unit_width = 120
-    thick = int(unit_width // 50)
-    rows = height // unit_height
-    cols = width // unit_width
-    for i in range(rows):
-        for j in range(cols):
-            label = i * cols + j + 1
-            left = int(j * unit_width)
-            top = int(i * unit_height)
-            right = int((j + 1) * unit_width)
-            bottom = int((i + 1) * unit_height)
-            cv2.rectangle(image, (left, top), (right, bottom), color, thick // 2)
-            cv2.putText(image, str(label), (left + int(unit_width * 0.05) + 3, top + int(unit_height * 0.3) + 3), 0,
-                        int(0.01 * unit_width), (0, 0, 0), thick)
-            cv2.putText(image, str(label), (left + int(unit_width * 0.05), top + int(unit_height * 0.3)), 0,
-                        int(0.01 * unit_width), color, thick)
-    cv2.imwrite(output_path, image)
-    return rows, cols
-
-
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    overlay = get_grid_overlay(height, width)
+    overlay.apply(image)
+    if output_path:
+        save_artifact(output_path, image)
+    return overlay.rows, overlay.cols, image
+
+
+# draw_bbox_multi 的数字标签约 22 像素高，缩放比例不低于该值时标签在模型看来仍然清晰
+LABEL_MIN_SCALE = 0.5
+# 发送给模型的图像的编码预设：(格式, 长边上限, 质量, 最小缩放比例)，长边上限为 0 表示不缩放；
+# 最小缩放比例优先于长边上限，low 为了体积不设下限，1080x2400 的截图会缩小到长边 1024，标签约 9 像素高
+IMAGE_PRESETS = {
+    "full": ("png", 0, 100, 0.0),
+    "high": ("jpeg", 2048, 90, LABEL_MIN_SCALE),
+    "balanced": ("jpeg", 1568, 85, LABEL_MIN_SCALE),
+    "low": ("webp", 1024, 75, 0.0),
+}
+IMAGE_MIME = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def image_options(configs):
+    # 从配置中读取模型图像的编码参数；IMAGE_PRESET 为 "custom" 时使用 IMAGE_FORMAT、IMAGE_MAX_EDGE、IMAGE_QUALITY
+    # 和 IMAGE_MIN_SCALE
+    if configs["IMAGE_PRESET"] == "custom":
+        return {"fmt": configs["IMAGE_FORMAT"], "max_edge": configs["IMAGE_MAX_EDGE"],
+                "quality": configs["IMAGE_QUALITY"], "min_scale": configs["IMAGE_MIN_SCALE"]}
+    fmt, max_edge, quality, min_scale = IMAGE_PRESETS[configs["IMAGE_PRESET"]]
+    return {"fmt": fmt, "max_edge": max_edge, "quality": quality, "min_scale": min_scale}
+
+
+def estimate_image_tokens(width, height):
+    # 按 GPT-4V 高精度模式估算图像 token：先缩放到 2048x2048 以内，再把短边缩放到 768 以内，
+    # 每个 512x512 的图块 170 个 token，另加 85 个基础 token
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+def encode_model_image(image, fmt="jpeg", max_edge=1568, quality=85, min_scale=LABEL_MIN_SCALE):
+    """
+    把要发送给模型的图像缩放并编码为 data URL。
+
+    长边超过 max_edge 时用 INTER_AREA 缩小，但缩放比例不低于 min_scale，保证数字标签仍然清晰；
+    两者冲突时 min_scale 优先，此时长边会超过 max_edge。MIME 类型与实际编码格式一致。
+
+    :param image: BGR 图像数组或图像文件路径
+    :param fmt: "png"、"jpeg" 或 "webp"
+    :param max_edge: 长边上限（像素），0 表示不缩放
+    :param quality: JPEG / WebP 的质量（0~100）
+    :param min_scale: 最小缩放比例，0 表示严格遵守 max_edge
+    :return: (data URL, 统计信息)，统计信息包括 bytes、width、height 和估算的 tokens
+    """
+    if not isinstance(image, np.ndarray):
+        image = cv2.imread(image)
+    height, width = image.shape[:2]
+    if max_edge and max(width, height) > max_edge:
+        scale = max(max_edge / max(width, height), min_scale)
+        width, height = round(width * scale), round(height * scale)
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    if fmt == "jpeg":
+        ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    elif fmt == "webp":
+        ok, buffer = cv2.imencode(".webp", image, [cv2.IMWRITE_WEBP_QUALITY, int(quality)])
+    else:
+        ok, buffer = cv2.imencode(".png", image)
+    if not ok:
+        raise ValueError(f"failed to encode the image as {fmt}")
+    data = buffer.tobytes()
+    stats = {"bytes": len(data), "width": width, "height": height, "tokens": estimate_image_tokens(width, height)}
+    return f"data:{IMAGE_MIME[fmt]};base64,{base64.b64encode(data).decode('utf-8')}", stats
+
+
+def format_image_stats(stats_list):
+    # 汇总一次请求中所有图像的大小和估算 token，用于打印
+    total_bytes = sum(stats["bytes"] for stats in stats_list)
+    total_tokens = sum(stats["tokens"] for stats in stats_list)
+    sizes = ", ".join(f"{stats['width']}x{stats['height']}" for stats in stats_list)
+    return f"{len(stats_list)} image(s) ({sizes}), {total_bytes / 1024:.0f} KB, ~{total_tokens} image tokens"